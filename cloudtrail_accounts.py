@@ -0,0 +1,183 @@
+import datetime
+import os
+import re
+import sys
+import threading
+
+from cloudtrail_cli import load_principals
+from cloudtrail_fetcher import create_cloudtrail_client, is_throttling_error, set_account_pool
+from cloudtrail_metrics import metrics
+
+
+# 各アカウントで引き受ける読み取り専用ロールの名前（--role-name 未指定時）
+DEFAULT_ROLE_NAME = "CloudTrailInspectorReadOnly"
+
+# AssumeRoleで取得する認証情報の有効期間（秒）
+DEFAULT_ROLE_DURATION_SECONDS = 3600
+
+# 認証情報の期限が切れる何秒前に取得し直すか（有効期間の1/4より短い場合はそちらを使う）
+CREDENTIAL_REFRESH_SECONDS = 300
+
+# AssumeRoleのセッション名（各アカウントのCloudTrailに記録される）
+ROLE_SESSION_NAME = "ctinspect"
+
+# --accounts 指定時の並列数の上限（--concurrency 未指定時は (アカウント, リージョン) の数まで並列にする）
+MAX_ACCOUNT_CONCURRENCY = 32
+
+
+# AssumeRoleできないアカウントで送出する例外（権限エラーのため fetch_page は再試行しない）
+class AccountAccessError(PermissionError):
+    pass
+
+
+# アカウントIDの一覧を読み込む関数（ファイル（1行に1件）またはカンマ区切り）
+def load_accounts(value):
+    accounts = load_principals(value) if os.path.isfile(value) else [account.strip() for account in value.split(",") if account.strip()]
+    invalid = [account for account in accounts if not re.fullmatch(r"\d{12}", account)]
+    if invalid:
+        raise ValueError(f"アカウントIDは12桁の数字で指定してください: {', '.join(invalid)}")
+    return list(dict.fromkeys(accounts))
+
+
+# CloudTrailクライアントを作成する関数（AccountPool の client_factory の既定値）
+def create_account_client(account, region, credentials):
+    return create_cloudtrail_client(region, credentials)
+
+
+# アカウントごとの一時的な認証情報と、(アカウント, リージョン) ごとのクライアントを管理するクラス
+# 認証情報は期限が近づくまで使い回し、期限が近づいたら次に使うときにAssumeRoleし直す（長時間の実行でも期限切れにならない）
+# 認証情報を取得し直した場合は、そのアカウントのクライアントも作り直す
+# 複数のワーカースレッドから同時に使え、同じアカウントのAssumeRoleは1回だけ行う
+class AccountPool:
+    def __init__(self, accounts, role_name=DEFAULT_ROLE_NAME, external_id=None,
+                 duration_seconds=DEFAULT_ROLE_DURATION_SECONDS, sts_client=None, client_factory=create_account_client):
+        self.accounts = list(accounts)
+        self.role_name = role_name
+        self.external_id = external_id
+        self.duration_seconds = duration_seconds
+        self.refresh_seconds = min(CREDENTIAL_REFRESH_SECONDS, duration_seconds / 4)
+        self.sts_client = sts_client
+        self.client_factory = client_factory
+        self.lock = threading.Lock()
+        self.account_locks = {}
+        # アカウント -> AssumeRoleで取得した認証情報（Credentials）
+        self.credentials = {}
+        # (アカウント, リージョン) -> (クライアント, 作成に使った認証情報)
+        self.clients = {}
+        # AssumeRoleできなかったアカウント -> エラーメッセージ
+        self.errors = {}
+
+    # 読み取り専用ロールのARNを返す
+    def role_arn(self, account):
+        return f"arn:aws:iam::{account}:role/{self.role_name}"
+
+    # アカウントの認証情報を返す（未取得、または期限が refresh_seconds 以内に切れる場合はAssumeRoleする）
+    def get_credentials(self, account):
+        with self.lock:
+            account_lock = self.account_locks.setdefault(account, threading.Lock())
+        with account_lock:
+            if account in self.errors:
+                raise AccountAccessError(self.errors[account])
+            credentials = self.credentials.get(account)
+            if credentials is None or self._expires_soon(credentials):
+                credentials = self._assume_role(account, refresh=credentials is not None)
+                self.credentials[account] = credentials
+            return credentials
+
+    def _expires_soon(self, credentials):
+        remaining = credentials["Expiration"] - datetime.datetime.now(datetime.timezone.utc)
+        return remaining.total_seconds() < self.refresh_seconds
+
+    def _assume_role(self, account, refresh=False):
+        params = {
+            "RoleArn": self.role_arn(account),
+            "RoleSessionName": ROLE_SESSION_NAME,
+            "DurationSeconds": self.duration_seconds,
+        }
+        if self.external_id:
+            params["ExternalId"] = self.external_id
+        try:
+            credentials = self._sts().assume_role(**params)["Credentials"]
+        except Exception as e:
+            # スロットリングは fetch_page で再試行し、それ以外（権限がないなど）はこのアカウントを以降も使わない
+            if is_throttling_error(e):
+                raise
+            self.errors[account] = f"{self.role_arn(account)} を引き受けられません: {e}"
+            raise AccountAccessError(self.errors[account]) from e
+        metrics.increment("assume_role_total", account=account)
+        if refresh:
+            print(f"アカウント {account} の認証情報を更新しました（期限: {credentials['Expiration']}）")
+        return credentials
+
+    def _sts(self):
+        with self.lock:
+            if self.sts_client is None:
+                import boto3
+
+                self.sts_client = boto3.client("sts")
+            return self.sts_client
+
+    # (アカウント, リージョン) のクライアントを返す（認証情報が更新されていれば作り直す）
+    def client(self, account, region=None):
+        credentials = self.get_credentials(account)
+        key = (account, region)
+        with self.lock:
+            entry = self.clients.get(key)
+        if entry is not None and entry[1] is credentials:
+            return entry[0]
+        client = self.client_factory(account, region, credentials)
+        with self.lock:
+            self.clients[key] = (client, credentials)
+        return client
+
+
+# --accounts オプションが指定されていれば、アカウントのプールを作成して取得に使う関数（未指定の場合は None）
+# --source fake の場合は、STSとアカウントごとのCloudTrailの代わりに擬似データを使う（ローカルでの動作確認用）
+# （fake:denied_accounts=アカウントID[+...] を指定すると、擬似的なSTSはそのアカウントへのAssumeRoleを拒否する）
+def configure_account_pool(options):
+    if "--accounts" not in options:
+        return None
+    try:
+        accounts = load_accounts(options["--accounts"])
+    except (OSError, ValueError) as e:
+        print(f"エラー: {e}")
+        sys.exit(1)
+    if not accounts:
+        print("エラー: --accounts にアカウントIDを指定してください")
+        sys.exit(1)
+
+    params = {
+        "role_name": options.get("--role-name", DEFAULT_ROLE_NAME),
+        "external_id": options.get("--external-id"),
+        "duration_seconds": int(options.get("--role-duration", DEFAULT_ROLE_DURATION_SECONDS)),
+    }
+    source = options.get("--source")
+    if source is None:
+        pool = AccountPool(accounts, **params)
+    elif source.partition(":")[0] == "fake":
+        from cloudtrail_sources import FakeStsClient, create_event_source
+
+        # 擬似的なSTSの設定を取り除いた残りを擬似データの設定にする
+        settings = [item for item in source.partition(":")[2].split(",") if item]
+        denied_accounts = [account for item in settings if item.startswith("denied_accounts=") for account in item.partition("=")[2].split("+")]
+        source = "fake:" + ",".join(item for item in settings if not item.startswith("denied_accounts="))
+
+        # アカウントごとに別の擬似データ（API制限もアカウントごと）
+        sources = {}
+        sources_lock = threading.Lock()
+
+        def client_factory(account, region, credentials):
+            with sources_lock:
+                if account not in sources:
+                    sources[account] = create_event_source(source)
+            return sources[account].as_client(region)
+
+        pool = AccountPool(accounts, sts_client=FakeStsClient(denied_accounts), client_factory=client_factory, **params)
+        print(f"STS・CloudTrailの代わりに擬似データを使用します: {options['--source']}")
+    else:
+        print("エラー: --accounts と組み合わせられる --source は fake のみです")
+        sys.exit(1)
+
+    set_account_pool(pool)
+    print(f"検索対象アカウント: {', '.join(accounts)}（ロール: {params['role_name']}）")
+    return pool
@@ -0,0 +1,416 @@
+import csv
+import datetime
+import json
+import sys
+from array import array
+
+from cloudtrail_extract import extract_event_source_and_name, normalize_service_name, to_epoch
+
+
+# 集計結果の詳細（回数・初回・最終）を出力するキー
+DETAILS_KEY = "CloudTrailイベントの詳細"
+
+# タイムライン（日別の回数）の列名
+TIMELINE_COLUMNS = ("principal", "date", "service", "event_source", "event_name", "count")
+
+# 1970-01-01 の序数（日付をUNIX時間の日数に変換するため）
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+# 日別の回数を集計するかどうか（--timeline 指定時のみ有効にする）
+_daily_counts_enabled = False
+
+
+# 日別の回数の集計を有効・無効にする関数
+# 全てのストアに適用されるため、ワーカーのプロセスでは initializer で呼び出す
+def set_daily_counts(enabled=True):
+    global _daily_counts_enabled
+    _daily_counts_enabled = enabled
+
+
+# イベントの日時をUTCの日（1970-01-01からの日数）に変換する関数
+def event_day(event_time):
+    if isinstance(event_time, str) and event_time.endswith("Z"):
+        # S3エクスポートログの "2025-01-01T00:00:00Z" 形式は日付部分だけを読む
+        return datetime.date.fromisoformat(event_time[:10]).toordinal() - _EPOCH_ORDINAL
+    if isinstance(event_time, datetime.datetime) and event_time.tzinfo is None:
+        return event_time.toordinal() - _EPOCH_ORDINAL
+    return int(to_epoch(event_time) // 86400)
+
+
+# UNIX時間（秒）をUTCのISO 8601形式の文字列に変換する関数
+def format_epoch(value):
+    return datetime.datetime.fromtimestamp(value, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+# (eventSource, eventName) ごとの出現回数と初回・最終の日時を集計するストア
+# 名前は初めて出現したときに1度だけ整数IDに割り当て（intern）、回数は配列で保持する
+# イベントごとに文字列やタプルを作らないため、イベント数が多くても割り当てがほとんど発生しない
+# 日時は受け取った形（datetime・文字列など）のまま比較し、UNIX時間への変換は出力時にだけ行う
+# （boto3のtzlocal付きdatetimeの変換はイベントごとに行うには重いため）
+# set_daily_counts() で有効にした場合は、日ごとに「IDを添字とする回数の配列」も持つ
+class EventNameStore:
+    def __init__(self):
+        # eventSource -> {eventName: ID}（タプルのキーを作らないよう2段の辞書にする）
+        self.index = {}
+        self.event_sources = []
+        self.services = []
+        self.event_names = []
+        self.counts = array("Q")
+        self.first_seen = []
+        self.last_seen = []
+        # UTCの日 -> array("I")（IDごとのその日の回数、必要になった分だけ伸ばす）
+        self.daily = {}
+        # 直前のイベントが属したUTCの日の範囲 (開始, 終了, 日)（イベントの日時と同じタイムゾーン）
+        self._day_range = None
+
+    def __len__(self):
+        return len(self.event_names)
+
+    # 新しい (eventSource, eventName) にIDを割り当てる
+    def _intern(self, event_source, event_name):
+        action_id = len(self.event_names)
+        self.index.setdefault(sys.intern(event_source), {})[sys.intern(event_name)] = action_id
+        self.event_sources.append(event_source)
+        self.services.append(normalize_service_name(event_source))
+        self.event_names.append(event_name)
+        self.counts.append(0)
+        self.first_seen.append(None)
+        self.last_seen.append(None)
+        return action_id
+
+    # 1件分を記録する（event_time: datetime、ISO 8601形式の文字列、UNIX時間のいずれか）
+    def add(self, event_source, event_name, event_time=None, count=1):
+        names = self.index.get(event_source)
+        action_id = names.get(event_name) if names is not None else None
+        if action_id is None:
+            action_id = self._intern(event_source, event_name)
+
+        self.counts[action_id] += count
+        if event_time is None:
+            return
+        if _daily_counts_enabled:
+            self._add_daily(action_id, self._event_day(event_time), count)
+        first_seen = self.first_seen[action_id]
+        if first_seen is None:
+            self.first_seen[action_id] = self.last_seen[action_id] = event_time
+            return
+        try:
+            if event_time < first_seen:
+                self.first_seen[action_id] = event_time
+            elif event_time > self.last_seen[action_id]:
+                self.last_seen[action_id] = event_time
+        except TypeError:
+            # 日時の表現が混在する場合（キャッシュとAPIの併用など）はUNIX時間にそろえる
+            self._set_seen(action_id, event_time, event_time)
+
+    # イベントの日時をUTCの日に変換する
+    # ページ内のイベントは時刻順に並ぶため、直前と同じ日の範囲に入るかを同じタイムゾーンのまま比較して判定し、
+    # 範囲外の場合だけUNIX時間に変換する
+    def _event_day(self, event_time):
+        if type(event_time) is not datetime.datetime:
+            return event_day(event_time)
+        day_range = self._day_range
+        if day_range is not None and day_range[0].tzinfo is event_time.tzinfo and day_range[0] <= event_time < day_range[1]:
+            return day_range[2]
+        day = event_day(event_time)
+        if event_time.tzinfo is None:
+            low = datetime.datetime(1970, 1, 1) + datetime.timedelta(days=day)
+            high = low + datetime.timedelta(days=1)
+        else:
+            low = datetime.datetime.fromtimestamp(day * 86400, event_time.tzinfo)
+            high = datetime.datetime.fromtimestamp((day + 1) * 86400, event_time.tzinfo)
+        self._day_range = (low, high, day)
+        return day
+
+    # 日別の回数に加算する
+    def _add_daily(self, action_id, day, count):
+        column = self.daily.get(day)
+        if column is None:
+            column = self.daily[day] = array("I")
+        if action_id >= len(column):
+            column.extend([0] * (len(self.event_names) - len(column)))
+        column[action_id] += count
+
+    # 初回・最終の日時をUNIX時間にそろえて更新する
+    def _set_seen(self, action_id, first_seen, last_seen):
+        if first_seen is None:
+            return
+        first_seen = to_epoch(first_seen)
+        last_seen = to_epoch(last_seen)
+        if self.first_seen[action_id] is not None:
+            first_seen = min(first_seen, to_epoch(self.first_seen[action_id]))
+            last_seen = max(last_seen, to_epoch(self.last_seen[action_id]))
+        self.first_seen[action_id] = first_seen
+        self.last_seen[action_id] = last_seen
+
+    # LookupEvents形式のイベント（CloudTrailEventとEventTimeを持つ辞書）を記録する
+    def add_event(self, event):
+        extracted = extract_event_source_and_name(event["CloudTrailEvent"])
+        if extracted:
+            self.add(extracted[0], extracted[1], event.get("EventTime"))
+
+    # 別のストア（他のワーカーの集計結果）を取り込む
+    # 種類数（数百程度）に比例する処理のため、イベント数によらず軽い
+    def merge(self, other):
+        id_map = [0] * len(other)
+        for event_source, names in other.index.items():
+            for event_name, other_id in names.items():
+                names_here = self.index.get(event_source)
+                action_id = names_here.get(event_name) if names_here is not None else None
+                if action_id is None:
+                    action_id = self._intern(event_source, event_name)
+                id_map[other_id] = action_id
+                self.counts[action_id] += other.counts[other_id]
+                self._set_seen(action_id, other.first_seen[other_id], other.last_seen[other_id])
+        for day, column in other.daily.items():
+            for other_id, count in enumerate(column):
+                if count:
+                    self._add_daily(id_map[other_id], day, count)
+        return self
+
+    # サービスごとのイベント名の集合を返す（従来の defaultdict(set) と同じ形）
+    def service_event_names(self):
+        result = {}
+        for service, event_name in zip(self.services, self.event_names):
+            result.setdefault(service, set()).add(event_name)
+        return result
+
+    # 出力用の「サービスごとのCloudTrailイベント」を作成する（最後に1度だけ文字列を組み立てる）
+    def render(self):
+        return {
+            service: sorted(f"{service}:{event_name}" for event_name in event_names)
+            for service, event_names in self.service_event_names().items()
+        }
+
+    # 出力用の「イベントごとの回数・初回・最終の日時」を作成する
+    def render_details(self):
+        details = {}
+        for action_id in sorted(range(len(self)), key=lambda i: (self.services[i], self.event_names[i])):
+            key = f"{self.services[action_id]}:{self.event_names[action_id]}"
+            detail = details.setdefault(key, {"回数": 0, "初回": None, "最終": None})
+            detail["回数"] += self.counts[action_id]
+            if self.first_seen[action_id] is not None:
+                first = format_epoch(to_epoch(self.first_seen[action_id]))
+                last = format_epoch(to_epoch(self.last_seen[action_id]))
+                detail["初回"] = min(filter(None, (detail["初回"], first)))
+                detail["最終"] = max(filter(None, (detail["最終"], last)))
+        return details
+
+    # タイムライン（イベント名ごとの日別の回数）の行を日付順に返す
+    # (日付, サービス名, eventSource, eventName, 回数) の形で、回数が0の日は含めない
+    def timeline_rows(self):
+        order = sorted(range(len(self)), key=lambda i: (self.services[i], self.event_names[i]))
+        for day in sorted(self.daily):
+            column = self.daily[day]
+            date = datetime.date.fromordinal(day + _EPOCH_ORDINAL)
+            for action_id in order:
+                if action_id < len(column) and column[action_id]:
+                    yield (date, self.services[action_id], self.event_sources[action_id],
+                           self.event_names[action_id], column[action_id])
+
+    # JSONで保存できる形に変換する（Lambda・ジャーナルのチェックポイント用）
+    # 日別の回数がある場合は6番目の要素に [日, 回数] のリストを加える
+    def to_state(self):
+        state = []
+        for event_source, names in self.index.items():
+            for event_name, action_id in names.items():
+                first_seen = self.first_seen[action_id]
+                last_seen = self.last_seen[action_id]
+                item = [
+                    event_source,
+                    event_name,
+                    self.counts[action_id],
+                    None if first_seen is None else to_epoch(first_seen),
+                    None if last_seen is None else to_epoch(last_seen),
+                ]
+                if self.daily:
+                    item.append([[day, column[action_id]] for day, column in self.daily.items()
+                                 if action_id < len(column) and column[action_id]])
+                state.append(item)
+        return state
+
+    @classmethod
+    def from_state(cls, state):
+        store = cls()
+        for event_source, event_name, count, first_seen, last_seen, *daily in state:
+            action_id = store._intern(event_source, event_name)
+            store.counts[action_id] = count
+            store.first_seen[action_id] = first_seen
+            store.last_seen[action_id] = last_seen
+            for day, day_count in (daily[0] if daily else ()):
+                store._add_daily(action_id, day, day_count)
+        return store
+
+    # 分析結果の「CloudTrailイベントの詳細」からストアを作成する（前回の結果との差分用）
+    # 結果にはeventSourceが残っていないため、サービス名をそのままeventSourceとして登録する
+    # （normalize_service_name はサービス名を変えないため、同じイベント名として出力される）
+    @classmethod
+    def from_details(cls, details):
+        store = cls()
+        for key, detail in details.items():
+            service, _, event_name = key.partition(":")
+            action_id = store._intern(service, event_name)
+            store.counts[action_id] = detail["回数"]
+            if detail.get("初回") and detail.get("最終"):
+                store.first_seen[action_id] = to_epoch(detail["初回"])
+                store.last_seen[action_id] = to_epoch(detail["最終"])
+        return store
+
+
+# 各スクリプト共通の形式の分析結果を作成する関数
+# extra は説明の次に入れる項目（分析期間、検索対象リージョンなど）
+def render_result(description, total_events, event_store, extra=None):
+    return {
+        "アクセス分析結果": description,
+        **(extra or {}),
+        "取得イベント数": total_events,
+        "サービスごとのCloudTrailイベント": event_store.render(),
+        DETAILS_KEY: event_store.render_details()
+    }
+
+
+# 分析結果をJSONファイルに保存して概要を表示する関数
+def save_result_file(output_file, response):
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(response, f, ensure_ascii=False, indent=2)
+
+    print(f"分析完了: 結果を {output_file} に保存しました")
+
+    # サービス数と総イベント数を表示
+    result = response["サービスごとのCloudTrailイベント"]
+    print(f"検出されたサービス数: {len(result)}")
+    print(f"合計イベント数: {response['取得イベント数']}")
+
+    # サービスごとのイベント名数を表示
+    for service, event_names in sorted(result.items()):
+        print(f"サービス {service}: {len(event_names)}イベント")
+
+
+# タイムライン（IAMエンティティ・イベント名ごとの日別の回数）をファイルに書き出す関数
+# 拡張子 .parquet の場合はParquet形式（pyarrowが必要）、それ以外はCSV
+# event_stores: {IAMエンティティ名: EventNameStore}
+def write_timeline(path, event_stores):
+    rows = [
+        (iam_entity,) + row
+        for iam_entity, event_store in sorted(event_stores.items())
+        for row in event_store.timeline_rows()
+    ]
+    if path.endswith(".parquet"):
+        import pyarrow
+        import pyarrow.parquet
+
+        columns = list(zip(*rows)) if rows else [()] * len(TIMELINE_COLUMNS)
+        types = (pyarrow.string(), pyarrow.date32(), pyarrow.string(), pyarrow.string(), pyarrow.string(), pyarrow.uint32())
+        table = pyarrow.table({
+            name: pyarrow.array(values, type=value_type)
+            for name, values, value_type in zip(TIMELINE_COLUMNS, columns, types)
+        })
+        pyarrow.parquet.write_table(table, path)
+    else:
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(TIMELINE_COLUMNS)
+            for iam_entity, date, service, event_source, event_name, count in rows:
+                writer.writerow((iam_entity, date.isoformat(), service, event_source, event_name, count))
+    print(f"タイムライン（{len(rows)}行）を {path} に保存しました")
+
+
+# --timeline オプションが指定されていれば日別の回数の集計を有効にする関数
+# Parquet形式の場合は、取得を始める前にpyarrowが使えるかを確認する
+def configure_timeline(options):
+    path = options.get("--timeline")
+    if path is None:
+        return None
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            print("エラー: Parquet形式のタイムラインの出力には pyarrow が必要です（pip install pyarrow、またはCSV形式を指定）")
+            sys.exit(1)
+    set_daily_counts(True)
+    return path
+
+
+# 従来の defaultdict(set) による集計と比較し、処理速度（イベント/秒）とメモリ使用量を表示する
+# 実行コマンド：python cloudtrail_aggregate.py [イベント数] [種類数]
+def main():
+    import gc
+    import time
+    import tracemalloc
+    from collections import defaultdict
+
+    event_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    kinds = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+
+    # 抽出済みの (eventSource, eventName, eventTime) を用意する（抽出の処理時間は含めない）
+    # 実際のページと同じく、同じ名前でもイベントごとに別の文字列オブジェクトにする
+    # boto3と同じくローカルタイムゾーン付きのdatetimeにする
+    base_time = datetime.datetime(2025, 1, 1).astimezone()
+    samples = [
+        (f"service{i % 40}.amazonaws.com", f"Action{i % kinds}", base_time + datetime.timedelta(seconds=i))
+        for i in range(min(event_count, 100000))
+    ]
+
+    def aggregate_with_sets():
+        service_event_names = defaultdict(set)
+        for i in range(event_count):
+            event_source, event_name, _ = samples[i % len(samples)]
+            service_event_names[normalize_service_name(event_source)].add(event_name)
+        result = {}
+        for service, event_names in service_event_names.items():
+            event_list = [f"{service}:{event_name}" for event_name in event_names]
+            result[service] = sorted(event_list)
+        return result
+
+    def aggregate_with_store():
+        store = EventNameStore()
+        for i in range(event_count):
+            event_source, event_name, event_time = samples[i % len(samples)]
+            store.add(event_source, event_name, event_time)
+        return store.render()
+
+    def aggregate_with_store_presence():
+        store = EventNameStore()
+        for i in range(event_count):
+            event_source, event_name, _ = samples[i % len(samples)]
+            store.add(event_source, event_name)
+        return store.render()
+
+    def aggregate_with_store_daily():
+        set_daily_counts(True)
+        try:
+            return aggregate_with_store()
+        finally:
+            set_daily_counts(False)
+
+    expected = aggregate_with_sets()
+    for label, aggregate in (("defaultdict(set)", aggregate_with_sets),
+                             ("EventNameStore（回数・日時あり）", aggregate_with_store),
+                             ("EventNameStore（回数・日時・日別の回数あり）", aggregate_with_store_daily),
+                             ("EventNameStore（回数のみ）", aggregate_with_store_presence)):
+        gc.collect()
+        started = time.perf_counter()
+        result = aggregate()
+        elapsed = time.perf_counter() - started
+
+        tracemalloc.start()
+        aggregate()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        status = "一致" if result == expected else "不一致"
+        print(f"{label}: {event_count / elapsed:,.0f} イベント/秒, ピークメモリ {peak / 1024:,.0f} KiB（結果{status}）")
+
+    # ワーカー間のマージ
+    stores = [EventNameStore() for _ in range(8)]
+    for i, (event_source, event_name, event_time) in enumerate(samples):
+        stores[i % len(stores)].add(event_source, event_name, event_time)
+    started = time.perf_counter()
+    merged = EventNameStore()
+    for store in stores:
+        merged.merge(store)
+    print(f"マージ: {len(stores)}ワーカー x {len(merged)}種類 {(time.perf_counter() - started) * 1000:.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,135 +1,321 @@
 import json
-import subprocess
 import datetime
-from collections import defaultdict
+import os
+import time
 import sys
 
+from cloudtrail_aggregate import EventNameStore, configure_timeline, render_result, save_result_file, write_timeline
+from cloudtrail_cache import LATE_ARRIVAL_MARGIN_SECONDS, open_cache_from_options
+from cloudtrail_chunks import fetch_chunk_events
+from cloudtrail_cli import (
+    CACHE_OPTIONS,
+    CACHE_USAGE,
+    EXPORT_OPTIONS,
+    EXPORT_USAGE,
+    JOURNAL_FLAGS,
+    JOURNAL_OPTIONS,
+    JOURNAL_USAGE,
+    METRICS_OPTIONS,
+    METRICS_USAGE,
+    TIMELINE_OPTIONS,
+    TIMELINE_USAGE,
+    load_principals,
+    parse_cli_args,
+)
+from cloudtrail_diff import DEFAULT_STALE_DAYS, PERIOD_KEY, build_delta, load_previous_result
+from cloudtrail_export import open_exporter_from_options
+from cloudtrail_fetcher import fetch_page, iter_event_pages
+from cloudtrail_journal import open_journal_from_options
+from cloudtrail_metrics import run_with_metrics
+from cloudtrail_planner import CHUNK_GAP, build_time_chunks, plan_time_chunks
+from cloudtrail_policy import load_result_event_names
+from cloudtrail_presence import DEFAULT_SAMPLE_PAGES, DEFAULT_VERIFY_PAGES, find_distinct_actions, render_presence_result
+from cloudtrail_scheduler import DEFAULT_CONCURRENCY, run_work_units
+from cloudtrail_sources import configure_event_source
 
-# 個別のCloudTrailイベントを処理する関数
-def process_cloudtrail_event(event, service_event_names):
-    event_details = json.loads(event['CloudTrailEvent'])
-    if "eventName" in event_details and "eventSource" in event_details:
-        service = event_details["eventSource"].split(".")[0].replace("amazonaws.com", "").replace("-", "")
-        event_name = event_details["eventName"]
-        # サービスごとにイベント名を分類
-        service_event_names[service].add(event_name)
 
-
-# AWS CLIコマンドを実行して結果を取得する関数
-def execute_aws_command(cmd):
-    try:
-        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        stdout, stderr = process.communicate()
+# 1チャンク分の全イベントを1回だけ取得し、Usernameで複数のIAMエンティティに振り分けて集計する関数
+# 対象ごとにLookupEventsを呼び出す必要がないため、対象が多いほどAPI呼び出しが少なくなる
+def fetch_chunk_events_shared(principals, chunk_index, chunk_count, chunk_start, chunk_end, use_cli=False, journal=None, exporter=None):
+    chunk_start_str = chunk_start.strftime("%Y-%m-%dT%H:%M:%S")
+    chunk_end_str = chunk_end.strftime("%Y-%m-%dT%H:%M:%S")
+    unit_key = f"*/{chunk_start_str}/{chunk_end_str}"
+    progress = journal.progress(unit_key) if journal is not None else None
+    
+    if progress is not None and progress.done:
+        print(f"チャンク {chunk_index+1}/{chunk_count} は前回の実行で完了済みです: {chunk_start_str} から {chunk_end_str}")
+        return {iam_entity: progress.result(iam_entity) for iam_entity in progress.results}
+    
+    print(f"チャンク {chunk_index+1}/{chunk_count} 処理中（一括取得）: {chunk_start_str} から {chunk_end_str}")
+    
+    principal_set = set(principals)
+    # 前回の実行で途中まで処理していれば、その集計結果から続ける
+    chunk_results = {iam_entity: list(progress.result(iam_entity)) for iam_entity in progress.results} if progress is not None else {}
+    next_token = progress.next_token if progress is not None else None
+    page_count = 0
+    scanned_count = 0
+    
+    pages = iter_event_pages(None, chunk_start, chunk_end, use_cli=use_cli, next_token=next_token)
+    if exporter is not None:
+        pages = exporter.export_pages(pages, None, principal_set)
+    for data in pages:
+        if journal is not None:
+            journal.check_stopped()
+        events = data.get("Events", [])
+        scanned_count += len(events)
+        page_count += 1
         
-        if process.returncode != 0:
-            raise Exception(f"AWS CLIコマンド実行エラー: {stderr}")
+        if page_count % 10 == 0:
+            print(f"  チャンク {chunk_index+1} ページ {page_count} 処理完了: 累計 {scanned_count} イベントを走査")
         
-        return json.loads(stdout)
-    except Exception as e:
-        print(f"エラー発生: {e}")
-        sys.exit(1)
+        # イベントを対象ごとに振り分け
+        page_results = {}
+        for event in events:
+            iam_entity = event.get("Username")
+            if iam_entity not in principal_set:
+                continue
+            if iam_entity not in page_results:
+                page_results[iam_entity] = [0, EventNameStore()]
+            page_results[iam_entity][0] += 1
+            page_results[iam_entity][1].add_event(event)
+        
+        if journal is not None:
+            journal.record_page(unit_key, data.get("NextToken"), page_results)
+        for iam_entity, (events_count, page_event_store) in page_results.items():
+            if iam_entity not in chunk_results:
+                chunk_results[iam_entity] = [0, EventNameStore()]
+            chunk_results[iam_entity][0] += events_count
+            chunk_results[iam_entity][1].merge(page_event_store)
+    
+    return {iam_entity: (events_count, chunk_event_store) for iam_entity, (events_count, chunk_event_store) in chunk_results.items()}
+
+
+# 分析結果をJSONファイルに保存して概要を表示する関数
+# merged=True（--since-result の結合結果）の場合は、結合元の同じ日の結果を上書きしないようファイル名に時刻まで含める
+def save_result(iam_entity, days_back, start_time, end_time, total_events, event_store, merged=False):
+    # --since-result で次回の実行がこの終了時刻以降だけを取得できるように期間を残す
+    period = {"開始": start_time.isoformat(timespec="seconds"), "終了": end_time.isoformat(timespec="seconds")}
+    response = render_result(f"{iam_entity}の過去{days_back}日間のアクティビティ", total_events, event_store, {PERIOD_KEY: period})
+    
+    # 結果を保存
+    current_date = end_time.strftime('%Y%m%d%H%M%S' if merged else '%Y%m%d')
+    save_result_file(f"cloudtrail_events_{iam_entity}_{current_date}_past{days_back}days.json", response)
+
+
+# 前回の結果との差分をJSONファイルに保存して概要を表示する関数
+def save_delta(iam_entity, previous_path, start_time, end_time, total_events, delta, stale_days):
+    response = {
+        "差分分析結果": f"{iam_entity}の{start_time.isoformat(timespec='seconds')}以降のアクティビティ（前回の結果: {previous_path}）",
+        PERIOD_KEY: {"開始": start_time.isoformat(timespec="seconds"), "終了": end_time.isoformat(timespec="seconds")},
+        "取得イベント数": total_events,
+        **delta
+    }
+    
+    output_file = f"cloudtrail_events_{iam_entity}_{end_time.strftime('%Y%m%d%H%M%S')}_delta.json"
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(response, f, ensure_ascii=False, indent=2)
+    
+    print(f"差分を {output_file} に保存しました")
+    print(f"新しいサービス: {', '.join(delta['新しいサービス']) or 'なし'}")
+    print(f"新しいイベント: {len(delta['新しいCloudTrailイベント'])}件")
+    for name, detail in delta["新しいCloudTrailイベント"].items():
+        print(f"  {name}（{detail['回数']}回, 初回 {detail['初回']}）")
+    stale = delta[f"{stale_days}日間使用されていないCloudTrailイベント"]
+    print(f"{stale_days}日間使用されていないイベント: {len(stale)}件")
+    for name, detail in stale.items():
+        print(f"  {name}（最終 {detail['最終']}）")
 
 
-# 実行コマンド：python cloudtrail_analyzer.py IAMユーザー名 [日数]
+# 使用の有無だけを調べて結果を保存する関数（--distinct-actions）
+# 全イベントを取得せず、サンプルと EventSource / EventName の検索条件で確認する（期間はチャンクに分割しない）
+def analyze_distinct_actions(iam_entity, days_back, start_time, end_time, candidates, sample_pages, verify_pages, use_cli=False):
+    def lookup(lookup_attribute, next_token):
+        return fetch_page(None, start_time, end_time, next_token=next_token, use_cli=use_cli, lookup_attribute=lookup_attribute)
+    
+    event_store, unconfirmed, api_calls, complete = find_distinct_actions(lookup, iam_entity, candidates, sample_pages, verify_pages)
+    response = render_presence_result(f"{iam_entity}の過去{days_back}日間に使用したイベント", event_store, unconfirmed, api_calls, complete)
+    
+    output_file = f"cloudtrail_events_{iam_entity}_{end_time.strftime('%Y%m%d')}_past{days_back}days_distinct.json"
+    with open(output_file, 'w', encoding='utf-8') as f:
+        json.dump(response, f, ensure_ascii=False, indent=2)
+    
+    print(f"分析完了: 結果を {output_file} に保存しました（API呼び出し {api_calls}回、{response['確認方法']}）")
+    print(f"検出されたイベント名: {len(event_store.render_details())}件（{response['結果の範囲']}）")
+    if unconfirmed:
+        print(f"確認できなかった候補: {', '.join(unconfirmed)}")
+
+
+# 実行コマンド：python cloudtrail_analyzer.py IAMユーザー名 [日数] [--concurrency N] [--source api|s3:パス|export:ディレクトリ|fake] [--adaptive-chunks] [--cache DBファイル] [--resume] [--journal ファイル] [--timeline ファイル] [--export ディレクトリ] [--metrics ファイル] [--profile ファイル] [--use-cli]
+#              python cloudtrail_analyzer.py IAMユーザー名 [日数] --distinct-actions [--sample-pages N] [--verify-pages N] [--candidates 分析結果ファイル] [--source ...] [--use-cli]
+#              python cloudtrail_analyzer.py IAMユーザー名 --since-result 前回の結果.json [--stale-days N] [その他のオプション]
+#              python cloudtrail_analyzer.py --principals-file ファイル [日数] [--shared-scan] [--concurrency N] [--source api|s3:パス|export:ディレクトリ|fake] [--adaptive-chunks] [--resume] [--journal ファイル] [--timeline ファイル] [--export ディレクトリ] [--metrics ファイル] [--profile ファイル] [--use-cli]
 def main():
-    iam_entity = sys.argv[1]
-    days_back = int(sys.argv[2]) if len(sys.argv) > 2 else 90
+    args, options = parse_cli_args(
+        sys.argv[1:],
+        value_options=("--concurrency", "--source", "--principals-file", "--since-result", "--stale-days", "--sample-pages", "--verify-pages", "--candidates") + CACHE_OPTIONS + JOURNAL_OPTIONS + TIMELINE_OPTIONS + EXPORT_OPTIONS + METRICS_OPTIONS,
+        flag_options=("--use-cli", "--shared-scan", "--adaptive-chunks", "--distinct-actions") + JOURNAL_FLAGS,
+    )
+    if not args and "--principals-file" not in options:
+        print(f"使用方法: python cloudtrail_analyzer.py IAMユーザー名 [日数] [--concurrency N] [--source api|s3:パス|export:ディレクトリ|fake] [--adaptive-chunks] {CACHE_USAGE} {JOURNAL_USAGE} {TIMELINE_USAGE} {EXPORT_USAGE} {METRICS_USAGE} [--use-cli]")
+        print("          python cloudtrail_analyzer.py IAMユーザー名 [日数] --distinct-actions [--sample-pages N] [--verify-pages N] [--candidates 分析結果ファイル] [--source ...] [--use-cli]")
+        print("          python cloudtrail_analyzer.py IAMユーザー名 --since-result 前回の結果.json [--stale-days N] [その他のオプション]")
+        print(f"          python cloudtrail_analyzer.py --principals-file ファイル [日数] [--shared-scan] [--concurrency N] [--source api|s3:パス|export:ディレクトリ|fake] [--adaptive-chunks] {JOURNAL_USAGE} {TIMELINE_USAGE} {EXPORT_USAGE} {METRICS_USAGE} [--use-cli]")
+        sys.exit(1)
+
+    # --principals-file 指定時は複数のIAMユーザー/ロールをまとめて分析
+    if "--principals-file" in options:
+        principals = load_principals(options["--principals-file"])
+        days_back = int(args[0]) if args else 90
+    else:
+        principals = [args[0]]
+        days_back = int(args[1]) if len(args) > 1 else 90
+    # --since-result 指定時は前回の結果の終了時刻以降だけを取得し、前回の結果に結合する
+    since_result = options.get("--since-result")
+    stale_days = int(options.get("--stale-days", DEFAULT_STALE_DAYS))
+    if since_result is not None:
+        if "--principals-file" in options:
+            print("エラー: --since-result は1つのIAMエンティティの分析でのみ指定できます")
+            sys.exit(1)
+        try:
+            previous_store, previous_start, previous_end, previous_events = load_previous_result(since_result)
+        except (OSError, ValueError) as e:
+            print(f"エラー: {e}")
+            sys.exit(1)
+    # --shared-scan 指定時は対象ごとではなく全イベントを1回だけ取得して振り分ける
+    shared_scan = options.get("--shared-scan", False)
+    # --use-cli 指定時のみ従来のAWS CLIサブプロセスで取得
+    use_cli = options.get("--use-cli", False)
+    # 同時に処理するチャンク数
+    concurrency = int(options.get("--concurrency", DEFAULT_CONCURRENCY))
+    # --adaptive-chunks 指定時はイベントの密度を調べてチャンクを分割・結合する
+    adaptive_chunks = options.get("--adaptive-chunks", False)
+    # --source 指定時はLookupEvents API以外（S3エクスポートファイル・擬似データ）から取得
+    configure_event_source(options)
     
-    print(f"分析開始: {iam_entity}の過去{days_back}日間のアクティビティ")
+    # --distinct-actions 指定時は回数・日時を集計せず、使用したイベント名だけを少ないAPI呼び出しで調べる
+    if options.get("--distinct-actions", False):
+        try:
+            candidates = load_result_event_names(options["--candidates"]) if "--candidates" in options else ()
+        except (OSError, ValueError) as e:
+            print(f"エラー: {e}")
+            sys.exit(1)
+        end_time = datetime.datetime.now()
+        start_time = end_time - datetime.timedelta(days=days_back)
+        for iam_entity in principals:
+            print(f"分析開始: {iam_entity}の過去{days_back}日間に使用したイベント（使用の有無のみ）")
+            analyze_distinct_actions(
+                iam_entity, days_back, start_time, end_time, candidates,
+                int(options.get("--sample-pages", DEFAULT_SAMPLE_PAGES)), int(options.get("--verify-pages", DEFAULT_VERIFY_PAGES)), use_cli,
+            )
+        return
+    # --timeline 指定時はイベント名ごとの日別の回数も集計し、CSV/Parquetで出力する
+    timeline_path = configure_timeline(options)
+    # --export 指定時は取得したイベントを絞り込んだ列だけにして、列指向のファイルに書き出す
+    exporter = open_exporter_from_options(options)
+    # --cache 指定時は取得済みの期間をローカルキャッシュから読み出す（一括取得時は使用しない）
+    cache = None if shared_scan else open_cache_from_options(options)
+    
+    if since_result is not None:
+        print(f"分析開始: {principals[0]}の{previous_end.isoformat(timespec='seconds')}以降のアクティビティ（前回の結果: {since_result}）")
+    else:
+        print(f"分析開始: {', '.join(principals)}の過去{days_back}日間のアクティビティ")
+    started = time.perf_counter()
     
     # 期間の設定
-    end_time = datetime.datetime.now()
-    start_time = end_time - datetime.timedelta(days=days_back)
+    # 直近 LATE_ARRIVAL_MARGIN_SECONDS 秒は遅れて配信されるイベントがあるため含めない（次回の --since-result で取得する）
+    end_time = (datetime.datetime.now() - datetime.timedelta(seconds=LATE_ARRIVAL_MARGIN_SECONDS)).replace(microsecond=0)
+    if since_result is not None and previous_end + CHUNK_GAP > end_time:
+        print(f"前回の結果の終了日時以降に取得できる期間がありません（直近{LATE_ARRIVAL_MARGIN_SECONDS // 60}分は遅延配信を考慮して取得しません）")
+        return
+    
+    # 進捗のジャーナル（--resume 指定時は前回の実行と同じ期間で、完了済みの作業単位を飛ばして再開する）
+    label = principals[0] if "--principals-file" not in options else os.path.splitext(os.path.basename(options["--principals-file"]))[0]
+    journal = open_journal_from_options(
+        options,
+        f"cloudtrail_events_{label}_since.journal" if since_result is not None else f"cloudtrail_events_{label}_past{days_back}days.journal",
+        {"principals": principals, "days_back": None if since_result is not None else days_back, "since_result": since_result,
+         "shared_scan": shared_scan, "adaptive_chunks": adaptive_chunks},
+        {"end_time": end_time.isoformat()},
+    )
+    end_time = datetime.datetime.fromisoformat(journal.run_info["end_time"])
+    if since_result is not None:
+        # 前回の結果は終了時刻の秒のイベントまで含むため、その次の秒から取得する
+        start_time = previous_end + CHUNK_GAP
+        # 結合後の結果は前回の開始時刻からの期間として保存する
+        days_back = (end_time - previous_start).days
+    else:
+        start_time = end_time - datetime.timedelta(days=days_back)
     
-    # サービスごとのイベント名収集用
-    service_event_names = defaultdict(set)
-    total_events = 0
+    # IAMエンティティごとのイベント名収集用
+    event_stores = {iam_entity: EventNameStore() for iam_entity in principals}
+    total_events = dict.fromkeys(principals, 0)
     
     # 時間範囲を分割して処理（例：10日ごと）
-    time_chunks = []
-    chunk_days = 10
-    chunk_start = start_time
+    time_chunks = build_time_chunks(start_time, end_time, 10)
     
-    while chunk_start < end_time:
-        chunk_end = min(chunk_start + datetime.timedelta(days=chunk_days), end_time)
-        time_chunks.append((chunk_start, chunk_end))
-        chunk_start = chunk_end
+    print(f"期間を{len(time_chunks)}チャンクに分割し、最大{concurrency}並列で処理します")
     
-    print(f"期間を{len(time_chunks)}チャンクに分割して処理します")
+    # IAMエンティティごとのチャンクを計画してジャーナルに記録する（再開時は記録した計画を使う）
+    plans = journal.chunk_plans()
+    if plans is None:
+        plans = [
+            (iam_entity, plan_time_chunks(iam_entity, time_chunks, use_cli=use_cli, concurrency=concurrency) if adaptive_chunks else time_chunks)
+            for iam_entity in ([None] if shared_scan else principals)
+        ]
+        journal.record_chunk_plans(plans)
     
-    for i, (chunk_start, chunk_end) in enumerate(time_chunks):
-        chunk_start_str = chunk_start.strftime("%Y-%m-%dT%H:%M:%S")
-        chunk_end_str = chunk_end.strftime("%Y-%m-%dT%H:%M:%S")
-        
-        print(f"チャンク {i+1}/{len(time_chunks)} 処理中: {chunk_start_str} から {chunk_end_str}")
-        
-        # ページネーション処理
-        next_token = None
-        page_count = 0
-        events_count = 0
-        
-        while True:
-            # AWS CLIコマンド構築
-            base_cmd = f"aws cloudtrail lookup-events --lookup-attributes AttributeKey=Username,AttributeValue={iam_entity} --start-time {chunk_start_str} --end-time {chunk_end_str}"
-            
-            if next_token:
-                cmd = f"{base_cmd} --next-token {next_token}"
-            else:
-                cmd = base_cmd
-            
-            # コマンド実行とデータ取得
-            data = execute_aws_command(cmd)
-            
-            events = data.get("Events", [])
-            events_count += len(events)
-            page_count += 1
-            
-            if page_count % 10 == 0 or len(events) > 0:
-                print(f"  ページ {page_count} 処理完了: 累計 {events_count} イベント")
-            
-            # イベント処理
-            for event in events:
-                process_cloudtrail_event(event, service_event_names)
-            
-            # 次のトークンを取得
-            next_token = data.get("NextToken")
-            
-            # トークンがなければループ終了
-            if not next_token:
-                break
-                
-        total_events += events_count
-        print(f"チャンク {i+1} 完了: {events_count} イベント処理")
-    
-    # 結果作成
-    result = {}
-    for service, event_names in service_event_names.items():
-        # CloudTrailのイベント名をサービス名とともに表示
-        event_list = [f"{service}:{event_name}" for event_name in event_names]
-        result[service] = sorted(event_list)
+    # (チャンク, IAMエンティティ) ごとの作業単位を同時に処理（APIレートはリージョンごとのトークンバケットで制御）
+    units = []
+    for iam_entity, chunks in plans:
+        units.extend((i, chunk_start, chunk_end, iam_entity, len(chunks)) for i, (chunk_start, chunk_end) in enumerate(chunks))
     
-    response = {
-        "アクセス分析結果": f"{iam_entity}の過去{days_back}日間のアクティビティ",
-        "取得イベント数": total_events,
-        "サービスごとのCloudTrailイベント": result
-    }
+    if shared_scan:
+        worker = lambda unit: fetch_chunk_events_shared(principals, unit[0], unit[4], unit[1], unit[2], use_cli, journal, exporter)
+    else:
+        worker = lambda unit: {unit[3]: fetch_chunk_events(unit[3], unit[0], unit[4], unit[1], unit[2], use_cli, cache, journal, exporter)}
     
-    # 結果を保存
-    current_date = end_time.strftime('%Y%m%d')
-    output_file = f"cloudtrail_events_{iam_entity}_{current_date}_past{days_back}days.json"
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(response, f, ensure_ascii=False, indent=2)
+    try:
+        for (i, _, _, _, _), unit_results in run_work_units(units, worker, concurrency):
+            for iam_entity, (events_count, chunk_event_store) in unit_results.items():
+                event_stores[iam_entity].merge(chunk_event_store)
+                total_events[iam_entity] += events_count
+                print(f"チャンク {i+1} 完了: {iam_entity} {events_count} イベント処理")
+    except (Exception, KeyboardInterrupt) as e:
+        # 実行中の作業単位を止め、ここまでの進捗をジャーナルに残す
+        journal.stop()
+        print(f"エラー発生: {e}" if isinstance(e, Exception) else "中断されました")
+        print(f"進捗を {journal.path} に保存しました。--resume を付けて再実行すると続きから処理します")
+        journal.close()
+        if exporter is not None:
+            exporter.close()
+        sys.exit(1)
     
-    print(f"分析完了: 結果を {output_file} に保存しました")
+    # IAMエンティティごとに結果を保存
+    if since_result is not None:
+        # 前回の結果に今回取得した分を結合して保存し、差分を別のファイルに保存する
+        iam_entity = principals[0]
+        merged_store = EventNameStore()
+        merged_store.merge(previous_store)
+        merged_store.merge(event_stores[iam_entity])
+        delta = build_delta(previous_store, event_stores[iam_entity], merged_store, end_time, stale_days)
+        save_result(iam_entity, days_back, previous_start, end_time, previous_events + total_events[iam_entity], merged_store, merged=True)
+        save_delta(iam_entity, since_result, start_time, end_time, total_events[iam_entity], delta, stale_days)
+    else:
+        for iam_entity in principals:
+            save_result(iam_entity, days_back, start_time, end_time, total_events[iam_entity], event_stores[iam_entity])
+    if timeline_path is not None:
+        write_timeline(timeline_path, event_stores)
+    if exporter is not None:
+        exporter.close()
+    journal.finish()
     
-    # サービス数と総イベント数を表示
-    print(f"検出されたサービス数: {len(result)}")
-    print(f"合計イベント数: {total_events}")
+    if cache is not None:
+        cache.print_stats()
+        cache.close()
     
-    # サービスごとのイベント名数を表示
-    for service, event_names in sorted(result.items()):
-        print(f"サービス {service}: {len(event_names)}イベント")
+    if len(principals) > 1:
+        print(f"{len(principals)}件のIAMエンティティの分析が完了しました（{time.perf_counter() - started:.1f}秒）")
 
 
 if __name__ == "__main__":
-    main()
+    run_with_metrics(main)
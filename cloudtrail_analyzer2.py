@@ -1,130 +1,163 @@
-import json
-import subprocess
 import datetime
-import time
-from collections import defaultdict
 import sys
-import random
-import os
-
+import time
 
-# 個別のCloudTrailイベントを処理する関数
-def process_cloudtrail_event(event, service_event_names):
-    event_details = json.loads(event['CloudTrailEvent'])
-    if "eventName" in event_details and "eventSource" in event_details:
-        service = event_details["eventSource"].split(".")[0].replace("amazonaws.com", "").replace("-", "")
-        event_name = event_details["eventName"]
-        # サービスごとにイベント名を分類
-        service_event_names[service].add(event_name)
+from cloudtrail_accounts import MAX_ACCOUNT_CONCURRENCY, AccountAccessError, configure_account_pool
+from cloudtrail_aggregate import EventNameStore, configure_timeline, render_result, save_result_file, write_timeline
+from cloudtrail_cache import iter_cached_event_pages, open_cache_from_options
+from cloudtrail_cli import (
+    ACCOUNTS_OPTIONS,
+    ACCOUNTS_USAGE,
+    CACHE_OPTIONS,
+    CACHE_USAGE,
+    EXPORT_OPTIONS,
+    EXPORT_USAGE,
+    JOURNAL_FLAGS,
+    JOURNAL_OPTIONS,
+    JOURNAL_USAGE,
+    METRICS_OPTIONS,
+    METRICS_USAGE,
+    TIMELINE_OPTIONS,
+    TIMELINE_USAGE,
+    parse_cli_args,
+)
+from cloudtrail_dedup import GLOBAL_EVENT_SOURCES, EventIdFilter
+from cloudtrail_export import open_exporter_from_options
+from cloudtrail_fetcher import iter_event_pages
+from cloudtrail_journal import open_journal_from_options
+from cloudtrail_metrics import metrics, run_with_metrics
+from cloudtrail_planner import build_time_chunks, plan_time_chunks
+from cloudtrail_scheduler import DEFAULT_CONCURRENCY, run_work_units
+from cloudtrail_sources import configure_event_source
 
 
-# AWS CLIコマンドを実行して結果を取得する関数 (エラーハンドリング強化版)
-def execute_aws_command(cmd, max_retries=3, retry_delay=2):
-    retries = 0
-    while retries <= max_retries:
-        try:
-            process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-            stdout, stderr = process.communicate()
-            
-            if process.returncode != 0:
-                if "ThrottlingException" in stderr or "RequestLimitExceeded" in stderr:
-                    retries += 1
-                    wait_time = retry_delay * (2 ** retries) + random.uniform(0, 1)
-                    print(f"スロットリング検出。{wait_time:.2f}秒後に再試行します。({retries}/{max_retries})")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    raise Exception(f"AWS CLIコマンド実行エラー: {stderr}")
-            
-            return json.loads(stdout)
+# CloudTrailイベントをページ単位で返すジェネレータ (マルチリージョン対応)
+# イベントを溜め込まず、1ページ（{"Events": [...], "NextToken": ...}）ずつ呼び出し元に渡す
+# next_token 指定時は前回の実行の続きのページから取得する
+# account 指定時はそのアカウントの読み取り専用ロールで取得する（--accounts）
+# dedup 指定時はEventIdが重複したイベント（他のリージョンにも現れるグローバルサービスのイベントなど）を取り除く
+def get_cloudtrail_events(iam_entity, chunk_start, chunk_end, regions, use_cli=False, cache=None, next_token=None, exporter=None, account=None, dedup=None):
+    for region in regions:
+        region_label = f"{account}/{region}" if account else region
+        print(f"リージョン {region_label} の処理を開始...")
+        
+        # キャッシュ使用時は未取得の期間のみAPIから取得
+        if cache is not None:
+            pages = iter_cached_event_pages(cache, iam_entity, chunk_start, chunk_end, region=region, use_cli=use_cli, account=account)
+        else:
+            pages = iter_event_pages(iam_entity, chunk_start, chunk_end, region=region, use_cli=use_cli, next_token=next_token, account=account)
+        if dedup is not None:
+            pages = dedup.filter_pages(pages, region, account)
+        if exporter is not None:
+            pages = exporter.export_pages(pages, iam_entity)
         
-        except Exception as e:
-            print(f"コマンド実行中にエラーが発生: {e}")
-            retries += 1
-            if retries <= max_retries:
-                time.sleep(retry_delay * retries)
-            else:
-                raise
-    
-    raise Exception(f"最大再試行回数({max_retries})に達しました。")
+        # 取得中のエラーは呼び出し元に伝える（作業単位を完了扱いにせず、ジャーナルに残して再開できるようにする）
+        chunk_label = chunk_start.strftime("%Y-%m-%d")
+        for data in pages:
+            events = data.get("Events", [])
+            print(f"  リージョン {region_label}: {len(events)} イベント取得")
+            metrics.increment("chunk_pages_total", region=region, chunk=chunk_label)
+            metrics.increment("chunk_events_total", len(events), region=region, chunk=chunk_label)
+            yield data
 
 
-# CloudTrailイベントを取得する関数 (マルチリージョン対応)
-def get_cloudtrail_events(iam_entity, chunk_start_str, chunk_end_str, regions, max_items=1000):
-    all_events = []
+# ページを受け取るたびにサービスごとのイベント名へ集計する関数
+# 集計後のページは保持しないため、メモリ使用量はページサイズ分に収まる
+def aggregate_cloudtrail_events(pages, event_store):
+    events_count = 0
+    for data in pages:
+        events = data.get("Events", [])
+        events_count += len(events)
+        parse_started = time.perf_counter()
+        for event in events:
+            # サービスごとにイベント名を分類（回数と初回・最終の日時も記録）
+            event_store.add_event(event)
+        metrics.increment("parse_seconds_total", time.perf_counter() - parse_started)
+    return events_count
+
+
+# 1つの (チャンク, リージョン) を取得・集計する関数
+# ページごとの集計結果と次のトークンをジャーナルに記録し、前回の実行で完了・途中の作業単位は続きから処理する
+# account 指定時は (アカウント, チャンク, リージョン) を1つの作業単位とし、AssumeRoleできないアカウントは0件として飛ばす
+# （それ以外のエラーは呼び出し元に伝え、作業単位は完了として記録しない）
+def fetch_unit_event_names(iam_entity, chunk_start, chunk_end, region, journal, use_cli=False, cache=None, exporter=None, account=None, dedup=None):
+    try:
+        return fetch_journaled_unit(iam_entity, chunk_start, chunk_end, region, journal, use_cli, cache, exporter, account, dedup)
+    except AccountAccessError:
+        # 取得できなかったアカウントは account_pool.errors に記録されている（ジャーナルには記録せず、再開時に再び試す）
+        return 0, EventNameStore()
+
+
+def fetch_journaled_unit(iam_entity, chunk_start, chunk_end, region, journal, use_cli, cache, exporter, account, dedup):
+    unit_key = f"{iam_entity}/{region}/{chunk_start.strftime('%Y-%m-%dT%H:%M:%S')}/{chunk_end.strftime('%Y-%m-%dT%H:%M:%S')}"
+    if account:
+        unit_key = f"{account}/{unit_key}"
+    progress = journal.progress(unit_key)
+    if progress.done:
+        print(f"リージョン {region} の {chunk_start.strftime('%Y-%m-%d')} からのチャンクは前回の実行で完了済みです")
+        return progress.result(iam_entity)
     
-    for region in regions:
-        print(f"リージョン {region} の処理を開始...")
-        starting_token = None
-        
-        while True:
-            # AWS CLIコマンド構築
-            base_cmd = f"aws cloudtrail lookup-events --lookup-attributes AttributeKey=Username,AttributeValue={iam_entity} --start-time {chunk_start_str} --end-time {chunk_end_str} --region {region} --max-items {max_items}"
-            
-            if starting_token:
-                cmd = f"{base_cmd} --starting-token {starting_token}"
-            else:
-                cmd = base_cmd
-            
-            try:
-                # コマンド実行とデータ取得
-                data = execute_aws_command(cmd)
-                
-                # イベントの追加
-                events = data.get("Events", [])
-                all_events.extend(events)
-                
-                print(f"  リージョン {region}: {len(events)} イベント取得")
-                
-                # 次のトークンを取得
-                starting_token = data.get("NextToken")
-                
-                # スロットリング回避、すりーぷ
-                wait_time = 2
-                time.sleep(wait_time)
-                
-                # トークンがなければリージョンの処理終了
-                if not starting_token:
-                    break
-                    
-            except Exception as e:
-                print(f"警告: リージョン {region} での処理中にエラーが発生: {e}")
-                # エラーが発生しても他のリージョンは続行
-                break
-    
-    return all_events
+    # 前回の実行で途中まで処理していれば、その集計結果から続ける
+    events_count, unit_event_store = progress.result(iam_entity)
+    pages = get_cloudtrail_events(iam_entity, chunk_start, chunk_end, [region], use_cli, cache, progress.next_token, exporter, account, dedup)
+    if cache is not None:
+        # キャッシュ使用時はページ単位ではなく作業単位で記録する
+        events_count += aggregate_cloudtrail_events(pages, unit_event_store)
+        journal.record_unit(unit_key, {iam_entity: (events_count, unit_event_store)})
+        return events_count, unit_event_store
+    
+    for data in pages:
+        journal.check_stopped()
+        page_event_store = EventNameStore()
+        page_events_count = aggregate_cloudtrail_events([data], page_event_store)
+        journal.record_page(unit_key, data.get("NextToken"), {iam_entity: (page_events_count, page_event_store)})
+        events_count += page_events_count
+        unit_event_store.merge(page_event_store)
+    return events_count, unit_event_store
 
 
-# 実行コマンド：python cloudtrail_analyzer_daterange.py IAMユーザー名 --start-date YYYY-MM-DD --end-date YYYY-MM-DD [--regions region1,region2,...]
+# 実行コマンド：python cloudtrail_analyzer2.py IAMユーザー名 --start-date YYYY-MM-DD --end-date YYYY-MM-DD [--regions region1,region2,...] [--concurrency N] [--source api|s3:パス|export:ディレクトリ|fake] [--adaptive-chunks] [--accounts アカウントID[,...]|ファイル [--role-name ロール名] [--external-id 外部ID] [--role-duration 秒]] [--cache DBファイル] [--metrics ファイル] [--profile ファイル] [--resume] [--journal ファイル] [--timeline ファイル] [--export ディレクトリ] [--use-cli]
 def main():
     # 引数の確認
     if len(sys.argv) < 6:
-        print("使用方法: python cloudtrail_analyzer_daterange.py IAMユーザー名 --start-date YYYY-MM-DD --end-date YYYY-MM-DD [--regions region1,region2,...]")
+        print(f"使用方法: python cloudtrail_analyzer2.py IAMユーザー名 --start-date YYYY-MM-DD --end-date YYYY-MM-DD [--regions region1,region2,...] [--concurrency N] [--source api|s3:パス|export:ディレクトリ|fake] [--adaptive-chunks] {ACCOUNTS_USAGE} {CACHE_USAGE} {METRICS_USAGE} {JOURNAL_USAGE} {TIMELINE_USAGE} {EXPORT_USAGE} [--use-cli]")
         sys.exit(1)
     
-    iam_entity = sys.argv[1]
-    
     # 引数のパース
-    start_date = None
-    end_date = None
-    regions = ["ap-northeast-1", "us-east-1"]
-    
-    i = 2
-    while i < len(sys.argv):
-        if sys.argv[i] == "--start-date" and i + 1 < len(sys.argv):
-            start_date = sys.argv[i + 1]
-            i += 2
-        elif sys.argv[i] == "--end-date" and i + 1 < len(sys.argv):
-            end_date = sys.argv[i + 1]
-            i += 2
-        elif sys.argv[i] == "--regions" and i + 1 < len(sys.argv):
-            regions = sys.argv[i + 1].split(",")
-            i += 2
-        else:
-            print(f"不明なオプション: {sys.argv[i]}")
-            i += 1
+    args, options = parse_cli_args(
+        sys.argv[1:],
+        value_options=("--start-date", "--end-date", "--regions", "--concurrency", "--source") + ACCOUNTS_OPTIONS + CACHE_OPTIONS + METRICS_OPTIONS + JOURNAL_OPTIONS + TIMELINE_OPTIONS + EXPORT_OPTIONS,
+        flag_options=("--use-cli", "--adaptive-chunks") + JOURNAL_FLAGS,
+    )
+    iam_entity = args[0] if args else None
+    start_date = options.get("--start-date")
+    end_date = options.get("--end-date")
+    regions = options["--regions"].split(",") if "--regions" in options else ["ap-northeast-1", "us-east-1"]
+    # --use-cli 指定時のみ従来のAWS CLIサブプロセスで取得
+    use_cli = options.get("--use-cli", False)
+    # --accounts 指定時は各アカウントの読み取り専用ロールを引き受けて取得する（--source fake は擬似的なSTSとアカウントを使う）
+    account_pool = configure_account_pool(options)
+    accounts = account_pool.accounts if account_pool is not None else [None]
+    # キャッシュ・AWS CLIはアカウントを区別しないため、--accounts とは組み合わせられない
+    if account_pool is not None and ("--cache" in options or use_cli):
+        print("エラー: --accounts は --cache・--use-cli と組み合わせられません")
+        sys.exit(1)
+    # 同時に処理する作業単位の数（--accounts 指定時はアカウントごとにAPIの制限が別のため、既定値を (アカウント, リージョン) の数にする）
+    default_concurrency = min(len(accounts) * len(regions), MAX_ACCOUNT_CONCURRENCY) if account_pool is not None else DEFAULT_CONCURRENCY
+    concurrency = int(options.get("--concurrency", default_concurrency))
+    # --source 指定時はLookupEvents API以外（S3エクスポートファイル・擬似データ）から取得
+    if account_pool is None:
+        configure_event_source(options)
+    # --timeline 指定時はイベント名ごとの日別の回数も集計し、CSV/Parquetで出力する
+    timeline_path = configure_timeline(options)
+    # --export 指定時は取得したイベントを絞り込んだ列だけにして、列指向のファイルに書き出す
+    exporter = open_exporter_from_options(options)
+    # --cache 指定時は取得済みの期間をローカルキャッシュから読み出す
+    cache = open_cache_from_options(options)
+    # --adaptive-chunks 指定時はリージョンごとにイベントの密度を調べてチャンクを分割・結合する
+    adaptive_chunks = options.get("--adaptive-chunks", False)
     
-    if not start_date or not end_date:
+    if not iam_entity or not start_date or not end_date:
         print("開始日と終了日を指定してください")
         sys.exit(1)
     
@@ -143,82 +176,125 @@ def main():
     
     # 固定パラメータ
     chunk_days = 7 
-    max_items = 1000
     
     date_range = (end_time - start_time).days + 1
     print(f"分析開始: {iam_entity}の{start_date}から{end_date}までの{date_range}日間のアクティビティ")
     print(f"検索対象リージョン: {', '.join(regions)}")
     
-    # サービスごとのイベント名収集用
-    service_event_names = defaultdict(set)
+    # 出力ファイル名（--accounts 指定時は1アカウントの結果と区別する）
+    output_name = f"cloudtrail_events_{iam_entity}_{start_date}_to_{end_date}"
+    if account_pool is not None:
+        output_name += "_accounts"
+    
+    # 進捗のジャーナル（--resume 指定時は完了済みの作業単位を飛ばし、途中の作業単位は続きのページから再開する）
+    journal = open_journal_from_options(
+        options,
+        f"{output_name}.journal",
+        {"iam_entity": iam_entity, "start_date": start_date, "end_date": end_date, "regions": regions,
+         "adaptive_chunks": adaptive_chunks, "accounts": accounts if account_pool is not None else None},
+    )
+    
+    # サービスごとのイベント名収集用（--accounts 指定時はアカウントごとにも集計する）
+    event_store = EventNameStore()
     total_events = 0
+    account_stores = {account: EventNameStore() for account in accounts}
+    account_events = dict.fromkeys(accounts, 0)
+    # EventIdによる重複の除去（グローバルサービスのイベントは us-east-1 の結果だけを集計する）
+    dedup = EventIdFilter(regions)
+    if dedup.global_region is not None and len(regions) > 1:
+        services = ", ".join(sorted(source.split(".")[0] for source in GLOBAL_EVENT_SOURCES))
+        print(f"グローバルサービス（{services}）のイベントは {dedup.global_region} の結果だけを集計します")
     
     # 時間範囲を分割して処理
-    time_chunks = []
-    chunk_start = start_time
+    time_chunks = build_time_chunks(start_time, end_time, chunk_days)
     
-    while chunk_start < end_time:
-        chunk_end = min(chunk_start + datetime.timedelta(days=chunk_days), end_time)
-        time_chunks.append((chunk_start, chunk_end))
-        chunk_start = chunk_end
+    unit_label = "(アカウント, チャンク, リージョン)" if account_pool is not None else "(チャンク, リージョン)"
+    print(f"期間を{len(time_chunks)}チャンクに分割し、{unit_label} ごとに最大{concurrency}並列で処理します")
     
-    print(f"期間を{len(time_chunks)}チャンクに分割して処理します")
+    # (アカウント, リージョン) ごとのチャンクを計画してジャーナルに記録する（再開時は記録した計画を使う）
+    plans = journal.chunk_plans()
+    if plans is None:
+        plans = []
+        for account in accounts:
+            denied = False
+            for region in regions:
+                chunks = time_chunks
+                if adaptive_chunks and not denied:
+                    try:
+                        chunks = plan_time_chunks(iam_entity, time_chunks, region, use_cli, concurrency=concurrency, account=account)
+                    except AccountAccessError as e:
+                        # AssumeRoleできないアカウントは密度を調べない（取得時に account_pool.errors に記録し、結果に出力する）
+                        print(f"警告: アカウント {account} は取得できないためスキップします: {e}")
+                        denied = True
+                plans.append(((account, region), chunks))
+        journal.record_chunk_plans(plans)
     
-    for i, (chunk_start, chunk_end) in enumerate(time_chunks):
-        chunk_start_str = chunk_start.strftime("%Y-%m-%dT%H:%M:%S")
-        chunk_end_str = chunk_end.strftime("%Y-%m-%dT%H:%M:%S")
-        
-        print(f"チャンク {i+1}/{len(time_chunks)} 処理中: {chunk_start_str} から {chunk_end_str}")
-        
-        # CloudTrailイベントの取得（マルチリージョン対応）
-        events = get_cloudtrail_events(iam_entity, chunk_start_str, chunk_end_str, regions, max_items)
-        
-        events_count = len(events)
-        total_events += events_count
-        
-        # イベント処理
-        for event in events:
-            process_cloudtrail_event(event, service_event_names)
-        
-        print(f"チャンク {i+1} 完了: {events_count} イベント処理")
-        
-        # チャンク間の待機時間
-        if i < len(time_chunks) - 1:
-            wait_time = 2
-            print(f"{wait_time}秒間待機してから次のチャンクを処理します...")
-            time.sleep(wait_time)
-    
-    # 結果
-    result = {}
-    for service, event_names in service_event_names.items():
-        # イベント名, サービス名を一緒に格納
-        event_list = [f"{service}:{event_name}" for event_name in event_names]
-        result[service] = sorted(event_list)
-    
-    response = {
-        "アクセス分析結果": f"{iam_entity}の{start_date}から{end_date}までのアクティビティ",
-        "検索対象リージョン": regions,
-        "取得イベント数": total_events,
-        "サービスごとのCloudTrailイベント": result
-    }
-    
-    # 結果を保存（日時を追加して重複を避ける）
-    timestamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
-    output_file = f"cloudtrail_events_{iam_entity}_{start_date}_to_{end_date}.json"
-    
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(response, f, ensure_ascii=False, indent=2)
-    
-    print(f"分析完了: 結果を {output_file} に保存しました")
-    
-    # サービス数と総イベント数を表示
-    print(f"検出されたサービス数: {len(result)}")
-    print(f"合計イベント数: {total_events}")
-    
-    # サービスごとのイベント名数を表示
-    for service, event_names in sorted(result.items()):
-        print(f"サービス {service}: {len(event_names)}イベント")
+    # (チャンク, リージョン) の作業単位を同時に処理（APIレートはリージョンごとのトークンバケットで制御）
+    # --accounts 指定時は (アカウント, チャンク, リージョン) を作業単位とし、APIレートは (アカウント, リージョン) ごとに制御する
+    units = []
+    for (account, region), chunks in plans:
+        units.extend((i, chunk_start, chunk_end, region, len(chunks), account) for i, (chunk_start, chunk_end) in enumerate(chunks))
+    if account_pool is not None:
+        # 全アカウントを並行して進めるよう、チャンクの順に処理する
+        units.sort(key=lambda unit: unit[0])
+    
+    try:
+        for (i, chunk_start, chunk_end, region, chunk_count, account), (events_count, unit_event_store) in run_work_units(
+            units,
+            lambda unit: fetch_unit_event_names(iam_entity, unit[1], unit[2], unit[3], journal, use_cli, cache, exporter, unit[5], dedup),
+            concurrency,
+        ):
+            total_events += events_count
+            
+            # 作業単位ごとの集計結果をマージ
+            event_store.merge(unit_event_store)
+            if account_pool is not None:
+                account_stores[account].merge(unit_event_store)
+                account_events[account] += events_count
+            
+            region_label = f"{account}/{region}" if account else region
+            print(f"チャンク {i+1}/{chunk_count} リージョン {region_label} 完了: {events_count} イベント処理")
+    except (Exception, KeyboardInterrupt) as e:
+        # 実行中の作業単位を止め、ここまでの進捗をジャーナルに残す
+        journal.stop()
+        print(f"エラー発生: {e}" if isinstance(e, Exception) else "中断されました")
+        print(f"進捗を {journal.path} に保存しました。--resume を付けて再実行すると続きから処理します")
+        journal.close()
+        if exporter is not None:
+            exporter.close()
+        sys.exit(1)
+    
+    # 結果（イベント名, サービス名を一緒に格納）を保存
+    # --accounts 指定時は全アカウントを合わせた結果に、アカウントごとのサービス・イベント名を加える
+    extra = {"検索対象リージョン": regions, **dedup.render_stats()}
+    if account_pool is not None:
+        extra["検索対象アカウント"] = accounts
+        extra["アカウントごとの結果"] = {
+            account: {"取得イベント数": account_events[account], "サービスごとのCloudTrailイベント": account_stores[account].render()}
+            for account in accounts
+        }
+        extra["取得できなかったアカウント"] = dict(account_pool.errors)
+    response = render_result(f"{iam_entity}の{start_date}から{end_date}までのアクティビティ", total_events, event_store, extra)
+    save_result_file(f"{output_name}.json", response)
+    print(f"取得イベント数（重複を含む）: {dedup.raw_events}（重複 {dedup.duplicates}件, "
+          f"{dedup.global_region or 'us-east-1'}以外のグローバルサービス {dedup.global_skipped}件を除外）")
+    if account_pool is not None:
+        for account in accounts:
+            print(f"アカウント {account}: {account_events[account]}イベント, {len(account_stores[account].render())}サービス")
+        for account, error in account_pool.errors.items():
+            print(f"警告: アカウント {account} は取得できませんでした: {error}")
+    if timeline_path is not None:
+        # --accounts 指定時はアカウントごとの行にする
+        timeline_stores = account_stores if account_pool is not None else {iam_entity: event_store}
+        write_timeline(timeline_path, timeline_stores)
+    if exporter is not None:
+        exporter.close()
+    journal.finish()
+    
+    if cache is not None:
+        cache.print_stats()
+        cache.close()
 
 
 if __name__ == "__main__":
-    main()
+    run_with_metrics(main)
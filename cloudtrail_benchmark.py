@@ -0,0 +1,250 @@
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from cloudtrail_aggregate import DETAILS_KEY, EventNameStore
+from cloudtrail_cli import parse_cli_args
+from cloudtrail_extract import extract_event_source_and_name, normalize_service_name
+from cloudtrail_sources import FakeEventSource, create_event_source
+
+
+# 計測する処理段階（表示順）
+STAGES = ("fetch", "extract", "normalize", "aggregate", "result")
+
+# デフォルトのイベント数（10000000件も指定可能）
+DEFAULT_SIZES = (10000, 1000000)
+
+# 比較モードで性能低下とみなす割合（0.2 = 1イベントあたりの時間が20%以上増加）
+DEFAULT_THRESHOLD = 0.2
+
+# これより短い段階は測定誤差が大きいため、性能低下の判定に使わない（秒）
+MIN_COMPARE_SECONDS = 0.01
+
+# 起動時間の計測で、読み込まれていないことを確認する重いモジュール
+HEAVY_MODULES = ("boto3", "botocore", "pyarrow", "numpy")
+
+# ctinspect --help の起動時間の上限（ミリ秒）
+STARTUP_LIMIT_MS = 100
+
+# 起動時間の計測で実行するコード（ctinspect を実行し、読み込まれた重いモジュールを最後の行に出力する）
+_HEAVY_MARKER = "heavy-modules:"
+_STARTUP_CODE = (
+    "import sys\n"
+    "import ctinspect\n"
+    "try:\n"
+    "    ctinspect.main(sys.argv[1:])\n"
+    "except SystemExit:\n"
+    "    pass\n"
+    f"print('{_HEAVY_MARKER}' + ','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))\n"
+)
+
+# 擬似データの期間の開始時刻（1秒に1イベント）
+_FAKE_START = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+# 取得元から指定件数のイベントを処理し、処理段階ごとの所要時間を計測する関数
+# ページ単位で各段階を続けて実行するため、1000万件でもイベント全体をメモリに保持しない
+def run_stages(source, size):
+    if isinstance(source, FakeEventSource):
+        start_time = _FAKE_START
+        end_time = _FAKE_START + datetime.timedelta(seconds=size * source.interval)
+    else:
+        start_time = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+        end_time = datetime.datetime.now(datetime.timezone.utc)
+
+    timings = dict.fromkeys(STAGES, 0.0)
+    page_latencies = []
+    event_store = EventNameStore()
+    events_count = 0
+    next_token = None
+
+    while events_count < size:
+        # ページ取得（ローカルの取得元を直接呼び出すため、APIのレート制御は含まない）
+        started = time.perf_counter()
+        data = source.lookup_events_page(None, start_time, end_time, None, next_token)
+        fetched = time.perf_counter()
+        page_latencies.append(fetched - started)
+        timings["fetch"] += fetched - started
+
+        events = data.get("Events", [])[:size - events_count]
+        events_count += len(events)
+
+        # CloudTrailEvent文字列から eventSource と eventName を取り出す
+        started = time.perf_counter()
+        extracted = [extract_event_source_and_name(event["CloudTrailEvent"]) for event in events]
+        events = [event for event, item in zip(events, extracted) if item]
+        extracted = [item for item in extracted if item]
+        timings["extract"] += time.perf_counter() - started
+
+        # eventSource をサービス名に変換する（集計とは別に、変換だけの時間を計測する）
+        started = time.perf_counter()
+        for event_source, _ in extracted:
+            normalize_service_name(event_source)
+        timings["normalize"] += time.perf_counter() - started
+
+        # イベント名ごとの回数・初回・最終の日時を集計する（サービス名への変換は新しい名前の登録時のみ）
+        started = time.perf_counter()
+        for event, (event_source, event_name) in zip(events, extracted):
+            event_store.add(event_source, event_name, event["EventTime"])
+        timings["aggregate"] += time.perf_counter() - started
+
+        next_token = data.get("NextToken")
+        if not next_token:
+            break
+
+    # 結果の作成（ソートとJSON出力）
+    started = time.perf_counter()
+    json.dump({"取得イベント数": events_count, "サービスごとのCloudTrailイベント": event_store.render(),
+               DETAILS_KEY: event_store.render_details()},
+              io.StringIO(), ensure_ascii=False, indent=2)
+    timings["result"] = time.perf_counter() - started
+
+    page_latencies.sort()
+    return {
+        "events": events_count,
+        "pages": len(page_latencies),
+        "page_latency_p50_ms": page_latencies[len(page_latencies) // 2] * 1000 if page_latencies else 0.0,
+        "page_latency_p99_ms": page_latencies[int(len(page_latencies) * 0.99)] * 1000 if page_latencies else 0.0,
+        "stages": {
+            stage: {
+                "seconds": seconds,
+                "ns_per_event": seconds / events_count * 1e9 if events_count else 0.0,
+            }
+            for stage, seconds in timings.items()
+        },
+    }
+
+
+# 繰り返し計測し、段階ごとに最も速かった結果を採用する関数（他プロセスの影響を減らすため）
+def run_benchmark(spec, size, repeat):
+    best = None
+    for _ in range(repeat):
+        source = create_event_source(spec) if spec else FakeEventSource(events_per_day=86400, principals=("benchmark",))
+        measured = run_stages(source, size)
+        if best is None:
+            best = measured
+            continue
+        for stage, values in measured["stages"].items():
+            if values["seconds"] < best["stages"][stage]["seconds"]:
+                best["stages"][stage] = values
+    return best
+
+
+# 計測結果を表示する関数
+def print_result(name, measured):
+    print(f"{name}: {measured['events']:,} イベント / {measured['pages']:,} ページ "
+          f"(ページ取得 p50 {measured['page_latency_p50_ms']:.3f}ms, p99 {measured['page_latency_p99_ms']:.3f}ms)")
+    for stage in STAGES:
+        values = measured["stages"][stage]
+        print(f"  {stage:<10} {values['seconds']:9.3f}秒 {values['ns_per_event']:10.1f} ns/イベント")
+
+
+# ベースラインと比較し、1イベントあたりの時間が閾値を超えて増えた段階を返す関数
+def compare_results(baseline, results, threshold):
+    regressions = []
+    for name, measured in results.items():
+        if name not in baseline["results"]:
+            print(f"{name}: ベースラインに記録がないため比較しません")
+            continue
+        for stage in STAGES:
+            before = baseline["results"][name]["stages"][stage]["ns_per_event"]
+            after = measured["stages"][stage]["ns_per_event"]
+            change = (after - before) / before if before else 0.0
+            regressed = change > threshold and measured["stages"][stage]["seconds"] >= MIN_COMPARE_SECONDS
+            mark = "低下" if regressed else ""
+            print(f"  {name} {stage:<10} {before:10.1f} -> {after:10.1f} ns/イベント ({change:+.1%}) {mark}")
+            if regressed:
+                regressions.append((name, stage, change))
+    return regressions
+
+
+# ctinspect を別プロセスで繰り返し起動し、起動時間の中央値（ミリ秒）と読み込まれた重いモジュールを返す関数
+def measure_startup(argv, repeat):
+    elapsed = []
+    heavy = ""
+    for _ in range(repeat):
+        started = time.perf_counter()
+        completed = subprocess.run(
+            [sys.executable, "-c", _STARTUP_CODE] + argv,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        elapsed.append(time.perf_counter() - started)
+        heavy = completed.stdout.rpartition(_HEAVY_MARKER)[2].strip()
+    elapsed.sort()
+    return elapsed[len(elapsed) // 2] * 1000, heavy
+
+
+# ctinspect --help と各サブコマンド（引数なしで使用方法を表示するまで）の起動時間を計測する関数
+# --help が上限を超えた場合、または重いモジュールを読み込んだ場合は False を返す
+def run_startup_benchmark(repeat):
+    from ctinspect import SUBCOMMANDS
+
+    print(f"起動時間（{repeat}回の中央値）:")
+    ok = True
+    for argv in [["--help"]] + [[name] for name in SUBCOMMANDS]:
+        elapsed_ms, heavy = measure_startup(argv, repeat)
+        print(f"  ctinspect {' '.join(argv):<14} {elapsed_ms:7.1f}ms  読み込まれた重いモジュール: {heavy or 'なし'}")
+        if argv == ["--help"] and (elapsed_ms > STARTUP_LIMIT_MS or heavy):
+            ok = False
+    return ok
+
+
+# 実行コマンド：python cloudtrail_benchmark.py [--sizes 10000,1000000] [--source fake:...|s3:パス] [--repeat N]
+#                                             [--save ベースライン.json] [--compare ベースライン.json [--threshold 0.2]]
+#              python cloudtrail_benchmark.py --startup [--repeat N]
+def main():
+    _, options = parse_cli_args(
+        sys.argv[1:],
+        value_options=("--sizes", "--source", "--repeat", "--save", "--compare", "--threshold"),
+        flag_options=("--startup",),
+    )
+    if options.get("--startup", False):
+        if not run_startup_benchmark(int(options.get("--repeat", 10))):
+            print(f"ctinspect --help の起動時間が上限（{STARTUP_LIMIT_MS}ms）を超えたか、重いモジュールを読み込んでいます")
+            sys.exit(1)
+        print(f"ctinspect --help は上限（{STARTUP_LIMIT_MS}ms）以内に起動しました")
+        return
+
+    sizes = [int(size) for size in options["--sizes"].split(",")] if "--sizes" in options else DEFAULT_SIZES
+    spec = options.get("--source")
+    repeat = int(options.get("--repeat", 1))
+    threshold = float(options.get("--threshold", DEFAULT_THRESHOLD))
+    corpus = "synthetic" if spec is None or spec.startswith("fake") else "recorded"
+
+    results = {}
+    for size in sizes:
+        name = f"{corpus}/{size}"
+        results[name] = run_benchmark(spec, size, repeat)
+        print_result(name, results[name])
+
+    if "--save" in options:
+        baseline = {
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "source": spec or "fake",
+            "results": results,
+        }
+        with open(options["--save"], 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=2)
+        print(f"ベースラインを {options['--save']} に保存しました")
+
+    if "--compare" in options:
+        with open(options["--compare"], encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"ベースライン {options['--compare']}（{baseline['created']}, Python {baseline['python']}）と比較します")
+        regressions = compare_results(baseline, results, threshold)
+        if regressions:
+            print(f"性能低下を検出しました（閾値 {threshold:.0%}）: {len(regressions)}件")
+            sys.exit(1)
+        print("性能低下はありません")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from cloudtrail_extract import extract_event_source_and_name, from_epoch, to_epoch
+from cloudtrail_fetcher import iter_event_pages
+
+
+# 遅れて配信されるイベントを考慮し、取得時刻からこの秒数以内の範囲は取得済みとして扱わない
+LATE_ARRIVAL_MARGIN_SECONDS = 15 * 60
+
+# キャッシュから読み出すときの1ページあたりの件数
+CACHE_PAGE_SIZE = 1000
+
+# デフォルトで保持する期間（LookupEventsで取得できるのは過去90日分のみ）
+DEFAULT_MAX_AGE_DAYS = 90
+
+# キャッシュの形式のバージョン（異なる形式の既存のキャッシュは破棄して作り直す）
+CACHE_SCHEMA_VERSION = 2
+
+# --source 未指定時の取得元（LookupEvents。AWS CLIでの取得も同じデータのため同じ取得元として扱う）
+DEFAULT_CACHE_SOURCE = "api"
+
+
+# 区間のリストを重なり・隣接をまとめた区間のリストにする関数
+def merge_windows(windows):
+    merged = []
+    for start, end in sorted(windows):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+# [start, end) から取得済み区間を除いた未取得区間を返す関数
+def subtract_windows(start, end, covered):
+    missing = []
+    cursor = start
+    for covered_start, covered_end in merge_windows(covered):
+        if covered_end <= cursor or covered_start >= end:
+            continue
+        if covered_start > cursor:
+            missing.append((cursor, covered_start))
+        cursor = max(cursor, covered_end)
+    if cursor < end:
+        missing.append((cursor, end))
+    return missing
+
+
+# 取得したイベントを (取得元, アカウント, IAMエンティティ, リージョン, 期間) 単位で保存するSQLiteキャッシュ
+# イベントは (eventSource, eventName, eventTime) に絞って保存し、取得済みの期間を別テーブルで管理する
+# source（--source の指定）ごとに別のデータとして扱い、擬似データやS3エクスポートログの取得済み期間をAPIの取得に使わない
+class EventCache:
+    def __init__(self, path, source=DEFAULT_CACHE_SOURCE):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.source = source
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        if self.connection.execute("PRAGMA user_version").fetchone()[0] != CACHE_SCHEMA_VERSION:
+            # 取得元・アカウントを区別しない以前の形式のキャッシュは、どの取得元のデータか分からないため使わない
+            self.connection.executescript("DROP TABLE IF EXISTS events; DROP TABLE IF EXISTS windows;")
+        self.connection.executescript(f"""
+            CREATE TABLE IF NOT EXISTS events (
+                source TEXT NOT NULL,
+                account TEXT NOT NULL,
+                principal TEXT NOT NULL,
+                region TEXT NOT NULL,
+                event_id TEXT NOT NULL,
+                event_time REAL NOT NULL,
+                event_source TEXT NOT NULL,
+                event_name TEXT NOT NULL,
+                PRIMARY KEY (source, account, principal, region, event_id)
+            );
+            CREATE INDEX IF NOT EXISTS events_by_time ON events (source, account, principal, region, event_time);
+            CREATE TABLE IF NOT EXISTS windows (
+                source TEXT NOT NULL,
+                account TEXT NOT NULL,
+                principal TEXT NOT NULL,
+                region TEXT NOT NULL,
+                start_time REAL NOT NULL,
+                end_time REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS windows_by_principal ON windows (source, account, principal, region);
+            PRAGMA user_version = {CACHE_SCHEMA_VERSION};
+        """)
+        self.stats = {
+            "hit_seconds": 0.0,
+            "miss_seconds": 0.0,
+            "cached_events": 0,
+            "fetched_events": 0,
+        }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    # (取得元, アカウント, IAMエンティティ, リージョン) のキー（account 未指定時は空文字列）
+    def _key(self, principal, region, account):
+        return (self.source, account or "", principal, region)
+
+    # 取得済みの期間を返す
+    def covered_windows(self, principal, region, account=None):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT start_time, end_time FROM windows WHERE source = ? AND account = ? AND principal = ? AND region = ?",
+                self._key(principal, region, account),
+            ).fetchall()
+        return merge_windows(rows)
+
+    # 未取得の期間を返し、ヒット/ミスの統計を更新する
+    def missing_windows(self, principal, region, start, end, account=None):
+        missing = subtract_windows(start, end, self.covered_windows(principal, region, account))
+        miss_seconds = sum(window_end - window_start for window_start, window_end in missing)
+        with self.lock:
+            self.stats["miss_seconds"] += miss_seconds
+            self.stats["hit_seconds"] += (end - start) - miss_seconds
+        return missing
+
+    # 期間を取得済みとして記録する（重なる区間はまとめる）
+    def mark_covered(self, principal, region, start, end, account=None):
+        if start >= end:
+            return
+        key = self._key(principal, region, account)
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                "SELECT start_time, end_time FROM windows WHERE source = ? AND account = ? AND principal = ? AND region = ?",
+                key,
+            ).fetchall()
+            self.connection.execute(
+                "DELETE FROM windows WHERE source = ? AND account = ? AND principal = ? AND region = ?",
+                key,
+            )
+            self.connection.executemany(
+                "INSERT INTO windows (source, account, principal, region, start_time, end_time) VALUES (?, ?, ?, ?, ?, ?)",
+                [(*key, s, e) for s, e in merge_windows(rows + [(start, end)])],
+            )
+
+    # LookupEventsのイベントを絞り込んだ形で保存する（同じEventIdは重複して保存しない）
+    def store_events(self, principal, region, events, account=None):
+        key = self._key(principal, region, account)
+        rows = []
+        for event in events:
+            extracted = extract_event_source_and_name(event['CloudTrailEvent'])
+            if extracted:
+                event_source, event_name = extracted
+                rows.append((*key, event["EventId"], to_epoch(event["EventTime"]), event_source, event_name))
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO events (source, account, principal, region, event_id, event_time, event_source, event_name) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.stats["fetched_events"] += len(events)
+
+    # 期間内のイベントを (event_id, event_time, event_source, event_name) のリストでページ単位に返す
+    def iter_event_rows(self, principal, region, start, end, page_size=CACHE_PAGE_SIZE, account=None):
+        key = self._key(principal, region, account)
+        last_key = (start, "")
+        while True:
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT event_id, event_time, event_source, event_name FROM events "
+                    "WHERE source = ? AND account = ? AND principal = ? AND region = ? AND (event_time, event_id) > (?, ?) AND event_time < ? "
+                    "ORDER BY event_time, event_id LIMIT ?",
+                    (*key, last_key[0], last_key[1], end, page_size),
+                ).fetchall()
+            if not rows:
+                break
+            with self.lock:
+                self.stats["cached_events"] += len(rows)
+            yield rows
+            last_key = (rows[-1][1], rows[-1][0])
+
+    # 古いイベントを削除する（保持期間・最大件数のどちらか、または両方を指定）
+    def evict(self, max_age_days=None, max_events=None):
+        cutoff = None
+        if max_age_days is not None:
+            cutoff = time.time() - max_age_days * 86400
+        with self.lock, self.connection:
+            if max_events is not None:
+                row = self.connection.execute(
+                    "SELECT event_time FROM events ORDER BY event_time DESC LIMIT 1 OFFSET ?",
+                    (max_events,),
+                ).fetchone()
+                if row:
+                    cutoff = max(cutoff or row[0], row[0])
+            if cutoff is None:
+                return 0
+            deleted = self.connection.execute("DELETE FROM events WHERE event_time <= ?", (cutoff,)).rowcount
+            # 削除した範囲は取得済み期間からも外す
+            self.connection.execute("DELETE FROM windows WHERE end_time <= ?", (cutoff,))
+            self.connection.execute("UPDATE windows SET start_time = ? WHERE start_time <= ?", (cutoff, cutoff))
+        return deleted
+
+    # キャッシュの統計を表示する
+    def print_stats(self):
+        total_seconds = self.stats["hit_seconds"] + self.stats["miss_seconds"]
+        hit_rate = self.stats["hit_seconds"] / total_seconds * 100 if total_seconds else 0.0
+        print(f"キャッシュ: 期間ヒット率 {hit_rate:.1f}% "
+              f"(ヒット {self.stats['hit_seconds'] / 3600:.1f}時間 / ミス {self.stats['miss_seconds'] / 3600:.1f}時間)")
+        print(f"キャッシュ: API取得 {self.stats['fetched_events']} イベント / キャッシュ読み出し {self.stats['cached_events']} イベント")
+
+
+# キャッシュを使ってイベントをページ単位で返すジェネレータ
+# 未取得の期間だけAPIから取得してキャッシュに追加し、その後キャッシュから期間内のイベントを返す
+# start_time・end_time はLookupEventsと同じくどちらも期間に含む（終了時刻の秒のイベントも返す）
+# キャッシュ内の期間は [開始, 終了) で管理するため、秒単位のイベント時刻に合わせて [切り上げた開始, 切り捨てた終了の1秒後) にする
+# account 指定時はそのアカウントのイベントとして取得・保存する
+def iter_cached_event_pages(cache, iam_entity, start_time, end_time, region=None, use_cli=False, account=None):
+    cache_region = region or "default"
+    start = math.ceil(to_epoch(start_time))
+    end = math.floor(to_epoch(end_time)) + 1
+
+    for window_start, window_end in cache.missing_windows(iam_entity, cache_region, start, end, account):
+        fetched_at = time.time()
+        # [window_start, window_end) のイベントをLookupEvents（終了時刻を含む）で取得する
+        fetch_start = math.ceil(window_start)
+        fetch_end = math.ceil(window_end) - 1
+        if fetch_start <= fetch_end:
+            for data in iter_event_pages(iam_entity, from_epoch(fetch_start), from_epoch(fetch_end), region, use_cli, account=account):
+                cache.store_events(iam_entity, cache_region, data.get("Events", []), account)
+        # 取得直後の範囲は遅延配信の可能性があるため、次回も取得し直す
+        cache.mark_covered(iam_entity, cache_region, window_start, min(window_end, math.floor(fetched_at - LATE_ARRIVAL_MARGIN_SECONDS)), account)
+
+    for rows in cache.iter_event_rows(iam_entity, cache_region, start, end, account=account):
+        yield {
+            "Events": [
+                {
+                    "EventId": event_id,
+                    "EventTime": event_time,
+                    "CloudTrailEvent": json.dumps({"eventSource": event_source, "eventName": event_name}, separators=(",", ":")),
+                }
+                for event_id, event_time, event_source, event_name in rows
+            ]
+        }
+
+
+# コマンドラインオプションからキャッシュを開く関数（--cache 未指定の場合はNone）
+def open_cache_from_options(options):
+    if "--cache" not in options:
+        return None
+
+    # 取得元ごとに別のデータとして保存する（AWS CLIでの取得はLookupEventsと同じ取得元）
+    source = options.get("--source", DEFAULT_CACHE_SOURCE)
+    cache = EventCache(options["--cache"], "api" if source == "cli" else source)
+    max_age_days = int(options.get("--cache-max-age-days", DEFAULT_MAX_AGE_DAYS))
+    max_events = int(options["--cache-max-events"]) if "--cache-max-events" in options else None
+    deleted = cache.evict(max_age_days=max_age_days, max_events=max_events)
+    print(f"キャッシュ {cache.path} を使用します（取得元: {cache.source}、古いイベント {deleted} 件を削除）")
+    return cache
@@ -0,0 +1,62 @@
+import json
+import os
+
+
+# チェックポイントをローカルのJSONファイルに保存するストア（ローカル実行・動作確認用）
+class FileCheckpointStore:
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def _path(self, checkpoint_id):
+        return os.path.join(self.directory, f"{checkpoint_id}.json")
+
+    def save(self, checkpoint_id, state):
+        # 書き込み途中で中断されても壊れたファイルが残らないよう、一時ファイルから置き換える
+        path = self._path(checkpoint_id)
+        with open(f"{path}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False)
+        os.replace(f"{path}.tmp", path)
+
+    def load(self, checkpoint_id):
+        with open(self._path(checkpoint_id), encoding='utf-8') as f:
+            return json.load(f)
+
+    def delete(self, checkpoint_id):
+        if os.path.exists(self._path(checkpoint_id)):
+            os.remove(self._path(checkpoint_id))
+
+
+# チェックポイントをS3に保存するストア（Lambda実行用）
+class S3CheckpointStore:
+    def __init__(self, bucket, prefix="cloudtrail-checkpoints/", s3_client=None):
+        if s3_client is None:
+            import boto3
+            s3_client = boto3.client('s3')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.s3 = s3_client
+
+    def _key(self, checkpoint_id):
+        return f"{self.prefix}{checkpoint_id}.json"
+
+    def save(self, checkpoint_id, state):
+        body = json.dumps(state, ensure_ascii=False).encode('utf-8')
+        self.s3.put_object(Bucket=self.bucket, Key=self._key(checkpoint_id), Body=body)
+
+    def load(self, checkpoint_id):
+        response = self.s3.get_object(Bucket=self.bucket, Key=self._key(checkpoint_id))
+        return json.loads(response['Body'].read())
+
+    def delete(self, checkpoint_id):
+        self.s3.delete_object(Bucket=self.bucket, Key=self._key(checkpoint_id))
+
+
+# 環境変数からチェックポイントストアを作成する関数
+# CHECKPOINT_BUCKET: S3に保存 / CHECKPOINT_DIR: ローカルファイルに保存 / どちらもなし: None（状態は継続用ペイロードに含める）
+def get_checkpoint_store():
+    if os.environ.get("CHECKPOINT_BUCKET"):
+        return S3CheckpointStore(os.environ["CHECKPOINT_BUCKET"], os.environ.get("CHECKPOINT_PREFIX", "cloudtrail-checkpoints/"))
+    if os.environ.get("CHECKPOINT_DIR"):
+        return FileCheckpointStore(os.environ["CHECKPOINT_DIR"])
+    return None
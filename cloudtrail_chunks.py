@@ -0,0 +1,66 @@
+import time
+
+from cloudtrail_aggregate import EventNameStore
+from cloudtrail_cache import iter_cached_event_pages
+from cloudtrail_fetcher import iter_event_pages
+from cloudtrail_metrics import metrics
+
+
+# 1チャンク分のイベントを取得して集計する関数
+# journal 指定時はページごとの集計結果と次のトークンを記録し、前回の実行で完了・途中のチャンクは続きから処理する
+def fetch_chunk_events(iam_entity, chunk_index, chunk_count, chunk_start, chunk_end, use_cli=False, cache=None, journal=None, exporter=None):
+    chunk_start_str = chunk_start.strftime("%Y-%m-%dT%H:%M:%S")
+    chunk_end_str = chunk_end.strftime("%Y-%m-%dT%H:%M:%S")
+    unit_key = f"{iam_entity}/{chunk_start_str}/{chunk_end_str}"
+    progress = journal.progress(unit_key) if journal is not None else None
+    
+    if progress is not None and progress.done:
+        print(f"チャンク {chunk_index+1}/{chunk_count} は前回の実行で完了済みです: {chunk_start_str} から {chunk_end_str}")
+        return progress.result(iam_entity)
+    
+    print(f"チャンク {chunk_index+1}/{chunk_count} 処理中: {chunk_start_str} から {chunk_end_str}")
+    
+    # 前回の実行で途中まで処理していれば、その集計結果から続ける
+    events_count, chunk_event_store = progress.result(iam_entity) if progress is not None else (0, EventNameStore())
+    page_count = 0
+    # キャッシュ使用時はページ単位ではなくチャンク単位で記録する
+    journal_pages = journal is not None and cache is None
+    
+    # ページネーション処理（キャッシュ使用時は未取得の期間のみAPIから取得）
+    if cache is not None:
+        pages = iter_cached_event_pages(cache, iam_entity, chunk_start, chunk_end, use_cli=use_cli)
+    else:
+        next_token = progress.next_token if progress is not None else None
+        pages = iter_event_pages(iam_entity, chunk_start, chunk_end, use_cli=use_cli, next_token=next_token)
+    if exporter is not None:
+        pages = exporter.export_pages(pages, iam_entity)
+    
+    chunk_label = chunk_start.strftime("%Y-%m-%d")
+    started = time.perf_counter()
+    for data in pages:
+        if journal is not None:
+            journal.check_stopped()
+        events = data.get("Events", [])
+        events_count += len(events)
+        page_count += 1
+        
+        if page_count % 10 == 0 or len(events) > 0:
+            print(f"  チャンク {chunk_index+1} ページ {page_count} 処理完了: 累計 {events_count} イベント")
+        
+        # イベント処理
+        parse_started = time.perf_counter()
+        page_event_store = EventNameStore() if journal_pages else chunk_event_store
+        for event in events:
+            # サービスごとにイベント名を分類（回数と初回・最終の日時も記録）
+            page_event_store.add_event(event)
+        if journal_pages:
+            journal.record_page(unit_key, data.get("NextToken"), {iam_entity: (len(events), page_event_store)})
+            chunk_event_store.merge(page_event_store)
+        metrics.increment("parse_seconds_total", time.perf_counter() - parse_started)
+        metrics.increment("chunk_pages_total", chunk=chunk_label)
+        metrics.increment("chunk_events_total", len(events), chunk=chunk_label)
+    
+    if journal is not None and not journal_pages:
+        journal.record_unit(unit_key, {iam_entity: (events_count, chunk_event_store)})
+    metrics.observe("chunk_seconds", time.perf_counter() - started)
+    return events_count, chunk_event_store
@@ -0,0 +1,76 @@
+# ローカルスクリプト共通のコマンドライン引数処理
+
+
+# キャッシュ関連のオプション（値を1つ取る）
+CACHE_OPTIONS = ("--cache", "--cache-max-age-days", "--cache-max-events")
+
+# キャッシュ関連オプションの使用方法
+CACHE_USAGE = "[--cache DBファイル [--cache-max-age-days 日数] [--cache-max-events 件数]]"
+
+# ジャーナル関連のオプション（値を1つ取る / 値を取らない）
+JOURNAL_OPTIONS = ("--journal",)
+JOURNAL_FLAGS = ("--resume",)
+
+# ジャーナル関連オプションの使用方法
+JOURNAL_USAGE = "[--resume] [--journal ファイル]"
+
+# タイムライン（イベント名ごとの日別の回数）の出力オプション（値を1つ取る）
+TIMELINE_OPTIONS = ("--timeline",)
+
+# タイムライン出力オプションの使用方法
+TIMELINE_USAGE = "[--timeline ファイル(.csv|.parquet)]"
+
+# 列指向ファイルへのエクスポートのオプション（値を1つ取る）
+EXPORT_OPTIONS = ("--export", "--export-format")
+
+# エクスポートオプションの使用方法
+EXPORT_USAGE = "[--export ディレクトリ [--export-format parquet|arrow]]"
+
+# 複数アカウントの分析のオプション（値を1つ取る）
+ACCOUNTS_OPTIONS = ("--accounts", "--role-name", "--external-id", "--role-duration")
+
+# 複数アカウントの分析のオプションの使用方法
+ACCOUNTS_USAGE = "[--accounts アカウントID[,...]|ファイル [--role-name ロール名] [--external-id 外部ID] [--role-duration 秒]]"
+
+# メトリクス・プロファイル関連のオプション（値を1つ取る、cloudtrail_metrics.run_with_metrics で処理）
+METRICS_OPTIONS = ("--metrics", "--profile")
+
+# メトリクス・プロファイル関連オプションの使用方法
+METRICS_USAGE = "[--metrics ファイル(.jsonl|.prom)] [--profile ファイル]"
+
+
+# コマンドライン引数を位置引数とオプションに分ける関数
+# value_options: 値を1つ取るオプション（例: --regions a,b）
+# flag_options: 値を取らないオプション（例: --use-cli）
+def parse_cli_args(argv, value_options=(), flag_options=()):
+    positional = []
+    options = {}
+
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg in value_options and i + 1 < len(argv):
+            options[arg] = argv[i + 1]
+            i += 2
+        elif arg in flag_options:
+            options[arg] = True
+            i += 1
+        elif arg.startswith("--"):
+            print(f"不明なオプション: {arg}")
+            i += 1
+        else:
+            positional.append(arg)
+            i += 1
+
+    return positional, options
+
+
+# IAMユーザー/ロール名の一覧ファイルを読み込む関数（1行に1件、空行と#で始まる行は無視）
+def load_principals(path):
+    principals = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#") and line not in principals:
+                principals.append(line)
+    return principals
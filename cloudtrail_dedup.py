@@ -0,0 +1,123 @@
+import hashlib
+import math
+import threading
+
+from cloudtrail_metrics import metrics
+
+
+# どのリージョンのLookupEventsにも同じイベントが現れるグローバルサービスと、そのイベントを集計するリージョン
+# （STSはリージョンごとのエンドポイントのイベントが別のイベントのため含めず、EventIdの重複判定だけで取り除く）
+GLOBAL_EVENT_SOURCES = frozenset(("iam.amazonaws.com", "cloudfront.amazonaws.com", "route53.amazonaws.com"))
+GLOBAL_SERVICE_REGION = "us-east-1"
+
+# EventIdを正確に記録する件数の上限（超えるとBloomフィルタに切り替える。1件あたり約70バイト）
+DEFAULT_EXACT_LIMIT = 1000000
+
+# Bloomフィルタで想定する件数と誤判定率（約36MB）
+DEFAULT_BLOOM_CAPACITY = 10000000
+DEFAULT_BLOOM_ERROR_RATE = 1e-6
+
+
+# EventIdを64ビットの整数にする関数（文字列のまま記録するより少ないメモリで済む）
+def event_id_key(event_id):
+    return int.from_bytes(hashlib.blake2b(event_id.encode(), digest_size=8).digest(), "little")
+
+
+# 固定サイズのビット列で要素の有無を記録するBloomフィルタ
+# 含まれていない要素を含まれていると判定することがある（capacity 件までは誤判定率 error_rate 以下）
+class BloomFilter:
+    def __init__(self, capacity=DEFAULT_BLOOM_CAPACITY, error_rate=DEFAULT_BLOOM_ERROR_RATE):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    # 64ビットのキーを追加し、追加前に含まれていた（と判定された）かどうかを返す
+    # ビットの位置はキーの上位・下位32ビットから二重ハッシュで決める
+    def add(self, key):
+        low = key & 0xFFFFFFFF
+        high = (key >> 32) | 1
+        present = True
+        for i in range(self.hashes):
+            position = (low + i * high) % self.size
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                present = False
+                self.bits[position >> 3] |= mask
+        return present
+
+
+# EventIdで重複したイベントを取り除くフィルタ（複数のワーカースレッドから同時に使える）
+# exact_limit 件まではEventIdを正確に記録し、超えた場合はBloomフィルタに切り替えてメモリ使用量を一定に抑える
+# （Bloomフィルタでは、まれに重複していないイベントを重複と判定して取り除く）
+# regions に GLOBAL_SERVICE_REGION が含まれる場合、他のリージョンのグローバルサービスのイベントは
+# CloudTrailEventを解析する前に取り除く（グローバルサービスは GLOBAL_SERVICE_REGION の結果だけで集計する）
+class EventIdFilter:
+    def __init__(self, regions=(), exact_limit=DEFAULT_EXACT_LIMIT,
+                 bloom_capacity=DEFAULT_BLOOM_CAPACITY, error_rate=DEFAULT_BLOOM_ERROR_RATE):
+        self.global_region = GLOBAL_SERVICE_REGION if GLOBAL_SERVICE_REGION in regions else None
+        self.exact_limit = exact_limit
+        self.bloom_capacity = bloom_capacity
+        self.error_rate = error_rate
+        self.keys = set()
+        self.bloom = None
+        self.lock = threading.Lock()
+        # 取り除く前のイベント数、EventIdが重複したイベント数、他のリージョンで集計するグローバルサービスのイベント数
+        self.raw_events = 0
+        self.duplicates = 0
+        self.global_skipped = 0
+
+    # EventIdを記録し、初めてのイベントかどうかを返す
+    def add(self, event_id):
+        key = event_id_key(event_id)
+        with self.lock:
+            if self.bloom is not None:
+                return not self.bloom.add(key)
+            if key in self.keys:
+                return False
+            self.keys.add(key)
+            if len(self.keys) > self.exact_limit:
+                self._switch_to_bloom()
+            return True
+
+    def _switch_to_bloom(self):
+        print(f"EventIdが{self.exact_limit}件を超えたため、重複の判定をBloomフィルタ（誤判定率 {self.error_rate:g}）に切り替えます")
+        self.bloom = BloomFilter(self.bloom_capacity, self.error_rate)
+        for key in self.keys:
+            self.bloom.add(key)
+        self.keys = set()
+
+    # ページから重複したイベントと、他のリージョンで集計するグローバルサービスのイベントを取り除いて返すジェネレータ
+    # （NextTokenなどイベント以外の項目はそのまま返す。account 指定時はアカウントごとに重複を判定する）
+    # EventIdが空のイベントは、全て同じイベントとして取り除かないよう重複の判定をしない
+    def filter_pages(self, pages, region=None, account=None):
+        prefix = f"{account}/" if account else ""
+        skip_global = self.global_region is not None and region != self.global_region
+        for data in pages:
+            events = data.get("Events", [])
+            kept = []
+            global_skipped = 0
+            for event in events:
+                if skip_global and event.get("EventSource") in GLOBAL_EVENT_SOURCES:
+                    global_skipped += 1
+                elif not event.get("EventId"):
+                    # EventIdのないイベント（eventIDのないS3エクスポートログのレコードなど）は重複を判定せずに残す
+                    kept.append(event)
+                elif self.add(prefix + event["EventId"]):
+                    kept.append(event)
+            duplicates = len(events) - len(kept) - global_skipped
+            with self.lock:
+                self.raw_events += len(events)
+                self.duplicates += duplicates
+                self.global_skipped += global_skipped
+            if duplicates or global_skipped:
+                metrics.increment("duplicate_events_total", duplicates + global_skipped, region=region or "default")
+            yield {**data, "Events": kept}
+
+    # 結果ファイルに出力する重複の集計
+    def render_stats(self):
+        return {
+            "取得イベント数（重複を含む）": self.raw_events,
+            "重複したイベント数": self.duplicates,
+            f"{self.global_region or GLOBAL_SERVICE_REGION}以外で除いたグローバルサービスのイベント数": self.global_skipped,
+            "重複の判定": "EventId" if self.bloom is None else f"EventId（Bloomフィルタ、誤判定率 {self.error_rate:g}）",
+        }
@@ -0,0 +1,65 @@
+import datetime
+import json
+
+from cloudtrail_aggregate import DETAILS_KEY, EventNameStore
+from cloudtrail_extract import from_epoch, to_epoch
+
+
+# 分析結果の期間（開始・終了）を出力するキー
+PERIOD_KEY = "分析期間"
+
+# 使用されていないとみなすまでの日数（--stale-days 未指定時）
+DEFAULT_STALE_DAYS = 30
+
+
+# 前回の分析結果ファイルを読み込む関数
+# 戻り値: (EventNameStore, 分析期間の開始, 分析期間の終了, 取得イベント数)
+# 分析期間が記録されていない古い結果では、最も古い・新しいイベントの日時を開始・終了とする
+def load_previous_result(path):
+    with open(path, encoding='utf-8') as f:
+        result = json.load(f)
+
+    if DETAILS_KEY in result:
+        event_store = EventNameStore.from_details(result[DETAILS_KEY])
+    elif "サービスごとのCloudTrailイベント" in result:
+        # 回数・日時のない結果はイベント名だけを登録する
+        event_store = EventNameStore.from_details({
+            name: {"回数": 0} for names in result["サービスごとのCloudTrailイベント"].values() for name in names
+        })
+    else:
+        raise ValueError(f"{path} に分析結果（{DETAILS_KEY}）がありません")
+
+    period = result.get(PERIOD_KEY)
+    if period:
+        start_time = datetime.datetime.fromisoformat(period["開始"])
+        end_time = datetime.datetime.fromisoformat(period["終了"])
+    else:
+        first_seen = [value for value in event_store.first_seen if value is not None]
+        last_seen = [value for value in event_store.last_seen if value is not None]
+        if not last_seen:
+            raise ValueError(f"{path} に分析期間がなく、イベントの日時からも前回の終了時刻を決められません")
+        start_time = from_epoch(min(first_seen))
+        end_time = from_epoch(max(last_seen))
+    return event_store, start_time, end_time, result.get("取得イベント数", 0)
+
+
+# 前回の結果と今回取得した分から差分をまとめる関数
+# 新しいサービス・新しいイベント名と、結合後の結果で stale_days 日以上使用されていないイベント名を返す
+# （日時が記録されていないイベント名は判定できないため含めない）
+def build_delta(previous_store, new_store, merged_store, end_time, stale_days):
+    previous_details = previous_store.render_details()
+    new_details = new_store.render_details()
+    previous_services = set(previous_store.render())
+    threshold = to_epoch(end_time) - stale_days * 86400
+
+    new_actions = {key: detail for key, detail in new_details.items() if key not in previous_details}
+    stale_actions = {
+        key: detail
+        for key, detail in merged_store.render_details().items()
+        if detail["最終"] is not None and to_epoch(detail["最終"]) < threshold
+    }
+    return {
+        "新しいサービス": sorted(set(new_store.render()) - previous_services),
+        "新しいCloudTrailイベント": new_actions,
+        f"{stale_days}日間使用されていないCloudTrailイベント": stale_actions,
+    }
@@ -1,46 +1,60 @@
-import json
-import subprocess
 import datetime
-import time
-from collections import defaultdict
 import sys
 
+from cloudtrail_aggregate import EventNameStore, configure_timeline, render_result, save_result_file, write_timeline
+from cloudtrail_cache import open_cache_from_options
+from cloudtrail_chunks import fetch_chunk_events
+from cloudtrail_cli import (
+    CACHE_OPTIONS,
+    CACHE_USAGE,
+    EXPORT_OPTIONS,
+    EXPORT_USAGE,
+    JOURNAL_FLAGS,
+    JOURNAL_OPTIONS,
+    JOURNAL_USAGE,
+    METRICS_OPTIONS,
+    METRICS_USAGE,
+    TIMELINE_OPTIONS,
+    TIMELINE_USAGE,
+    parse_cli_args,
+)
+from cloudtrail_export import open_exporter_from_options
+from cloudtrail_journal import open_journal_from_options
+from cloudtrail_metrics import run_with_metrics
+from cloudtrail_planner import build_time_chunks, plan_time_chunks
+from cloudtrail_scheduler import DEFAULT_CONCURRENCY, run_work_units
+from cloudtrail_sources import configure_event_source
 
-# 個別のCloudTrailイベントを処理する関数
-def process_cloudtrail_event(event, service_event_names):
-    event_details = json.loads(event['CloudTrailEvent'])
-    if "eventName" in event_details and "eventSource" in event_details:
-        service = event_details["eventSource"].split(".")[0].replace("amazonaws.com", "").replace("-", "")
-        event_name = event_details["eventName"]
-        # サービスごとにイベント名を分類
-        service_event_names[service].add(event_name)
 
-
-# AWS CLIコマンドを実行して結果を取得する関数
-def execute_aws_command(cmd):
-    try:
-        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-        stdout, stderr = process.communicate()
-        
-        if process.returncode != 0:
-            raise Exception(f"AWS CLIコマンド実行エラー: {stderr}")
-        
-        return json.loads(stdout)
-    except Exception as e:
-        print(f"エラー発生: {e}")
-        sys.exit(1)
-
-
-# 実行コマンド：python cloudtrail_analyzer_daterange.py IAMユーザー名 --start-date YYYY-MM-DD --end-date YYYY-MM-DD
+# 実行コマンド：python cloudtrail_events_bydate.py IAMユーザー名 --start-date YYYY-MM-DD --end-date YYYY-MM-DD [--concurrency N] [--source api|s3:パス|export:ディレクトリ|fake] [--adaptive-chunks] [--cache DBファイル] [--metrics ファイル] [--profile ファイル] [--resume] [--journal ファイル] [--timeline ファイル] [--export ディレクトリ] [--use-cli]
 def main():
     # 引数の確認
-    if len(sys.argv) != 6 or sys.argv[2] != "--start-date" or sys.argv[4] != "--end-date":
-        print("使用方法: python cloudtrail_analyzer_daterange.py IAMユーザー名 --start-date YYYY-MM-DD --end-date YYYY-MM-DD")
+    args, options = parse_cli_args(
+        sys.argv[1:],
+        value_options=("--start-date", "--end-date", "--concurrency", "--source") + CACHE_OPTIONS + METRICS_OPTIONS + JOURNAL_OPTIONS + TIMELINE_OPTIONS + EXPORT_OPTIONS,
+        flag_options=("--use-cli", "--adaptive-chunks") + JOURNAL_FLAGS,
+    )
+    if len(args) != 1 or "--start-date" not in options or "--end-date" not in options:
+        print(f"使用方法: python cloudtrail_events_bydate.py IAMユーザー名 --start-date YYYY-MM-DD --end-date YYYY-MM-DD [--concurrency N] [--source api|s3:パス|export:ディレクトリ|fake] [--adaptive-chunks] {CACHE_USAGE} {METRICS_USAGE} {JOURNAL_USAGE} {TIMELINE_USAGE} {EXPORT_USAGE} [--use-cli]")
         sys.exit(1)
     
-    iam_entity = sys.argv[1]
-    start_date = sys.argv[3]
-    end_date = sys.argv[5]
+    iam_entity = args[0]
+    start_date = options["--start-date"]
+    end_date = options["--end-date"]
+    # --use-cli 指定時のみ従来のAWS CLIサブプロセスで取得
+    use_cli = options.get("--use-cli", False)
+    # 同時に処理するチャンク数
+    concurrency = int(options.get("--concurrency", DEFAULT_CONCURRENCY))
+    # --source 指定時はLookupEvents API以外（S3エクスポートファイル・擬似データ）から取得
+    configure_event_source(options)
+    # --timeline 指定時はイベント名ごとの日別の回数も集計し、CSV/Parquetで出力する
+    timeline_path = configure_timeline(options)
+    # --export 指定時は取得したイベントを絞り込んだ列だけにして、列指向のファイルに書き出す
+    exporter = open_exporter_from_options(options)
+    # --cache 指定時は取得済みの期間をローカルキャッシュから読み出す
+    cache = open_cache_from_options(options)
+    # --adaptive-chunks 指定時はイベントの密度を調べてチャンクを分割・結合する
+    adaptive_chunks = options.get("--adaptive-chunks", False)
     
     # 日付文字列をdatetimeオブジェクトに変換
     try:
@@ -57,102 +71,69 @@ def main():
     
     # 固定パラメータ
     chunk_days = 10  # 10日ごとに分割処理
-    api_sleep_time = 0.5  # APIリクエスト間の待機時間（秒）
-    chunk_sleep_time = 30  # チャンク間の待機時間（秒）
     
     date_range = (end_time - start_time).days + 1
     print(f"分析開始: {iam_entity}の{start_date}から{end_date}までの{date_range}日間のアクティビティ")
     
+    # 進捗のジャーナル（--resume 指定時は完了済みのチャンクを飛ばし、途中のチャンクは続きのページから再開する）
+    journal = open_journal_from_options(
+        options,
+        f"cloudtrail_events_{iam_entity}_{start_date}_to_{end_date}.journal",
+        {"iam_entity": iam_entity, "start_date": start_date, "end_date": end_date, "adaptive_chunks": adaptive_chunks},
+    )
+    
     # サービスごとのイベント名収集用
-    service_event_names = defaultdict(set)
+    event_store = EventNameStore()
     total_events = 0
     
     # 時間範囲を分割して処理
-    time_chunks = []
-    chunk_start = start_time
+    time_chunks = build_time_chunks(start_time, end_time, chunk_days)
     
-    while chunk_start < end_time:
-        chunk_end = min(chunk_start + datetime.timedelta(days=chunk_days), end_time)
-        time_chunks.append((chunk_start, chunk_end))
-        chunk_start = chunk_end
+    # 計画したチャンクをジャーナルに記録する（再開時は記録した計画を使い、密度を調べ直さない）
+    plans = journal.chunk_plans()
+    if plans is None:
+        plans = [(None, plan_time_chunks(iam_entity, time_chunks, use_cli=use_cli, concurrency=concurrency) if adaptive_chunks else time_chunks)]
+        journal.record_chunk_plans(plans)
+    ((_, time_chunks),) = plans
     
-    print(f"期間を{len(time_chunks)}チャンクに分割して処理します")
+    print(f"期間を{len(time_chunks)}チャンクに分割し、最大{concurrency}並列で処理します")
     
-    for i, (chunk_start, chunk_end) in enumerate(time_chunks):
-        chunk_start_str = chunk_start.strftime("%Y-%m-%dT%H:%M:%S")
-        chunk_end_str = chunk_end.strftime("%Y-%m-%dT%H:%M:%S")
-        
-        print(f"チャンク {i+1}/{len(time_chunks)} 処理中: {chunk_start_str} から {chunk_end_str}")
-        
-        # ページネーション処理
-        next_token = None
-        page_count = 0
-        events_count = 0
-        
-        while True:
-            # AWS CLIコマンド構築
-            base_cmd = f"aws cloudtrail lookup-events --lookup-attributes AttributeKey=Username,AttributeValue={iam_entity} --start-time {chunk_start_str} --end-time {chunk_end_str}"
-            
-            if next_token:
-                cmd = f"{base_cmd} --next-token {next_token}"
-            else:
-                cmd = base_cmd
-            
-            # コマンド実行とデータ取得
-            data = execute_aws_command(cmd)
-            
-            # API呼び出しレート制限対策のためスリープを挿入
-            time.sleep(api_sleep_time)
-            
-            events = data.get("Events", [])
-            events_count += len(events)
-            page_count += 1
-            
-            if page_count % 10 == 0 or len(events) > 0:
-                print(f"  ページ {page_count} 処理完了: 累計 {events_count} イベント")
-            
-            # イベント処理
-            for event in events:
-                process_cloudtrail_event(event, service_event_names)
-            
-            # 次のトークンを取得
-            next_token = data.get("NextToken")
-            
-            # トークンがなければループ終了
-            if not next_token:
-                break
-                
-        total_events += events_count
-        print(f"チャンク {i+1} 完了: {events_count} イベント処理")
+    # チャンクごとの作業単位を同時に処理（APIレートはリージョンごとのトークンバケットで制御）
+    chunk_count = len(time_chunks)
+    units = [(i, chunk_start, chunk_end) for i, (chunk_start, chunk_end) in enumerate(time_chunks)]
     
-    # 結果作成
-    result = {}
-    for service, event_names in service_event_names.items():
-        # CloudTrailのイベント名をサービス名とともに表示
-        event_list = [f"{service}:{event_name}" for event_name in event_names]
-        result[service] = sorted(event_list)
-    
-    response = {
-        "アクセス分析結果": f"{iam_entity}の{start_date}から{end_date}までのアクティビティ",
-        "取得イベント数": total_events,
-        "サービスごとのCloudTrailイベント": result
-    }
-    
-    # 結果を保存
-    output_file = f"cloudtrail_events_{iam_entity}_{start_date}_to_{end_date}.json"
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(response, f, ensure_ascii=False, indent=2)
-    
-    print(f"分析完了: 結果を {output_file} に保存しました")
-    
-    # サービス数と総イベント数を表示
-    print(f"検出されたサービス数: {len(result)}")
-    print(f"合計イベント数: {total_events}")
+    try:
+        for (i, _, _), (events_count, chunk_event_store) in run_work_units(
+            units,
+            lambda unit: fetch_chunk_events(iam_entity, unit[0], chunk_count, unit[1], unit[2], use_cli, cache, journal, exporter),
+            concurrency,
+        ):
+            event_store.merge(chunk_event_store)
+            total_events += events_count
+            print(f"チャンク {i+1} 完了: {events_count} イベント処理")
+    except (Exception, KeyboardInterrupt) as e:
+        # 実行中のチャンクを止め、ここまでの進捗をジャーナルに残す
+        journal.stop()
+        print(f"エラー発生: {e}" if isinstance(e, Exception) else "中断されました")
+        print(f"進捗を {journal.path} に保存しました。--resume を付けて再実行すると続きから処理します")
+        journal.close()
+        if exporter is not None:
+            exporter.close()
+        sys.exit(1)
     
-    # サービスごとのイベント名数を表示
-    for service, event_names in sorted(result.items()):
-        print(f"サービス {service}: {len(event_names)}イベント")
+    # 結果作成（CloudTrailのイベント名をサービス名とともに表示）して保存
+    response = render_result(f"{iam_entity}の{start_date}から{end_date}までのアクティビティ", total_events, event_store)
+    save_result_file(f"cloudtrail_events_{iam_entity}_{start_date}_to_{end_date}.json", response)
+    if timeline_path is not None:
+        write_timeline(timeline_path, {iam_entity: event_store})
+    if exporter is not None:
+        exporter.close()
+    journal.finish()
+    
+    if cache is not None:
+        cache.print_stats()
+        cache.close()
 
 
 if __name__ == "__main__":
-    main()
+    run_with_metrics(main)
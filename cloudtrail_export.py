@@ -0,0 +1,209 @@
+import datetime
+import glob
+import os
+import sys
+import threading
+
+from cloudtrail_cli import parse_cli_args
+from cloudtrail_extract import extract_event_fields, to_epoch
+
+
+# エクスポートする列（IAMエンティティと、CloudTrailイベントから絞り込んだフィールド）
+EXPORT_COLUMNS = ("principal", "eventTime", "eventSource", "eventName", "awsRegion", "sourceIPAddress", "errorCode")
+
+# CloudTrailEvent文字列から取り出すフィールド（eventTimeはLookupEventsのEventTimeを使う）
+RECORD_FIELDS = EXPORT_COLUMNS[2:]
+
+# 出力形式と拡張子
+EXPORT_FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+# 1ファイルあたりの行数（この件数がたまるごとにファイルに書き出す）
+EXPORT_BATCH_ROWS = 100000
+
+# 圧縮方式（Parquet・Arrow IPCとも）
+EXPORT_COMPRESSION = "zstd"
+
+# 集計レポートで表示する件数
+DEFAULT_TOP = 20
+
+
+# エクスポートのスキーマを返す関数
+def export_schema():
+    import pyarrow
+
+    return pyarrow.schema(
+        [("principal", pyarrow.string()), ("eventTime", pyarrow.timestamp("ms", tz="UTC"))]
+        + [(field, pyarrow.string()) for field in RECORD_FIELDS]
+    )
+
+
+# 取得したイベントを絞り込んだ列だけにして、圧縮した列指向のファイル（Parquet / Arrow IPC）に書き出すクラス
+# 一定の行数がたまるごとに1ファイルとして書き出すため、取得中もメモリ使用量はその行数分に収まる
+# 複数のワーカースレッドから同時に追加できる
+class EventExporter:
+    def __init__(self, directory, export_format="parquet", batch_rows=EXPORT_BATCH_ROWS):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.export_format = export_format
+        self.batch_rows = batch_rows
+        self.schema = export_schema()
+        # 実行ごとに別のファイル名にする（同じディレクトリに複数回エクスポートできるように）
+        self.prefix = f"events-{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}-{os.getpid()}"
+        self.lock = threading.Lock()
+        self.rows = []
+        self.parts = 0
+        self.total_rows = 0
+
+    # LookupEvents形式のイベントのリストを追加する
+    # iam_entity が None の場合はイベントのUsernameを使い、principals を指定した場合はそれ以外のイベントを除く
+    def add_events(self, iam_entity, events, principals=None):
+        rows = []
+        for event in events:
+            if principals is not None and event.get("Username") not in principals:
+                continue
+            rows.append(
+                (iam_entity or event.get("Username"), int(to_epoch(event["EventTime"]) * 1000))
+                + extract_event_fields(event["CloudTrailEvent"], RECORD_FIELDS)
+            )
+        self.add_rows(rows)
+
+    # 絞り込み済みの行 (principal, eventTime(ミリ秒), eventSource, ...) を追加する
+    def add_rows(self, rows):
+        with self.lock:
+            self.rows.extend(rows)
+            if len(self.rows) < self.batch_rows:
+                return
+            rows, self.rows = self.rows, []
+            part = self.parts
+            self.parts += 1
+        self._write_part(part, rows)
+
+    # ページを呼び出し元に渡しながら、そのイベントを追加するジェネレータ
+    def export_pages(self, pages, iam_entity, principals=None):
+        for data in pages:
+            self.add_events(iam_entity, data.get("Events", []), principals)
+            yield data
+
+    # 1ファイル分を書き出す（書き込み途中のファイルが読まれないよう、一時ファイルから置き換える）
+    def _write_part(self, part, rows):
+        import pyarrow
+
+        columns = list(zip(*rows))
+        table = pyarrow.table(
+            [pyarrow.array(values, type=field.type) for values, field in zip(columns, self.schema)],
+            schema=self.schema,
+        )
+        path = os.path.join(self.directory, f"{self.prefix}-{part:05d}{EXPORT_FORMATS[self.export_format]}")
+        if self.export_format == "parquet":
+            import pyarrow.parquet
+
+            pyarrow.parquet.write_table(table, f"{path}.tmp", compression=EXPORT_COMPRESSION)
+        else:
+            options = pyarrow.ipc.IpcWriteOptions(compression=EXPORT_COMPRESSION)
+            with pyarrow.OSFile(f"{path}.tmp", "wb") as sink, pyarrow.ipc.new_file(sink, self.schema, options=options) as writer:
+                writer.write_table(table)
+        os.replace(f"{path}.tmp", path)
+        with self.lock:
+            self.total_rows += len(rows)
+
+    # 残りの行を書き出す
+    def close(self):
+        with self.lock:
+            rows, self.rows = self.rows, []
+            part = self.parts
+            if rows:
+                self.parts += 1
+        if rows:
+            self._write_part(part, rows)
+        print(f"イベント {self.total_rows} 件を {self.parts} ファイルに分けて {self.directory} にエクスポートしました")
+
+
+# コマンドラインオプションからエクスポートを開始する関数（--export 未指定の場合は None）
+# pyarrowは必要な場合だけ読み込み、ない場合は取得を始める前に終了する
+def open_exporter_from_options(options):
+    if "--export" not in options:
+        return None
+    export_format = options.get("--export-format", "parquet")
+    if export_format not in EXPORT_FORMATS:
+        print(f"エラー: --export-format は {' / '.join(EXPORT_FORMATS)} のいずれかを指定してください")
+        sys.exit(1)
+    try:
+        import pyarrow
+    except ImportError:
+        print("エラー: エクスポートには pyarrow が必要です（pip install pyarrow）")
+        sys.exit(1)
+    if options.get("--resume", False):
+        print("注意: 再開した実行では、中断前に処理したページのうちファイルに書き出されていない分はエクスポートされません")
+    return EventExporter(options["--export"], export_format)
+
+
+# エクスポートしたファイルの一覧を返す関数
+def find_export_files(directory):
+    paths = []
+    for suffix in EXPORT_FORMATS.values():
+        paths.extend(glob.glob(os.path.join(directory, f"*{suffix}")))
+    return sorted(paths)
+
+
+# エクスポートしたファイルをメモリマップで読み込み、1つのテーブルにする関数
+# columns を指定した場合はその列だけを読み込む
+def read_export(directory, columns=None):
+    import pyarrow
+    import pyarrow.parquet
+
+    tables = []
+    for path in find_export_files(directory):
+        if path.endswith(EXPORT_FORMATS["parquet"]):
+            tables.append(pyarrow.parquet.read_table(path, columns=columns, memory_map=True))
+        else:
+            table = pyarrow.ipc.open_file(pyarrow.memory_map(path)).read_all()
+            tables.append(table.select(columns) if columns else table)
+    if not tables:
+        schema = export_schema()
+        return schema.empty_table().select(columns) if columns else schema.empty_table()
+    return pyarrow.concat_tables(tables)
+
+
+# エクスポートしたイベントを指定した列ごとに数える関数（"date" はeventTimeのUTCの日付）
+# 戻り値: [(列の値のタプル, 件数), ...]（件数の多い順）
+def count_exported_events(directory, group_by, principal=None):
+    import pyarrow
+    import pyarrow.compute
+
+    columns = sorted({"eventTime" if column == "date" else column for column in group_by} | ({"principal"} if principal else set()))
+    table = read_export(directory, columns)
+    if principal:
+        table = table.filter(pyarrow.compute.equal(table["principal"], principal))
+    if "date" in group_by:
+        table = table.append_column("date", pyarrow.compute.cast(table["eventTime"], pyarrow.date32()))
+
+    counted = table.group_by(list(group_by)).aggregate([([], "count_all")])
+    counted = counted.sort_by([("count_all", "descending")])
+    keys = list(zip(*[counted[column].to_pylist() for column in group_by]))
+    return list(zip(keys, counted["count_all"].to_pylist()))
+
+
+# 実行コマンド：python cloudtrail_export.py エクスポートディレクトリ [--group-by 列[,列...]] [--principal IAMエンティティ名] [--top N]
+# 列: principal, date, eventSource, eventName, awsRegion, sourceIPAddress, errorCode
+def main():
+    args, options = parse_cli_args(sys.argv[1:], value_options=("--group-by", "--principal", "--top"))
+    if len(args) != 1:
+        print("使用方法: python cloudtrail_export.py エクスポートディレクトリ [--group-by 列[,列...]] [--principal IAMエンティティ名] [--top N]")
+        sys.exit(1)
+
+    group_by = tuple(options.get("--group-by", "eventSource,eventName").split(","))
+    unknown = [column for column in group_by if column != "date" and column not in EXPORT_COLUMNS]
+    if unknown:
+        print(f"エラー: 不明な列: {', '.join(unknown)}（{', '.join(('date',) + EXPORT_COLUMNS)}）")
+        sys.exit(1)
+    top = int(options.get("--top", DEFAULT_TOP))
+
+    counts = count_exported_events(args[0], group_by, options.get("--principal"))
+    total = sum(count for _, count in counts)
+    print(f"{args[0]}: {total} イベント, {len(counts)} 種類（{', '.join(group_by)} ごと）")
+    for key, count in counts[:top]:
+        print(f"  {count:>10}  {' '.join(str(value) for value in key)}")
+
+
+if __name__ == "__main__":
+    main()
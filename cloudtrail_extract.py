@@ -0,0 +1,155 @@
+import calendar
+import datetime
+import json
+import time
+from functools import lru_cache
+
+
+# CloudTrailEvent文字列（コンパクトなJSON）内のキー表現
+_EVENT_SOURCE_MARKER = '"eventSource":"'
+_EVENT_NAME_MARKER = '"eventName":"'
+
+# 任意の内容を含みうるネストしたフィールド
+# eventSource/eventNameはこれらより前に出現するため、これ以降は検索しない
+_NESTED_FIELD_MARKERS = (
+    '"requestParameters"',
+    '"responseElements"',
+    '"additionalEventData"',
+    '"serviceEventDetails"',
+)
+
+
+# markerの直後にある文字列値を取り出す関数（エスケープを含む場合はNone）
+def _find_string_value(raw, marker, limit):
+    start = raw.find(marker, 0, limit)
+    if start < 0:
+        return None
+    start += len(marker)
+    end = raw.find('"', start)
+    if end < 0 or raw.find('\\', start, end) >= 0:
+        return None
+    return raw[start:end]
+
+
+# CloudTrailEvent文字列を全てパースして eventSource と eventName を取り出す関数
+def extract_event_source_and_name_full(raw):
+    event_details = json.loads(raw)
+    if "eventName" in event_details and "eventSource" in event_details:
+        return event_details["eventSource"], event_details["eventName"]
+    return None
+
+
+# ネストしたフィールドが始まる位置（なければ文字列の長さ）を返す関数
+def _nested_fields_start(raw):
+    limit = len(raw)
+    for marker in _NESTED_FIELD_MARKERS:
+        position = raw.find(marker, 0, limit)
+        if position >= 0:
+            limit = position
+    return limit
+
+
+# CloudTrailEvent文字列から eventSource と eventName だけを取り出す関数
+# requestParameters/responseElements などの大きなフィールドはパースせず、
+# 想定外の形式（空白入りのJSON、エスケープを含む値など）の場合は全体をパースする
+def extract_event_source_and_name(raw):
+    limit = _nested_fields_start(raw)
+
+    event_source = _find_string_value(raw, _EVENT_SOURCE_MARKER, limit)
+    event_name = _find_string_value(raw, _EVENT_NAME_MARKER, limit)
+    if event_source is None or event_name is None:
+        return extract_event_source_and_name_full(raw)
+    return event_source, event_name
+
+
+# フィールド名ごとの (文字列値のキー表現, キー表現) を返す関数
+@lru_cache(maxsize=64)
+def _field_markers(fields):
+    return tuple((f'"{field}":"', f'"{field}":') for field in fields)
+
+
+# CloudTrailEvent文字列から、トップレベルの文字列フィールドの値をまとめて取り出す関数（ない場合はNone）
+# ネストしたフィールドより前にある文字列値（awsRegion、sourceIPAddress など）はパースせずに取り出し、
+# 文字列以外の値・エスケープを含む値や、ネストしたフィールドより後にあるフィールド（eventID など）は全体をパースする
+def extract_event_fields(raw, fields):
+    limit = _nested_fields_start(raw)
+    values = []
+    for string_marker, key_marker in _field_markers(fields):
+        value = _find_string_value(raw, string_marker, limit)
+        if value is None and raw.find(key_marker) >= 0:
+            event_details = json.loads(raw)
+            return tuple(event_details.get(field) for field in fields)
+        values.append(value)
+    return tuple(values)
+
+
+# eventSourceをサービス名に変換する関数（例: ssm-incidents.amazonaws.com -> ssmincidents）
+# eventSourceの種類は少ないため結果をキャッシュする
+@lru_cache(maxsize=1024)
+def normalize_service_name(event_source):
+    return event_source.split(".")[0].replace("amazonaws.com", "").replace("-", "")
+
+
+# datetime/文字列/数値の時刻をUNIX時間（秒）に変換する関数
+# タイムゾーンなしのdatetimeはboto3と同じくUTCとして扱う
+def to_epoch(value):
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            return calendar.timegm(value.timetuple()) + value.microsecond / 1e6
+        return value.timestamp()
+    if isinstance(value, (int, float)):
+        return float(value)
+    return to_epoch(datetime.datetime.fromisoformat(value.replace("Z", "+00:00")))
+
+
+# UNIX時間（秒）をタイムゾーンなし（UTC）のdatetimeに変換する関数
+def from_epoch(value):
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=value)
+
+
+# ベンチマーク用のCloudTrailEvent文字列を作成する関数
+def _build_sample_event(index, payload_size):
+    return json.dumps({
+        "eventVersion": "1.09",
+        "userIdentity": {
+            "type": "IAMUser",
+            "principalId": "AIDAEXAMPLE",
+            "arn": "arn:aws:iam::123456789012:user/example",
+            "accountId": "123456789012",
+            "userName": "example",
+        },
+        "eventTime": "2025-01-01T00:00:00Z",
+        "eventSource": ("s3.amazonaws.com", "ssm-incidents.amazonaws.com", "iam.amazonaws.com")[index % 3],
+        "eventName": f"Action{index % 40}",
+        "awsRegion": "ap-northeast-1",
+        "sourceIPAddress": "192.0.2.1",
+        "userAgent": "aws-cli/2.0",
+        "requestParameters": {"bucketName": "example", "policy": "x" * (payload_size // 2)},
+        "responseElements": {"eventSource": "nested.amazonaws.com", "body": "y" * (payload_size // 2)},
+        "requestID": "EXAMPLE",
+        "eventID": f"event-{index}",
+        "readOnly": True,
+        "eventType": "AwsApiCall",
+    }, separators=(",", ":"))
+
+
+# 全体パースと高速抽出の処理速度（イベント/秒）を表示する（結果の一致は tests/test_extract.py で確認する）
+# 実行コマンド：python cloudtrail_extract.py [イベント数] [ペイロードサイズ(バイト)]
+def main():
+    import sys
+
+    event_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    payload_size = int(sys.argv[2]) if len(sys.argv) > 2 else 4096
+    samples = [_build_sample_event(i, payload_size) for i in range(1000)]
+
+    for label, extractor in (("全体パース", extract_event_source_and_name_full),
+                             ("高速抽出", extract_event_source_and_name)):
+        started = time.perf_counter()
+        for i in range(event_count):
+            extractor(samples[i % len(samples)])
+        elapsed = time.perf_counter() - started
+        print(f"{label}: {event_count / elapsed:,.0f} イベント/秒 (ペイロード約{payload_size}バイト)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import json
+import subprocess
+import time
+import random
+import threading
+
+from cloudtrail_metrics import metrics
+from cloudtrail_scheduler import get_rate_limiter
+
+
+# スロットリングとして扱うエラーコード
+THROTTLING_ERROR_CODES = ("ThrottlingException", "RequestLimitExceeded")
+
+# LookupEventsの1ページあたりの最大件数（APIの上限）
+MAX_RESULTS_PER_PAGE = 50
+
+# AWS CLIフォールバック時の1回あたりの取得件数（CLI内部で複数ページをまとめて取得する）
+CLI_MAX_ITEMS = 1000
+
+# リージョンごとのCloudTrailクライアント（プロセス内で使い回す）
+_clients = {}
+_clients_lock = threading.Lock()
+
+# イベントの取得元（Noneの場合はboto3でLookupEventsを呼び出す）
+# cloudtrail_sources のS3エクスポートファイルや擬似データに差し替えられる
+_event_source = None
+
+
+# --accounts 指定時に、アカウントごとの認証情報と (アカウント, リージョン) ごとのクライアントを管理するプール
+# （cloudtrail_accounts.AccountPool。account を指定した取得はこのプールのクライアントで行う）
+_account_pool = None
+
+
+# イベントの取得元を差し替える関数
+def set_event_source(source):
+    global _event_source
+    _event_source = source
+
+
+# アカウントごとのクライアントのプールを設定する関数
+def set_account_pool(pool):
+    global _account_pool
+    _account_pool = pool
+
+
+# CloudTrailクライアントを作成する関数（credentials はAssumeRoleで取得した一時的な認証情報）
+def create_cloudtrail_client(region=None, credentials=None, max_pool_connections=10):
+    import boto3
+    from botocore.config import Config
+
+    # リトライは fetch_page 側で制御するため、botocore側のリトライは無効化
+    config = Config(
+        max_pool_connections=max_pool_connections,
+        retries={"max_attempts": 1, "mode": "standard"},
+    )
+    params = {}
+    if credentials:
+        params = {
+            "aws_access_key_id": credentials["AccessKeyId"],
+            "aws_secret_access_key": credentials["SecretAccessKey"],
+            "aws_session_token": credentials["SessionToken"],
+        }
+    return boto3.client("cloudtrail", region_name=region, config=config, **params)
+
+
+# リージョンごとのCloudTrailクライアントを取得する関数（account 指定時はそのアカウントのクライアント）
+# boto3クライアントは1つのHTTPコネクションプールを保持するため、ページごとにTLS接続を張り直さない
+def get_cloudtrail_client(region=None, max_pool_connections=10, account=None):
+    if account is not None:
+        return _account_pool.client(account, region)
+    key = region or "default"
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = create_cloudtrail_client(region, max_pool_connections=max_pool_connections)
+            _clients[key] = client
+    return client
+
+
+# 例外からAWSのエラーコードを取り出す関数
+def get_error_code(error):
+    response = getattr(error, "response", None) or {}
+    return response.get("Error", {}).get("Code", "")
+
+
+# スロットリングによるエラーかどうかを判定する関数
+def is_throttling_error(error):
+    if get_error_code(error) in THROTTLING_ERROR_CODES:
+        return True
+    message = str(error)
+    return any(code in message for code in THROTTLING_ERROR_CODES)
+
+
+# AWS CLIコマンドを実行して結果を取得する関数 (フォールバック用)
+def execute_aws_command(cmd):
+    started = time.perf_counter()
+    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    stdout, stderr = process.communicate()
+    metrics.observe("cli_command_seconds", time.perf_counter() - started)
+    metrics.increment("response_bytes_total", len(stdout), backend="cli")
+
+    if process.returncode != 0:
+        raise Exception(f"AWS CLIコマンド実行エラー: {stderr}")
+
+    return json.loads(stdout)
+
+
+# 検索条件（LookupAttributes）を返す関数
+# LookupEventsに指定できる条件は1つだけのため、lookup_attribute (キー, 値) を指定した場合はIAMエンティティでは絞り込まない
+# 例: ("EventName", "GetObject") / ("EventSource", "s3.amazonaws.com")
+def build_lookup_attribute(iam_entity, lookup_attribute=None):
+    if lookup_attribute:
+        return lookup_attribute
+    if iam_entity:
+        return ("Username", iam_entity)
+    return None
+
+
+# AWS CLIのlookup-eventsコマンドを組み立てる関数（iam_entityがNoneの場合は全イベントが対象）
+def build_lookup_events_command(iam_entity, start_time, end_time, region=None, next_token=None, lookup_attribute=None):
+    start_str = start_time.strftime("%Y-%m-%dT%H:%M:%S")
+    end_str = end_time.strftime("%Y-%m-%dT%H:%M:%S")
+    cmd = f"aws cloudtrail lookup-events --start-time {start_str} --end-time {end_str} --max-items {CLI_MAX_ITEMS}"
+    attribute = build_lookup_attribute(iam_entity, lookup_attribute)
+    if attribute:
+        cmd = f"{cmd} --lookup-attributes AttributeKey={attribute[0]},AttributeValue={attribute[1]}"
+    if region:
+        cmd = f"{cmd} --region {region}"
+    if next_token:
+        cmd = f"{cmd} --starting-token {next_token}"
+    return cmd
+
+
+# boto3でLookupEventsを1ページ分呼び出す関数（iam_entityがNoneの場合は全イベントが対象）
+def lookup_events_page(iam_entity, start_time, end_time, region=None, next_token=None, lookup_attribute=None, account=None):
+    params = {
+        "StartTime": start_time,
+        "EndTime": end_time,
+        "MaxResults": MAX_RESULTS_PER_PAGE,
+    }
+    attribute = build_lookup_attribute(iam_entity, lookup_attribute)
+    if attribute:
+        params["LookupAttributes"] = [
+            {
+                "AttributeKey": attribute[0],
+                "AttributeValue": attribute[1]
+            }
+        ]
+    if next_token:
+        params["NextToken"] = next_token
+
+    data = get_cloudtrail_client(region, account=account).lookup_events(**params)
+    headers = data.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    metrics.increment("response_bytes_total", int(headers.get("content-length", 0)), backend="api")
+    return data
+
+
+# 1ページ分のイベントを取得する関数 (リトライ付き)
+# リージョンごとのトークンバケットでAPIレートを制御し、
+# スロットリング時はレートを下げたうえで指数バックオフ、それ以外のエラーは待機時間を伸ばしながら再試行する
+# 呼び出しごとの処理時間、スロットリング・再試行の回数、ページ数・イベント数をリージョンごとに記録する
+# lookup_attribute を指定した場合は、IAMエンティティの代わりにその条件（EventName / EventSource）で絞り込む
+# account を指定した場合は、アカウントのプールのクライアントで取得し、アカウントごとにレートを制御する
+def fetch_page(iam_entity, start_time, end_time, region=None, next_token=None,
+               use_cli=False, max_retries=3, retry_delay=2, lookup_attribute=None, account=None):
+    # ローカルファイルなどAPI制限のない取得元ではレート制御しない
+    if account is not None or _event_source is None or _event_source.rate_limited:
+        limiter = get_rate_limiter(region, account)
+    else:
+        limiter = None
+    backend = "cli" if use_cli else ("api" if _event_source is None or account is not None else type(_event_source).__name__)
+    labels = {"region": region or "default"}
+    if account is not None:
+        labels["account"] = account
+    retries = 0
+    while True:
+        if limiter:
+            limiter.acquire()
+        started = time.perf_counter()
+        try:
+            if use_cli:
+                cmd = build_lookup_events_command(iam_entity, start_time, end_time, region, next_token, lookup_attribute)
+                data = execute_aws_command(cmd)
+            elif _event_source is not None and account is None:
+                data = _event_source.lookup_events_page(iam_entity, start_time, end_time, region, next_token, lookup_attribute)
+            else:
+                data = lookup_events_page(iam_entity, start_time, end_time, region, next_token, lookup_attribute, account)
+            metrics.observe("api_call_seconds", time.perf_counter() - started, backend=backend, **labels)
+            metrics.increment("pages_total", **labels)
+            metrics.increment("events_total", len(data.get("Events", [])), **labels)
+            if limiter:
+                limiter.on_success()
+            return data
+
+        except Exception as e:
+            metrics.observe("api_call_seconds", time.perf_counter() - started, backend=backend, **labels)
+            retries += 1
+            throttled = is_throttling_error(e)
+            metrics.increment("throttles_total" if throttled else "errors_total", **labels)
+            # 権限がない場合（AssumeRoleできないアカウントなど）は再試行しない
+            if isinstance(e, PermissionError):
+                raise
+            if retries <= max_retries:
+                metrics.increment("retries_total", **labels)
+            if throttled and limiter:
+                limiter.on_throttle()
+            if retries > max_retries:
+                raise Exception(f"最大再試行回数({max_retries})に達しました: {e}") from e
+
+            if throttled:
+                wait_time = retry_delay * (2 ** retries) + random.uniform(0, 1)
+                print(f"スロットリング検出。{wait_time:.2f}秒後に再試行します。({retries}/{max_retries})")
+            else:
+                wait_time = retry_delay * retries
+                print(f"イベント取得中にエラーが発生: {e} ({retries}/{max_retries})")
+            time.sleep(wait_time)
+
+
+# 指定期間のイベントをページ単位で返すジェネレータ
+# 返す値は {"Events": [...], "NextToken": ...} 形式（AWS CLIの出力と同じ形）
+def iter_event_pages(iam_entity, start_time, end_time, region=None, use_cli=False, next_token=None, account=None):
+    while True:
+        data = fetch_page(iam_entity, start_time, end_time, region, next_token, use_cli=use_cli, account=account)
+        yield data
+
+        # 次のトークンを取得
+        next_token = data.get("NextToken")
+
+        # トークンがなければループ終了
+        if not next_token:
+            break
@@ -0,0 +1,168 @@
+import datetime
+import json
+import os
+import sys
+import threading
+
+from cloudtrail_aggregate import EventNameStore
+
+
+# 作業単位の途中経過（前回までの実行でジャーナルに記録された内容）
+class UnitProgress:
+    def __init__(self):
+        # ラベル（IAMエンティティ名）-> [イベント数, EventNameStore]
+        self.results = {}
+        self.next_token = None
+        self.done = False
+
+    def add(self, label, events_count, event_store):
+        if label not in self.results:
+            self.results[label] = [0, EventNameStore()]
+        self.results[label][0] += events_count
+        self.results[label][1].merge(event_store)
+
+    # ラベルごとの (イベント数, EventNameStore) を返す（記録がなければ空の集計）
+    def result(self, label):
+        events_count, event_store = self.results.get(label, (0, EventNameStore()))
+        return events_count, event_store
+
+
+# 実行中の進捗を追記していくジャーナル（1行1レコードのJSON）
+# 1行目に実行条件、続けて計画したチャンク、以降に (チャンク, リージョン, IAMエンティティ) の作業単位ごとに
+# ページの集計結果と次のページのトークン、または作業単位全体の集計結果を記録する
+# 書き込みの途中でプロセスが終了しても、最後の不完全な行を無視すれば直前までの内容から再開できる
+class RunJournal:
+    def __init__(self, path, params, resume=False, run_info=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.units = {}
+        self.stopped = False
+        self.run_info = run_info or {}
+        self.resumed = False
+
+        if resume and os.path.exists(path):
+            self._load(params)
+            self.file = open(path, 'a', encoding='utf-8')
+        else:
+            if resume:
+                print(f"ジャーナル {path} がないため最初から実行します")
+            elif os.path.exists(path):
+                print(f"前回の実行のジャーナル {path} を破棄して新しく開始します（続きから実行するには --resume を指定）")
+            self.file = open(path, 'w', encoding='utf-8')
+            self._write({
+                "type": "run",
+                "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                "params": params,
+                "run_info": self.run_info,
+            }, sync=True)
+
+    def _load(self, params):
+        with open(self.path, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+
+        header = json.loads(lines[0])
+        if header["params"] != params:
+            raise ValueError(f"ジャーナル {self.path} の実行条件が今回の指定と一致しません: {header['params']}")
+        self.run_info = header["run_info"]
+        self.resumed = True
+
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 書き込み途中で中断された最後の行
+                continue
+            if record["type"] == "run_info":
+                self.run_info.update(record["run_info"])
+                continue
+            progress = self.units.setdefault(record["unit"], UnitProgress())
+            if record["type"] == "unit":
+                progress.results = {}
+            for label, (events_count, state) in record["results"].items():
+                progress.add(label, events_count, EventNameStore.from_state(state))
+            progress.next_token = record.get("next_token")
+            progress.done = record["type"] == "unit" or not progress.next_token
+
+        completed = sum(1 for progress in self.units.values() if progress.done)
+        print(f"ジャーナル {self.path} から再開します（完了済み {completed} 作業単位、途中 {len(self.units) - completed} 作業単位）")
+
+    # 1行追記してすぐにOSへ書き出す（プロセスが異常終了しても記録は残る）
+    # sync=True の場合は電源断にも備えてディスクへの書き込みを待つ（作業単位の完了時のみ）
+    def _write(self, record, sync=False):
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self.lock:
+            if self.file.closed:
+                # 中断後に実行中の作業単位から届いた記録（再開時はその前のページから取得し直す）
+                return
+            self.file.write(line + "\n")
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
+
+    # 計画したチャンクを記録する（再開時は記録した計画を使い、イベントの密度を調べ直さない）
+    # plans: [(キー, [(チャンク開始, チャンク終了), ...]), ...]
+    def record_chunk_plans(self, plans):
+        run_info = {"chunk_plans": [[key, [[chunk_start.isoformat(), chunk_end.isoformat()] for chunk_start, chunk_end in chunks]]
+                                    for key, chunks in plans]}
+        self.run_info.update(run_info)
+        self._write({"type": "run_info", "run_info": run_info}, sync=True)
+
+    # 記録した計画を返す（記録がない場合は None）
+    def chunk_plans(self):
+        if "chunk_plans" not in self.run_info:
+            return None
+        return [
+            (tuple(key) if isinstance(key, list) else key,
+             [(datetime.datetime.fromisoformat(chunk_start), datetime.datetime.fromisoformat(chunk_end)) for chunk_start, chunk_end in chunks])
+            for key, chunks in self.run_info["chunk_plans"]
+        ]
+
+    # 作業単位の途中経過を返す
+    def progress(self, unit_key):
+        return self.units.get(unit_key) or UnitProgress()
+
+    # 1ページ分の集計結果と次のページのトークンを記録する（トークンがなければ作業単位の完了）
+    # results: {ラベル: (イベント数, EventNameStore)}
+    def record_page(self, unit_key, next_token, results):
+        self._write({
+            "type": "page",
+            "unit": unit_key,
+            "next_token": next_token,
+            "results": {label: [events_count, event_store.to_state()] for label, (events_count, event_store) in results.items()},
+        }, sync=not next_token)
+
+    # 作業単位全体の集計結果を記録する（キャッシュ使用時など、ページ単位で再開できない場合）
+    def record_unit(self, unit_key, results):
+        self._write({
+            "type": "unit",
+            "unit": unit_key,
+            "results": {label: [events_count, event_store.to_state()] for label, (events_count, event_store) in results.items()},
+        }, sync=True)
+
+    # Ctrl-Cなどで中断する際に、実行中の作業単位を次のページで止める
+    def stop(self):
+        self.stopped = True
+
+    def check_stopped(self):
+        if self.stopped:
+            raise KeyboardInterrupt("中断されました")
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    # 全ての作業単位が完了して結果を保存した後に、ジャーナルを削除する
+    def finish(self):
+        self.close()
+        os.remove(self.path)
+
+
+# コマンドラインオプションからジャーナルを開く関数
+# --journal 未指定の場合は結果ファイル名をもとにしたパスを使い、--resume 指定時は前回の続きから再開する
+def open_journal_from_options(options, default_path, params, run_info=None):
+    path = options.get("--journal", default_path)
+    try:
+        return RunJournal(path, params, options.get("--resume", False), run_info)
+    except ValueError as e:
+        print(f"エラー: {e}")
+        sys.exit(1)
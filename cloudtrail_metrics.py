@@ -0,0 +1,231 @@
+import json
+import sys
+import threading
+import time
+from bisect import bisect_left
+
+
+# 処理時間のヒストグラムのバケット（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Prometheusのメトリクス名の接頭辞
+PROMETHEUS_PREFIX = "cloudtrail_"
+
+# --profile 指定時に表示する関数の数（累積時間の上位）
+PROFILE_TOP_FUNCTIONS = 25
+
+
+# 1つのラベルの組み合わせに対する処理時間の分布
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+# カウンタとヒストグラムをラベル（リージョンなど）ごとに保持するレジストリ
+# 複数スレッドの作業単位から同時に記録されるため、ロックで保護する
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+            self.started = time.time()
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    # 指定したラベルでカウンタを合計する（例: リージョンごとのページ数）
+    def totals(self, name, label):
+        totals = {}
+        with self.lock:
+            for (metric_name, labels), value in self.counters.items():
+                if metric_name == name:
+                    key = dict(labels).get(label)
+                    totals[key] = totals.get(key, 0) + value
+        return totals
+
+    # 記録内容を1件1行のJSONに変換する
+    def to_json_lines(self):
+        timestamp = time.time()
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(json.dumps({"timestamp": timestamp, "type": "counter", "name": name,
+                                         "labels": dict(labels), "value": value}, ensure_ascii=False))
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                lines.append(json.dumps({
+                    "timestamp": timestamp,
+                    "type": "histogram",
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": histogram.count,
+                    "sum": histogram.sum,
+                    "max": histogram.max,
+                    "buckets": dict(zip([str(bound) for bound in histogram.buckets] + ["+Inf"], histogram.counts)),
+                }, ensure_ascii=False))
+        return lines
+
+    # 記録内容をPrometheusのテキスト形式（node_exporterのtextfile collector用）に変換する
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = f"{PROMETHEUS_PREFIX}{name}"
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} counter")
+                    typed.add(metric)
+                lines.append(f"{metric}{_format_labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                metric = f"{PROMETHEUS_PREFIX}{name}"
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} histogram")
+                    typed.add(metric)
+                cumulative = 0
+                for bound, count in zip([str(bound) for bound in histogram.buckets] + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f"{metric}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{metric}_sum{_format_labels(labels)} {histogram.sum}")
+                lines.append(f"{metric}_count{_format_labels(labels)} {histogram.count}")
+        return lines
+
+    # 記録内容をCloudWatchの埋め込みメトリクス形式（EMF）に変換する（ラベルの組み合わせごとに1行）
+    def to_emf(self, namespace, dimensions=None):
+        dimensions = dimensions or {}
+        groups = {}
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                unit = "Seconds" if name.endswith("_seconds_total") else "Count"
+                groups.setdefault(labels, []).append((name, unit, value))
+            for (name, labels), histogram in self.histograms.items():
+                groups.setdefault(labels, []).extend([
+                    (f"{name}_sum", "Seconds", histogram.sum),
+                    (f"{name}_max", "Seconds", histogram.max),
+                    (f"{name}_count", "Count", histogram.count),
+                ])
+
+        lines = []
+        timestamp = int(time.time() * 1000)
+        for labels, values in sorted(groups.items()):
+            record = {**dimensions, **dict(labels)}
+            record["_aws"] = {
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [{
+                    "Namespace": namespace,
+                    "Dimensions": [sorted(set(dimensions) | {label for label, _ in labels})],
+                    "Metrics": [{"Name": name, "Unit": unit} for name, unit, _ in values],
+                }],
+            }
+            for name, _, value in values:
+                record[name] = value
+            lines.append(json.dumps(record, ensure_ascii=False))
+        return lines
+
+
+# Prometheusのラベル表記に変換する関数
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+# プロセス全体で共有するメトリクス
+metrics = MetricsRegistry()
+
+
+# メトリクスをファイルに書き出す関数（拡張子 .prom の場合はPrometheus形式、それ以外はJSON Lines）
+def write_metrics(path, registry=metrics):
+    lines = registry.to_prometheus() if path.endswith(".prom") else registry.to_json_lines()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    print(f"メトリクスを {path} に保存しました")
+
+
+# リージョンごとの取得状況（API呼び出し・スロットリング・再試行・イベント/秒）を表示する関数
+def print_metrics_summary(registry=metrics):
+    elapsed = max(time.time() - registry.started, 1e-9)
+    pages = registry.totals("pages_total", "region")
+    events = registry.totals("events_total", "region")
+    throttles = registry.totals("throttles_total", "region")
+    retries = registry.totals("retries_total", "region")
+
+    print("リージョンごとの取得状況:")
+    for region in sorted(pages, key=str):
+        with registry.lock:
+            latencies = [histogram for (name, labels), histogram in registry.histograms.items()
+                         if name == "api_call_seconds" and dict(labels).get("region") == region]
+        calls = sum(histogram.count for histogram in latencies)
+        average = sum(histogram.sum for histogram in latencies) / calls if calls else 0.0
+        print(f"  {region or 'default'}: {pages[region]} ページ, {events.get(region, 0)} イベント, "
+              f"平均 {average * 1000:.0f}ms/呼び出し, スロットリング {throttles.get(region, 0)} 回, 再試行 {retries.get(region, 0)} 回")
+
+    parse_seconds = sum(registry.totals("parse_seconds_total", "region").values())
+    total_events = sum(events.values())
+    print(f"合計 {total_events} イベント（{total_events / elapsed:,.0f} イベント/秒, 解析 {parse_seconds:.2f}秒）")
+
+
+# --metrics / --profile を処理したうえで main を実行する関数
+# --profile 指定時はcProfileで実行し（ワーカースレッドを含む）、統計をファイルに保存して累積時間の上位を表示する
+def run_with_metrics(main, argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    options = {}
+    for name in ("--metrics", "--profile"):
+        if name in argv[:-1]:
+            options[name] = argv[argv.index(name) + 1]
+
+    profiles = []
+    if "--profile" in options:
+        import cProfile
+
+        # 作業単位を処理するワーカースレッドも、スレッドごとのプロファイラで計測する
+        def profile_thread(*_):
+            sys.setprofile(None)
+            thread_profile = cProfile.Profile()
+            try:
+                thread_profile.enable()
+            except ValueError:
+                # Python 3.12以降はメインスレッドのプロファイラが全スレッドを計測する
+                return
+            profiles.append(thread_profile)
+
+        profiles.append(cProfile.Profile())
+        profiles[0].enable()
+        threading.setprofile(profile_thread)
+
+    try:
+        main()
+    finally:
+        if profiles:
+            import pstats
+            threading.setprofile(None)
+            profiles[0].disable()
+            stats = pstats.Stats(*profiles)
+            stats.dump_stats(options["--profile"])
+            print(f"プロファイルを {options['--profile']} に保存しました（累積時間の上位{PROFILE_TOP_FUNCTIONS}件）")
+            stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+        if "--metrics" in options:
+            print_metrics_summary()
+            write_metrics(options["--metrics"])
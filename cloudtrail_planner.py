@@ -0,0 +1,110 @@
+import datetime
+import math
+
+from cloudtrail_extract import to_epoch
+from cloudtrail_fetcher import fetch_page
+from cloudtrail_scheduler import DEFAULT_CONCURRENCY, run_work_units
+
+
+# 1つの作業単位に含めるイベント数の目安（LookupEventsで約40ページ分）
+DEFAULT_TARGET_EVENTS = 2000
+
+# 1つのチャンクを分割する最大数
+DEFAULT_MAX_SPLIT = 16
+
+# 隣接するチャンクの間隔
+# LookupEventsの開始・終了時刻はどちらも範囲に含まれるため、境界を共有すると境界の秒のイベントを両方のチャンクで取得してしまう
+# CloudTrailのイベント時刻は秒単位のため、前のチャンクを境界の1秒前で終えれば取りこぼしも重複もない
+CHUNK_GAP = datetime.timedelta(seconds=1)
+
+
+# 境界の時刻から、前のチャンクの終了時刻と次のチャンクの開始時刻を返す関数（境界は秒単位に切り捨てる）
+def split_at(boundary):
+    next_start = boundary.replace(microsecond=0)
+    return next_start - CHUNK_GAP, next_start
+
+
+# 期間を chunk_days 日ごとのチャンク [(開始, 終了), ...] に分割する関数（チャンク同士は重ならない）
+# 開始・終了は秒単位に切り捨てる（開始と終了が同じ秒の場合は1秒のチャンクになる）
+def build_time_chunks(start_time, end_time, chunk_days):
+    start_time = start_time.replace(microsecond=0)
+    end_time = end_time.replace(microsecond=0)
+    time_chunks = []
+    chunk_start = start_time
+    while chunk_start <= end_time:
+        boundary = chunk_start + datetime.timedelta(days=chunk_days)
+        if boundary >= end_time:
+            time_chunks.append((chunk_start, end_time))
+            break
+        chunk_end, next_start = split_at(boundary)
+        time_chunks.append((chunk_start, chunk_end))
+        chunk_start = next_start
+    return time_chunks
+
+
+# 期間の先頭ページを取得して、期間内のイベント数を推定する関数
+# LookupEventsは新しいイベントから返すため、先頭ページがカバーする時間幅から密度を求める
+def estimate_window_events(iam_entity, start_time, end_time, region=None, use_cli=False, account=None):
+    data = fetch_page(iam_entity, start_time, end_time, region, use_cli=use_cli, account=account)
+    events = data.get("Events", [])
+    if not data.get("NextToken") or not events:
+        return len(events)
+
+    window_seconds = to_epoch(end_time) - to_epoch(start_time)
+    oldest = min(to_epoch(event["EventTime"]) for event in events)
+    covered_seconds = max(to_epoch(end_time) - oldest, 1.0)
+    # 先頭ページより多いことは確実なので、推定値の下限は1ページ分+1件とする
+    return max(len(events) + 1, int(len(events) * window_seconds / covered_seconds))
+
+
+# 推定イベント数をもとに作業単位を計画する関数
+# estimates: [(開始, 終了, 推定イベント数), ...]（時系列順）
+# 密なチャンクは目安の件数になるよう等分し、隣接する疎なチャンクは目安を超えない範囲でまとめる
+# （等分した作業単位も build_time_chunks と同じく重ならないようにする）
+def plan_chunks(estimates, target_events=DEFAULT_TARGET_EVENTS, max_split=DEFAULT_MAX_SPLIT):
+    plan = []
+    pending = None
+
+    for start, end, estimate in estimates:
+        if estimate > target_events:
+            if pending:
+                plan.append(pending)
+                pending = None
+            pieces = min(max_split, math.ceil(estimate / target_events))
+            step = (end - start) / pieces
+            piece_start = start
+            for i in range(pieces):
+                if i == pieces - 1:
+                    piece_end, next_start = end, None
+                else:
+                    piece_end, next_start = split_at(start + step * (i + 1))
+                plan.append((piece_start, piece_end, estimate / pieces))
+                piece_start = next_start
+        elif pending and pending[1] + CHUNK_GAP == start and pending[2] + estimate <= target_events:
+            pending = (pending[0], end, pending[2] + estimate)
+        else:
+            if pending:
+                plan.append(pending)
+            pending = (start, end, estimate)
+
+    if pending:
+        plan.append(pending)
+    return plan
+
+
+# チャンクごとの密度を並列に調べて作業単位の計画を作成し、計画内容を表示する関数
+def plan_time_chunks(iam_entity, time_chunks, region=None, use_cli=False,
+                     target_events=DEFAULT_TARGET_EVENTS, concurrency=DEFAULT_CONCURRENCY, account=None):
+    estimates = dict(run_work_units(
+        time_chunks,
+        lambda chunk: estimate_window_events(iam_entity, chunk[0], chunk[1], region, use_cli, account),
+        concurrency,
+    ))
+    plan = plan_chunks([(start, end, estimates[(start, end)]) for start, end in time_chunks], target_events)
+
+    label = " / ".join(name for name in (account, iam_entity, region) if name) or "全イベント"
+    print(f"チャンク計画（{label}）: {len(time_chunks)}チャンク -> {len(plan)}作業単位")
+    for start, end, estimate in plan:
+        print(f"  {start.strftime('%Y-%m-%dT%H:%M:%S')} から {end.strftime('%Y-%m-%dT%H:%M:%S')}: 推定 {int(estimate)} イベント")
+
+    return [(start, end) for start, end, _ in plan]
@@ -0,0 +1,240 @@
+import json
+import os
+import re
+import sys
+import time
+from functools import lru_cache
+
+from cloudtrail_aggregate import DETAILS_KEY
+from cloudtrail_cli import parse_cli_args
+from cloudtrail_extract import normalize_service_name
+
+
+# eventSource/eventName から IAMアクションへの対応表（編集用のJSON。ctinspect パッケージのデータとして配布する）
+MAPPING_PACKAGE = "ctinspect"
+MAPPING_RESOURCE = "cloudtrail_iam_mapping.json"
+
+# 管理ポリシーの最大サイズ（空白を除いた文字数）
+POLICY_SIZE_LIMIT = 6144
+
+# 分析結果ファイルでイベント名の一覧を持つキー（ローカルスクリプト / Lambda）
+RESULT_KEYS = ("サービスごとのCloudTrailイベント", "サービスごとのアクション")
+
+# 対応表のJSONを読み込む関数（mapping_path 未指定の場合はパッケージのデータを読み込む）
+def load_mapping(mapping_path=None):
+    if mapping_path is None:
+        from importlib import resources
+        return json.loads(resources.files(MAPPING_PACKAGE).joinpath(MAPPING_RESOURCE).read_text(encoding='utf-8'))
+    with open(mapping_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+# 対応表のJSONを、サービス名（normalize_service_name の結果）をキーとする索引にコンパイルする関数
+# 分析結果はeventSourceではなくサービス名で記録されているため、サービス名から引けるようにする
+def build_index(mapping_path=None):
+    mapping = load_mapping(mapping_path)
+
+    index = {
+        "prefixes": {},
+        "actions": {},
+        "suffixes": {},
+        "verbs": {},
+        "catalogs": {prefix: frozenset(actions) for prefix, actions in mapping.get("catalogs", {}).items()},
+    }
+    for event_source, prefix in mapping.get("services", {}).items():
+        index["prefixes"][normalize_service_name(event_source)] = prefix
+    for event_source, actions in mapping.get("actions", {}).items():
+        service = normalize_service_name(event_source)
+        for event_name, iam_actions in actions.items():
+            index["actions"][(service, event_name)] = tuple(iam_actions)
+    for event_source, pattern in mapping.get("event_name_suffixes", {}).items():
+        index["suffixes"][normalize_service_name(event_source)] = re.compile(pattern)
+    for event_source, verbs in mapping.get("event_name_verbs", {}).items():
+        # 長い接頭辞から順に照合する（Update と Untag など）
+        index["verbs"][normalize_service_name(event_source)] = sorted(verbs.items(), key=lambda item: -len(item[0]))
+    return index
+
+
+# 索引を返す関数（初めて必要になったときに対応表からコンパイルし、同じプロセスでは再利用する）
+# 索引はファイルに保存しない（インストール先に書き込まず、書き込み可能な場所からpickleを読み込まないため）
+@lru_cache(maxsize=None)
+def load_index():
+    return build_index()
+
+
+# サービス名とイベント名から、必要なIAMアクションのタプルを返す関数
+# 対応表にあればその内容、なければ接尾辞の除去や動詞の変換を行い、それ以外は「IAMの接頭辞:イベント名」とする
+# 対応が決められない場合は None、権限が不要なイベント（GetCallerIdentity など）は空のタプルを返す
+@lru_cache(maxsize=65536)
+def map_event_to_actions(service, event_name):
+    index = load_index()
+    actions = index["actions"].get((service, event_name))
+    if actions is not None:
+        return actions
+
+    prefix = index["prefixes"].get(service, service)
+    suffix = index["suffixes"].get(service)
+    if suffix is not None:
+        # Lambda の GetFunction20150331v2 など、APIバージョンの付いたイベント名
+        event_name = suffix.sub("", event_name)
+        actions = index["actions"].get((service, event_name))
+        if actions is not None:
+            return actions
+
+    verbs = index["verbs"].get(service)
+    if verbs is not None:
+        # API Gateway の管理操作は HTTPメソッドのアクション（apigateway:GET など）
+        for verb, method in verbs:
+            if event_name.startswith(verb):
+                return (f"{prefix}:{method}",)
+        return None
+
+    return (f"{prefix}:{event_name}",)
+
+
+# アクション名の単語の区切り（大文字の始まり）までの接頭辞を返す関数（例: DescribeInstances -> Describe, DescribeInstances）
+def _word_prefixes(action):
+    boundaries = [i for i in range(1, len(action)) if action[i].isupper() and not action[i - 1].isupper()]
+    return [action[:i] for i in boundaries] + [action]
+
+
+# 1つのサービスのアクションを、安全な場合だけワイルドカードにまとめる関数
+# 安全: そのサービスのアクション一覧（catalog）のうち、ワイルドカードに一致するものが全て使用済みであること
+# （一覧にないアクションは許可が広がらないとは言えないため、そのまま残す）
+def group_actions(prefix, actions, catalog):
+    if not catalog:
+        return sorted(f"{prefix}:{action}" for action in actions)
+    if catalog <= actions:
+        return [f"{prefix}:*"]
+
+    grouped = []
+    covered = set()
+    for action in sorted(actions):
+        if action in covered:
+            continue
+        if action in catalog:
+            for word_prefix in _word_prefixes(action)[:-1]:
+                matched = {name for name in catalog if name.startswith(word_prefix)}
+                if len(matched) > 1 and matched <= actions:
+                    grouped.append(f"{prefix}:{word_prefix}*")
+                    covered |= matched
+                    break
+            else:
+                grouped.append(f"{prefix}:{action}")
+        else:
+            grouped.append(f"{prefix}:{action}")
+    return sorted(grouped)
+
+
+# 「サービス名:イベント名」の一覧からIAMポリシーを作成する関数
+# 戻り値: (ポリシー, 対応が決められなかったイベント名, 権限が不要なイベント名)
+def generate_policy(service_event_names, catalogs=None, wildcards=True):
+    index = load_index()
+    catalogs = {**index["catalogs"], **(catalogs or {})}
+
+    # IAMの接頭辞ごとのアクション名
+    prefix_actions = {}
+    unmapped = []
+    no_permission = []
+    for service_event_name in sorted(service_event_names):
+        service, _, event_name = service_event_name.partition(":")
+        actions = map_event_to_actions(service, event_name)
+        if actions is None:
+            unmapped.append(service_event_name)
+            continue
+        if not actions:
+            no_permission.append(service_event_name)
+        for action in actions:
+            prefix, _, name = action.partition(":")
+            prefix_actions.setdefault(prefix, set()).add(name)
+
+    statement_actions = []
+    for prefix, actions in sorted(prefix_actions.items()):
+        catalog = catalogs.get(prefix) if wildcards else None
+        statement_actions.extend(group_actions(prefix, actions, catalog))
+
+    policy = {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Effect": "Allow",
+                "Action": statement_actions,
+                "Resource": "*"
+            }
+        ]
+    }
+    return policy, unmapped, no_permission
+
+
+# 分析結果ファイルから「サービス名:イベント名」の一覧を読み込む関数
+def load_result_event_names(path):
+    with open(path, encoding='utf-8') as f:
+        result = json.load(f)
+
+    if DETAILS_KEY in result:
+        return set(result[DETAILS_KEY])
+    for key in RESULT_KEYS:
+        if key in result:
+            return {name for names in result[key].values() for name in names}
+    raise ValueError(f"{path} に分析結果（{', '.join(RESULT_KEYS)}）がありません")
+
+
+# 追加のアクション一覧（{"IAMの接頭辞": ["アクション名", ...]}）を読み込む関数
+def load_catalogs(path):
+    with open(path, encoding='utf-8') as f:
+        return {prefix: frozenset(actions) for prefix, actions in json.load(f).items()}
+
+
+# 実行コマンド：python cloudtrail_policy.py 分析結果ファイル [...] [--output-dir ディレクトリ] [--catalog ファイル] [--no-wildcards]
+def main():
+    args, options = parse_cli_args(
+        sys.argv[1:],
+        value_options=("--output-dir", "--catalog"),
+        flag_options=("--no-wildcards",),
+    )
+
+    if not args:
+        print("使用方法: python cloudtrail_policy.py 分析結果ファイル [...] [--output-dir ディレクトリ] [--catalog ファイル] [--no-wildcards]")
+        sys.exit(1)
+
+    catalogs = load_catalogs(options["--catalog"]) if "--catalog" in options else None
+    wildcards = not options.get("--no-wildcards", False)
+    output_dir = options.get("--output-dir")
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    started = time.perf_counter()
+    for path in args:
+        try:
+            service_event_names = load_result_event_names(path)
+        except (OSError, ValueError) as e:
+            print(f"警告: {e}")
+            continue
+
+        policy, unmapped, no_permission = generate_policy(service_event_names, catalogs, wildcards)
+        actions = policy["Statement"][0]["Action"]
+        if not actions:
+            print(f"{path}: 許可が必要なアクションがないため、ポリシーを作成しません")
+            continue
+
+        output_file = os.path.splitext(path)[0] + "_policy.json"
+        if output_dir:
+            output_file = os.path.join(output_dir, os.path.basename(output_file))
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(policy, f, ensure_ascii=False, indent=4)
+
+        print(f"{path}: イベント名 {len(service_event_names)} 件 -> アクション {len(actions)} 件を {output_file} に保存しました")
+        if no_permission:
+            print(f"  権限が不要なイベント: {', '.join(no_permission)}")
+        if unmapped:
+            print(f"  対応するIAMアクションが不明なイベント（ポリシーに含めていません）: {', '.join(unmapped)}")
+        size = len(json.dumps(policy, separators=(",", ":")))
+        if size > POLICY_SIZE_LIMIT:
+            print(f"  警告: ポリシーのサイズ（{size}文字）が管理ポリシーの上限（{POLICY_SIZE_LIMIT}文字）を超えています")
+
+    elapsed = time.perf_counter() - started
+    print(f"{len(args)}件の分析結果を処理しました（{elapsed:.2f}秒）")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import datetime
+import sys
+import time
+
+from cloudtrail_aggregate import EventNameStore
+from cloudtrail_extract import extract_event_source_and_name, normalize_service_name
+
+
+# IAMエンティティの検索で最初に取得するページ数（この中で取得し終われば全件を取得したことになる）
+DEFAULT_SAMPLE_PAGES = 3
+
+# 候補のイベントごとに確認するページ数（見つかった時点でそれ以上は取得しない）
+DEFAULT_VERIFY_PAGES = 1
+
+# 結果に含まれるイベント名の範囲（全件を取得しなかった場合、サンプルにも候補にもないイベント名は検出できないため下限になる）
+COVERAGE_COMPLETE = "全件（使用したイベント名をすべて含む）"
+COVERAGE_LOWER_BOUND = "下限（サンプルにも候補にもないイベント名は含まれない場合があります）"
+
+
+# IAMエンティティが使用したイベント名を、全イベントを取得せずに調べる関数
+# lookup(lookup_attribute, next_token) は1ページ分のLookupEventsの結果を返す関数
+# （lookup_attribute は ("Username", 名前) / ("EventSource", 値) / ("EventName", 値)、None は全イベント）
+#
+# 1. IAMエンティティで検索した最初の sample_pages ページから、使用したイベント名を集める
+#    （大量に呼び出されるイベントはここで見つかる。この中で最後のページまで取得できれば全件の結果と同じ）
+# 2. 絞り込まない最初の sample_pages ページと candidates（"サービス名:イベント名"）から、まだ見つかっていない候補を作る
+# 3. 候補のeventSourceごとに EventSource で検索し、IAMエンティティのイベントがあれば使用したイベント名に加える
+# 4. 残った候補を EventName で検索し、IAMエンティティのイベントが見つかった時点で次の候補に進む
+# 候補は3・4とも verify_pages ページまで確認し、それでも見つからなかった候補は「確認できなかった候補」として返す
+# 戻り値: (EventNameStore, 確認できなかった候補, API呼び出し回数, 全件を取得したかどうか)
+# EventNameStore の回数・日時は確認に使ったイベントだけのもの
+# 全件を取得しなかった場合、結果は使用したイベント名の下限（「確認できなかった候補」がなくても見落としがありうる）
+def find_distinct_actions(lookup, iam_entity, candidates=(), sample_pages=DEFAULT_SAMPLE_PAGES, verify_pages=DEFAULT_VERIFY_PAGES):
+    event_store = EventNameStore()
+    # "サービス名:イベント名" -> eventSource（結果ファイルから読み込んだ候補は None）
+    candidate_sources = dict.fromkeys(candidates)
+    api_calls = 0
+
+    # 1. IAMエンティティで検索したサンプル
+    next_token = None
+    for _ in range(sample_pages):
+        data = lookup(("Username", iam_entity), next_token)
+        api_calls += 1
+        for event in data.get("Events", []):
+            event_store.add_event(event)
+        next_token = data.get("NextToken")
+        if not next_token:
+            return event_store, [], api_calls, True
+
+    # 2. 絞り込まないサンプルから候補を集める
+    next_token = None
+    for _ in range(sample_pages):
+        data = lookup(None, next_token)
+        api_calls += 1
+        for event in data.get("Events", []):
+            extracted = extract_event_source_and_name(event["CloudTrailEvent"])
+            if not extracted:
+                continue
+            if event.get("Username") == iam_entity:
+                event_store.add(extracted[0], extracted[1], event.get("EventTime"))
+            candidate_sources[f"{normalize_service_name(extracted[0])}:{extracted[1]}"] = extracted[0]
+        next_token = data.get("NextToken")
+        if not next_token:
+            break
+
+    found = set(event_store.render_details())
+    remaining = {key: event_source for key, event_source in candidate_sources.items() if key not in found}
+
+    # 3. eventSourceごとの確認（1回の検索で同じサービスの複数の候補を確認できる）
+    for event_source in sorted({event_source for event_source in remaining.values() if event_source}):
+        next_token = None
+        for _ in range(verify_pages):
+            data = lookup(("EventSource", event_source), next_token)
+            api_calls += 1
+            for event in data.get("Events", []):
+                if event.get("Username") == iam_entity:
+                    event_store.add_event(event)
+            found = set(event_store.render_details())
+            next_token = data.get("NextToken")
+            if not next_token or all(key in found for key, source in remaining.items() if source == event_source):
+                break
+    remaining = {key: event_source for key, event_source in remaining.items() if key not in found}
+
+    # 4. イベント名ごとの確認（IAMエンティティのイベントが見つかった時点で打ち切る）
+    unconfirmed = []
+    for key in sorted(remaining):
+        service, _, event_name = key.partition(":")
+        next_token = None
+        hit = False
+        for _ in range(verify_pages):
+            data = lookup(("EventName", event_name), next_token)
+            api_calls += 1
+            for event in data.get("Events", []):
+                if event.get("Username") != iam_entity:
+                    continue
+                extracted = extract_event_source_and_name(event["CloudTrailEvent"])
+                if extracted and normalize_service_name(extracted[0]) == service:
+                    event_store.add(extracted[0], extracted[1], event.get("EventTime"))
+                    hit = True
+            next_token = data.get("NextToken")
+            if hit or not next_token:
+                break
+        if not hit:
+            unconfirmed.append(key)
+
+    return event_store, unconfirmed, api_calls, False
+
+
+# 使用の有無だけの分析結果を作成する関数
+def render_presence_result(description, event_store, unconfirmed, api_calls, complete):
+    return {
+        "アクセス分析結果": description,
+        "確認方法": "全件取得" if complete else "サンプルと検索条件（EventSource / EventName）による確認",
+        "結果の範囲": COVERAGE_COMPLETE if complete else COVERAGE_LOWER_BOUND,
+        "API呼び出し回数": api_calls,
+        "サービスごとのCloudTrailイベント": event_store.render(),
+        "確認できなかった候補": unconfirmed,
+    }
+
+
+# 擬似データ（少数のイベントを大量に呼び出すロール）で、全件取得と使用の有無の確認のAPI呼び出し回数を比較する
+# 実行コマンド：python cloudtrail_presence.py [1日あたりのイベント数] [日数] [大量に呼び出すイベントの割合]
+def main():
+    from cloudtrail_sources import FakeEventSource
+
+    events_per_day = float(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    days = int(sys.argv[2]) if len(sys.argv) > 2 else 7
+    hot_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.99
+    iam_entity = "heavy-role"
+
+    source = FakeEventSource(events_per_day=events_per_day, principals=(iam_entity, "other-user"), hot_rate=hot_rate)
+    end_time = datetime.datetime(2025, 1, 1) + datetime.timedelta(days=days)
+    start_time = end_time - datetime.timedelta(days=days)
+
+    def lookup(lookup_attribute, next_token):
+        return source.lookup_events_page(None, start_time, end_time, None, next_token, lookup_attribute)
+
+    # 全件取得
+    started = time.perf_counter()
+    full_store = EventNameStore()
+    next_token = None
+    full_calls = 0
+    while True:
+        data = lookup(("Username", iam_entity), next_token)
+        full_calls += 1
+        for event in data.get("Events", []):
+            full_store.add_event(event)
+        next_token = data.get("NextToken")
+        if not next_token:
+            break
+    full_actions = set(full_store.render_details())
+    print(f"全件取得: API呼び出し {full_calls}回, イベント名 {len(full_actions)}種類 ({time.perf_counter() - started:.2f}秒)")
+
+    # サンプルのみ / 前回の結果のイベント名を候補にした場合
+    for label, candidates in (("サンプルのみ", ()), ("前回の結果を候補に指定", sorted(full_actions))):
+        started = time.perf_counter()
+        event_store, unconfirmed, api_calls, complete = find_distinct_actions(lookup, iam_entity, candidates)
+        actions = set(event_store.render_details())
+        print(f"使用の有無（{label}）: API呼び出し {api_calls}回 (x{full_calls / api_calls:.1f}削減), "
+              f"イベント名 {len(actions & full_actions)}/{len(full_actions)}種類（{'全件' if complete else '下限'}）, "
+              f"確認できなかった候補 {len(unconfirmed)}件 ({time.perf_counter() - started:.2f}秒)")
+
+
+if __name__ == "__main__":
+    main()
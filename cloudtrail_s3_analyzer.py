@@ -0,0 +1,161 @@
+import json
+import gzip
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import sys
+
+from cloudtrail_aggregate import EventNameStore, configure_timeline, render_result, save_result_file, set_daily_counts, write_timeline
+from cloudtrail_cli import EXPORT_OPTIONS, EXPORT_USAGE, TIMELINE_OPTIONS, TIMELINE_USAGE, load_principals, parse_cli_args
+from cloudtrail_export import RECORD_FIELDS, open_exporter_from_options
+from cloudtrail_extract import to_epoch
+
+
+# 対象の名前を含むかどうかでファイルを読み飛ばす判定を行う最大の対象数
+PREFILTER_MAX_PRINCIPALS = 8
+
+
+# CloudTrailログのレコードの主体を表す名前の一覧を返す関数
+# LookupEventsのUsername属性と同様に、IAMユーザー名・ロール名・セッション名を対象とする
+def record_principal_names(record):
+    user_identity = record.get("userIdentity") or {}
+    session_issuer = (user_identity.get("sessionContext") or {}).get("sessionIssuer") or {}
+    arn = user_identity.get("arn") or ""
+    return {
+        user_identity.get("userName"),
+        session_issuer.get("userName"),
+        arn.rsplit("/", 1)[-1] or None,
+    }
+
+
+# 個別のCloudTrailレコードを処理する関数
+def process_cloudtrail_record(record, event_store):
+    if "eventName" in record and "eventSource" in record:
+        # サービスごとにイベント名を分類（回数と初回・最終の日時も記録）
+        event_store.add(record["eventSource"], record["eventName"], record.get("eventTime"))
+
+
+# 1つのログファイル（.json.gz）を解凍して集計する関数（プロセスプールのワーカーで実行）
+# 各レコードをハッシュ検索で対象のIAMエンティティごとの集計に振り分ける
+# export=True の場合は、エクスポート用に絞り込んだ行も返す（ファイルへの書き出しは親プロセスで行う）
+def analyze_log_file(path, principals, export=False):
+    principal_event_stores = {}
+    principal_counts = {}
+    export_rows = []
+    records_count = 0
+
+    with gzip.open(path, "rb") as f:
+        data = f.read()
+
+    # 対象の名前を1つも含まないファイルはJSONをパースせずに読み飛ばす（対象が少ない場合のみ）
+    if len(principals) <= PREFILTER_MAX_PRINCIPALS and not any(p.encode("utf-8") in data for p in principals):
+        return len(data), data.count(b'"eventVersion"'), principal_counts, principal_event_stores, export_rows
+
+    records = json.loads(data).get("Records", [])
+    records_count = len(records)
+    for record in records:
+        for iam_entity in record_principal_names(record) & principals:
+            principal_counts[iam_entity] = principal_counts.get(iam_entity, 0) + 1
+            if iam_entity not in principal_event_stores:
+                principal_event_stores[iam_entity] = EventNameStore()
+            process_cloudtrail_record(record, principal_event_stores[iam_entity])
+            if export and "eventTime" in record:
+                export_rows.append((iam_entity, int(to_epoch(record["eventTime"]) * 1000))
+                                   + tuple(record.get(field) for field in RECORD_FIELDS))
+
+    return len(data), records_count, principal_counts, principal_event_stores, export_rows
+
+
+# ディレクトリまたはグロブパターンからログファイルの一覧を作成する関数
+def find_log_files(patterns):
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "**", "*.json.gz")
+        files.extend(glob.glob(pattern, recursive=True))
+    return sorted(set(files))
+
+
+# 分析結果をJSONファイルに保存して概要を表示する関数
+def save_result(iam_entity, file_count, total_events, event_store):
+    # 結果作成（CloudTrailのイベント名をサービス名とともに表示）
+    response = render_result(f"{iam_entity}のS3エクスポートログ（{file_count}ファイル）のアクティビティ", total_events, event_store)
+    save_result_file(f"cloudtrail_events_{iam_entity}_s3export.json", response)
+
+
+# 実行コマンド：python cloudtrail_s3_analyzer.py IAMユーザー名 ディレクトリまたはグロブ [...] [--workers N] [--timeline ファイル] [--export ディレクトリ]
+#              python cloudtrail_s3_analyzer.py --principals-file ファイル ディレクトリまたはグロブ [...] [--workers N] [--timeline ファイル] [--export ディレクトリ]
+def main():
+    args, options = parse_cli_args(sys.argv[1:], value_options=("--workers", "--principals-file") + TIMELINE_OPTIONS + EXPORT_OPTIONS)
+
+    # --principals-file 指定時は1回の走査で複数のIAMユーザー/ロールをまとめて分析
+    if "--principals-file" in options:
+        principals = load_principals(options["--principals-file"])
+        patterns = args
+    else:
+        principals = args[:1]
+        patterns = args[1:]
+
+    if not principals or not patterns:
+        print(f"使用方法: python cloudtrail_s3_analyzer.py IAMユーザー名 ディレクトリまたはグロブ [...] [--workers N] {TIMELINE_USAGE} {EXPORT_USAGE}")
+        print(f"          python cloudtrail_s3_analyzer.py --principals-file ファイル ディレクトリまたはグロブ [...] [--workers N] {TIMELINE_USAGE} {EXPORT_USAGE}")
+        sys.exit(1)
+
+    log_files = find_log_files(patterns)
+    workers = int(options.get("--workers", os.cpu_count() or 1))
+    # --timeline 指定時はイベント名ごとの日別の回数も集計し、CSV/Parquetで出力する
+    timeline_path = configure_timeline(options)
+    # --export 指定時は対象のレコードを絞り込んだ列だけにして、列指向のファイルに書き出す
+    exporter = open_exporter_from_options(options)
+
+    if not log_files:
+        print("対象のログファイル（.json.gz）が見つかりません")
+        sys.exit(1)
+
+    print(f"分析開始: {', '.join(principals)}のアクティビティ（ログファイル {len(log_files)} 件, {workers}プロセス）")
+
+    # IAMエンティティごとのイベント名収集用
+    principal_set = frozenset(principals)
+    event_stores = {iam_entity: EventNameStore() for iam_entity in principals}
+    total_events = dict.fromkeys(principals, 0)
+    total_records = 0
+    total_bytes = 0
+    started = time.perf_counter()
+
+    # ログファイルをプロセスプールで並列に解凍・集計
+    # （日別の回数を集計するかどうかはワーカーのプロセスにも設定する）
+    with ProcessPoolExecutor(max_workers=workers, initializer=set_daily_counts, initargs=(timeline_path is not None,)) as executor:
+        results = executor.map(analyze_log_file, log_files, [principal_set] * len(log_files),
+                               [exporter is not None] * len(log_files), chunksize=16)
+        for i, (size, records_count, principal_counts, principal_event_stores, export_rows) in enumerate(results):
+            total_bytes += size
+            total_records += records_count
+            for iam_entity, events_count in principal_counts.items():
+                total_events[iam_entity] += events_count
+            for iam_entity, file_event_store in principal_event_stores.items():
+                event_stores[iam_entity].merge(file_event_store)
+            if exporter is not None:
+                exporter.add_rows(export_rows)
+
+            if (i + 1) % 100 == 0:
+                print(f"  ファイル {i+1}/{len(log_files)} 処理完了: 累計 {sum(total_events.values())} イベント")
+
+    elapsed = time.perf_counter() - started
+
+    # IAMエンティティごとに結果を保存
+    for iam_entity in principals:
+        save_result(iam_entity, len(log_files), total_events[iam_entity], event_stores[iam_entity])
+    if timeline_path is not None:
+        write_timeline(timeline_path, event_stores)
+    if exporter is not None:
+        exporter.close()
+
+    # 処理性能を表示（解凍後のバイト数で計算）
+    print(f"処理時間: {elapsed:.2f}秒 "
+          f"({total_bytes / elapsed / 1e9:.3f} GB/s, {total_records / elapsed:,.0f} レコード/秒)")
+    print(f"全レコード数: {total_records}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+# LookupEventsのAPI制限（アカウント・リージョンごとに毎秒2リクエスト）
+LOOKUP_EVENTS_TPS = 2.0
+
+# スロットリング検出時に下げられる最小レート（リクエスト/秒）
+MIN_RATE = 0.1
+
+# 成功時にレートを回復させる幅（リクエスト/秒）
+RATE_RECOVERY_STEP = 0.1
+
+# 同時に処理する作業単位数のデフォルト
+DEFAULT_CONCURRENCY = 4
+
+# リージョンごとのレートリミッター
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+# トークンバケット方式のレートリミッター
+# スロットリングを検出したらレートを半分に下げ、成功が続けば元のレートまで少しずつ戻す
+class TokenBucket:
+    def __init__(self, rate=LOOKUP_EVENTS_TPS, capacity=None):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.throttle_count = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    # トークンを1つ取得する（なければ補充されるまで待機）
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+    # スロットリングを検出したときに呼ぶ
+    def on_throttle(self):
+        with self.lock:
+            self.throttle_count += 1
+            self.rate = max(self.rate / 2, MIN_RATE)
+            self.tokens = 0
+
+    # リクエストが成功したときに呼ぶ
+    def on_success(self):
+        with self.lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.rate + RATE_RECOVERY_STEP, self.max_rate)
+
+
+# リージョンごとのレートリミッターを取得する関数
+# LookupEventsの上限はアカウント・リージョンごとのため、account 指定時は (アカウント, リージョン) ごとに分ける
+def get_rate_limiter(region=None, account=None):
+    key = f"{account}/{region or 'default'}" if account else region or "default"
+    with _rate_limiters_lock:
+        limiter = _rate_limiters.get(key)
+        if limiter is None:
+            limiter = TokenBucket()
+            _rate_limiters[key] = limiter
+    return limiter
+
+
+# 作業単位をスレッドプールで同時に処理し、完了したものから (作業単位, 結果) を返すジェネレータ
+def run_work_units(units, worker, concurrency=DEFAULT_CONCURRENCY):
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    try:
+        futures = {executor.submit(worker, unit): unit for unit in units}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+    except BaseException:
+        # エラーやCtrl-Cで中断した場合は未着手の作業単位を取り消す
+        # 実行中の作業単位の終了は待たない（呼び出し元がジャーナルなどで停止させる）
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    executor.shutdown()
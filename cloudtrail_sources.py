@@ -0,0 +1,398 @@
+import bisect
+import datetime
+import gzip
+import json
+import math
+import random
+import threading
+import time
+from collections import deque
+
+from cloudtrail_dedup import GLOBAL_EVENT_SOURCES, GLOBAL_SERVICE_REGION
+from cloudtrail_extract import to_epoch
+from cloudtrail_fetcher import (
+    MAX_RESULTS_PER_PAGE,
+    build_lookup_events_command,
+    execute_aws_command,
+    lookup_events_page,
+    set_event_source,
+)
+
+
+# S3エクスポートファイルから返す1ページあたりの件数（API制限がないため大きめにする）
+S3_EXPORT_PAGE_SIZE = 1000
+
+# 擬似データで使うサービスとイベント名
+FAKE_SERVICES = (
+    ("s3.amazonaws.com", ("GetObject", "PutObject", "ListBuckets", "HeadObject")),
+    ("ec2.amazonaws.com", ("DescribeInstances", "RunInstances", "DescribeVpcs")),
+    ("iam.amazonaws.com", ("GetRole", "ListRoles", "PassRole")),
+    ("sts.amazonaws.com", ("AssumeRole", "GetCallerIdentity")),
+    ("ssm-incidents.amazonaws.com", ("ListResponsePlans",)),
+)
+
+# 擬似データで hot_rate の割合を占める、大量に呼び出されるイベント
+FAKE_HOT_ACTIONS = (("sts.amazonaws.com", "AssumeRole"), ("s3.amazonaws.com", "GetObject"))
+
+# LookupEventsの検索条件のキーと、CloudTrailEvent（レコード）のフィールドの対応
+LOOKUP_ATTRIBUTE_FIELDS = {"EventName": "eventName", "EventSource": "eventSource"}
+
+
+# イベントの取得元の基底クラス
+# どの取得元もLookupEventsと同じ形式 {"Events": [...], "NextToken": ...} でページを返す
+class EventSource:
+    # LookupEventsのAPI制限（リージョンごとのトークンバケット）を適用するかどうか
+    rate_limited = True
+
+    # lookup_attribute (キー, 値) を指定した場合は、IAMエンティティではなくその条件で絞り込む（LookupEventsと同じく条件は1つ）
+    def lookup_events_page(self, iam_entity, start_time, end_time, region=None, next_token=None, lookup_attribute=None):
+        raise NotImplementedError
+
+    # boto3のCloudTrailクライアントと同じ呼び出し方（lookup_events(**params)）ができるアダプタを返す
+    def as_client(self, region=None):
+        return EventSourceClient(self, region)
+
+
+# EventSourceをboto3のCloudTrailクライアントとして使うためのアダプタ
+class EventSourceClient:
+    def __init__(self, source, region=None):
+        self.source = source
+        self.region = region
+
+    def lookup_events(self, **params):
+        iam_entity = None
+        lookup_attribute = None
+        for attribute in params.get("LookupAttributes", []):
+            if attribute["AttributeKey"] == "Username":
+                iam_entity = attribute["AttributeValue"]
+            else:
+                lookup_attribute = (attribute["AttributeKey"], attribute["AttributeValue"])
+        return self.source.lookup_events_page(
+            iam_entity, params["StartTime"], params["EndTime"], self.region, params.get("NextToken"), lookup_attribute
+        )
+
+
+# LookupEvents APIから取得する（boto3、またはAWS CLIのサブプロセス）
+class LookupEventsSource(EventSource):
+    def __init__(self, use_cli=False):
+        self.use_cli = use_cli
+
+    def lookup_events_page(self, iam_entity, start_time, end_time, region=None, next_token=None, lookup_attribute=None):
+        if self.use_cli:
+            return execute_aws_command(build_lookup_events_command(iam_entity, start_time, end_time, region, next_token, lookup_attribute))
+        return lookup_events_page(iam_entity, start_time, end_time, region, next_token, lookup_attribute)
+
+
+# S3に出力されたCloudTrailログファイル（.json.gz）から、LookupEventsと同じ形式で返す
+# (IAMエンティティ, リージョン, 検索条件) ごとに対象のレコードを最初に一度だけ読み込み、時刻順の索引を作る
+class S3ExportSource(EventSource):
+    rate_limited = False
+
+    def __init__(self, patterns, page_size=S3_EXPORT_PAGE_SIZE):
+        from cloudtrail_s3_analyzer import find_log_files
+
+        self.log_files = find_log_files(patterns)
+        self.page_size = page_size
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def _load_index(self, iam_entity, region, lookup_attribute=None):
+        from cloudtrail_s3_analyzer import record_principal_names
+
+        entries = []
+        for path in self.log_files:
+            with gzip.open(path, "rb") as f:
+                records = json.loads(f.read()).get("Records", [])
+            for record in records:
+                if "eventTime" not in record:
+                    continue
+                if region and record.get("awsRegion") != region:
+                    continue
+                if lookup_attribute and record.get(LOOKUP_ATTRIBUTE_FIELDS[lookup_attribute[0]]) != lookup_attribute[1]:
+                    continue
+                names = record_principal_names(record) - {None}
+                if iam_entity and iam_entity not in names:
+                    continue
+                entries.append((
+                    to_epoch(record["eventTime"]),
+                    record.get("eventID", ""),
+                    iam_entity or (sorted(names)[0] if names else None),
+                    json.dumps(record, separators=(",", ":")),
+                ))
+        entries.sort()
+        return [entry[0] for entry in entries], entries
+
+    def lookup_events_page(self, iam_entity, start_time, end_time, region=None, next_token=None, lookup_attribute=None):
+        if lookup_attribute and lookup_attribute[0] == "Username":
+            iam_entity, lookup_attribute = lookup_attribute[1], None
+        elif lookup_attribute:
+            iam_entity = None
+        key = (iam_entity, region, lookup_attribute)
+        with self.lock:
+            if key not in self.indexes:
+                self.indexes[key] = self._load_index(iam_entity, region, lookup_attribute)
+            times, entries = self.indexes[key]
+
+        # LookupEventsと同じく新しいイベントから返す
+        low = bisect.bisect_left(times, to_epoch(start_time))
+        high = bisect.bisect_right(times, to_epoch(end_time)) - int(next_token or 0)
+        page_low = max(low, high - self.page_size)
+
+        events = []
+        for event_time, event_id, username, raw in reversed(entries[page_low:high]):
+            events.append({
+                "EventId": event_id,
+                "EventTime": datetime.datetime.fromtimestamp(event_time, datetime.timezone.utc),
+                "Username": username,
+                "CloudTrailEvent": raw,
+            })
+        page = {"Events": events}
+        if page_low > low:
+            page["NextToken"] = str(int(next_token or 0) + self.page_size)
+        return page
+
+
+# cloudtrail_export.py でエクスポートした列指向のファイルから、LookupEventsと同じ形式で返す
+# CloudTrailEventはエクスポートした列（eventSource、eventName、awsRegion など）だけを含む
+class ExportEventSource(S3ExportSource):
+    def __init__(self, directory, page_size=S3_EXPORT_PAGE_SIZE):
+        from cloudtrail_export import read_export
+
+        self.table = read_export(directory)
+        self.page_size = page_size
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def _load_index(self, iam_entity, region, lookup_attribute=None):
+        entries = []
+        for row_number, row in enumerate(self.table.to_pylist()):
+            if region and row["awsRegion"] != region:
+                continue
+            if lookup_attribute and row[LOOKUP_ATTRIBUTE_FIELDS[lookup_attribute[0]]] != lookup_attribute[1]:
+                continue
+            if iam_entity and row["principal"] != iam_entity:
+                continue
+            record = {
+                "userIdentity": {"userName": row["principal"]},
+                "eventTime": row["eventTime"].strftime("%Y-%m-%dT%H:%M:%SZ"),
+            }
+            record.update((field, row[field]) for field in ("eventSource", "eventName", "awsRegion", "sourceIPAddress", "errorCode")
+                          if row[field] is not None)
+            entries.append((row["eventTime"].timestamp(), f"export-{row_number}", row["principal"], json.dumps(record, separators=(",", ":"))))
+        entries.sort()
+        return [entry[0] for entry in entries], entries
+
+
+# 擬似データのスロットリングエラー（botocoreのClientErrorと同じくresponseにエラーコードを持つ）
+class FakeThrottlingException(Exception):
+    def __init__(self):
+        super().__init__("ThrottlingException: Rate exceeded (fake)")
+        self.response = {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}
+
+
+# 擬似的なイベントを生成して返す（AWSアカウントなしでの負荷試験・回帰確認用）
+# イベントは一定間隔で並んだ時刻に決定的に生成されるため、期間の分け方によらず同じ結果になる
+# hot_rate を指定すると、その割合のイベントを FAKE_HOT_ACTIONS にする（少数のイベントを大量に呼び出すロールの再現）
+class FakeEventSource(EventSource):
+    def __init__(self, events_per_day=1000, page_size=MAX_RESULTS_PER_PAGE, throttle_rate=0.0, tps=None,
+                 latency=0.0, payload_size=512, principals=("fake-user",), seed=0, hot_rate=0.0):
+        self.interval = 86400 / events_per_day
+        self.hot_rate = hot_rate
+        self.page_size = page_size
+        self.throttle_rate = throttle_rate
+        self.tps = tps
+        self.latency = latency
+        self.padding = "x" * payload_size
+        self.principals = tuple(principals)
+        self.random = random.Random(seed)
+        self.recent_calls = {}
+        self.calls = 0
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    # APIの遅延とスロットリングを再現する
+    def _simulate_api(self, region):
+        with self.lock:
+            self.calls += 1
+            now = time.monotonic()
+            recent = self.recent_calls.setdefault(region, deque())
+            while recent and now - recent[0] >= 1.0:
+                recent.popleft()
+
+            if self.random.random() < self.throttle_rate or (self.tps and len(recent) >= self.tps):
+                self.throttles += 1
+                raise FakeThrottlingException()
+            recent.append(now)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+    # イベント番号から (eventSource, eventName) を決める
+    def _event_action(self, index):
+        hashed = (index * 2654435761) % 2 ** 32
+        if self.hot_rate and (hashed >> 16) % 10000 < self.hot_rate * 10000:
+            return FAKE_HOT_ACTIONS[(hashed >> 8) % len(FAKE_HOT_ACTIONS)]
+        event_source, event_names = FAKE_SERVICES[hashed % len(FAKE_SERVICES)]
+        return event_source, event_names[(hashed >> 8) % len(event_names)]
+
+    # イベント番号のイベント時刻（CloudTrailと同じく秒単位、エポック秒）
+    def _event_second(self, index):
+        return math.floor(index * self.interval)
+
+    # 時刻が start_time 以上・end_time 以下のイベント番号の範囲 (最初, 最後) を返す
+    def _index_range(self, start_time, end_time):
+        start = math.ceil(to_epoch(start_time))
+        end = math.floor(to_epoch(end_time))
+        first = max(0, math.ceil(start / self.interval) - 1)
+        while self._event_second(first) < start:
+            first += 1
+        last = math.floor((end + 1) / self.interval) + 1
+        while last >= first and self._event_second(last) > end:
+            last -= 1
+        return first, last
+
+    def _build_event(self, index, username, region):
+        event_time = datetime.datetime.fromtimestamp(self._event_second(index), datetime.timezone.utc)
+        event_source, event_name = self._event_action(index)
+        event_id = f"fake-{region or 'default'}-{index}"
+        # グローバルサービスのイベントは、どのリージョンで検索しても同じイベント（us-east-1で記録されたもの）を返す
+        if event_source in GLOBAL_EVENT_SOURCES:
+            event_id = f"fake-global-{index}"
+            region = GLOBAL_SERVICE_REGION
+        record = {
+            "eventVersion": "1.09",
+            "userIdentity": {
+                "type": "IAMUser",
+                "userName": username,
+                "arn": f"arn:aws:iam::123456789012:user/{username}",
+            },
+            "eventTime": event_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "eventSource": event_source,
+            "eventName": event_name,
+            "awsRegion": region or "us-east-1",
+            "sourceIPAddress": "192.0.2.1",
+            "requestParameters": {"padding": self.padding},
+            "responseElements": None,
+            "eventID": event_id,
+            "eventType": "AwsApiCall",
+        }
+        return {
+            "EventId": event_id,
+            "EventName": event_name,
+            "EventSource": event_source,
+            "EventTime": event_time,
+            "Username": username,
+            "CloudTrailEvent": json.dumps(record, separators=(",", ":")),
+        }
+
+    def lookup_events_page(self, iam_entity, start_time, end_time, region=None, next_token=None, lookup_attribute=None):
+        self._simulate_api(region)
+        if lookup_attribute and lookup_attribute[0] == "Username":
+            iam_entity, lookup_attribute = lookup_attribute[1], None
+        elif lookup_attribute:
+            iam_entity = None
+            # _event_action の (eventSource, eventName) のうち比較する位置
+            position = 1 if lookup_attribute[0] == "EventName" else 0
+
+        # イベント番号 index は principals を順番に割り当てる（Username指定時はその対象の番号だけを返す）
+        if iam_entity in self.principals:
+            stride = len(self.principals)
+            residue = self.principals.index(iam_entity)
+        else:
+            stride = 1
+            residue = 0
+
+        first, last = self._index_range(start_time, end_time)
+        high = last - (last - residue) % stride
+
+        # NextToken は新しい方から読み進めたイベント番号の数（検索条件に一致しない番号も含む）
+        events = []
+        index = high - stride * int(next_token or 0)
+        while index >= first and len(events) < self.page_size:
+            if lookup_attribute is None or self._event_action(index)[position] == lookup_attribute[1]:
+                username = iam_entity or self.principals[index % len(self.principals)]
+                events.append(self._build_event(index, username, region))
+            index -= stride
+
+        page = {"Events": events}
+        if index >= first:
+            page["NextToken"] = str((high - index) // stride)
+        return page
+
+
+# 擬似的なSTSが拒否したときに送出する例外
+class FakeAccessDeniedException(Exception):
+    def __init__(self, message):
+        super().__init__(f"An error occurred (AccessDenied) when calling the AssumeRole operation: {message}")
+        self.response = {"Error": {"Code": "AccessDenied", "Message": message}}
+
+
+# 擬似的なSTS（--accounts の動作確認用。AssumeRoleで期限付きの認証情報を返す）
+# denied_accounts のアカウントへのAssumeRoleは拒否する
+class FakeStsClient:
+    def __init__(self, denied_accounts=()):
+        self.denied_accounts = set(denied_accounts)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def assume_role(self, RoleArn, RoleSessionName, DurationSeconds=3600, ExternalId=None):
+        account = RoleArn.split(":")[4]
+        with self.lock:
+            self.calls += 1
+            calls = self.calls
+        if account in self.denied_accounts:
+            raise FakeAccessDeniedException(f"not authorized to perform: sts:AssumeRole on resource: {RoleArn}")
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=DurationSeconds)
+        return {
+            "Credentials": {
+                "AccessKeyId": f"ASIAFAKE{account}",
+                "SecretAccessKey": "fake",
+                "SessionToken": f"fake-{calls}",
+                "Expiration": expiration,
+            },
+            "AssumedRoleUser": {"Arn": f"arn:aws:sts::{account}:assumed-role/{RoleArn.rpartition('/')[2]}/{RoleSessionName}"},
+        }
+
+
+# 取得元の指定文字列からEventSourceを作成する関数
+# 指定例: api / cli / s3:ディレクトリまたはグロブ[,...] / export:ディレクトリ / fake / fake:events_per_day=5000,throttle_rate=0.05
+def create_event_source(spec):
+    kind, _, argument = spec.partition(":")
+    if kind == "api":
+        return LookupEventsSource()
+    if kind == "cli":
+        return LookupEventsSource(use_cli=True)
+    if kind == "s3":
+        return S3ExportSource(argument.split(","))
+    if kind == "export":
+        return ExportEventSource(argument)
+    if kind == "fake":
+        converters = {
+            "events_per_day": float,
+            "page_size": int,
+            "throttle_rate": float,
+            "tps": float,
+            "latency": float,
+            "payload_size": int,
+            "principals": lambda value: value.split("+"),
+            "seed": int,
+            "hot_rate": float,
+        }
+        params = {}
+        for item in filter(None, argument.split(",")):
+            name, _, value = item.partition("=")
+            if name not in converters:
+                raise ValueError(f"不明な擬似データの設定: {name}")
+            params[name] = converters[name](value)
+        return FakeEventSource(**params)
+    raise ValueError(f"不明な取得元: {spec}")
+
+
+# --source オプションが指定されていればイベントの取得元を差し替える関数
+def configure_event_source(options):
+    if "--source" not in options:
+        return None
+    source = create_event_source(options["--source"])
+    set_event_source(source)
+    print(f"イベントの取得元: {options['--source']}")
+    return source
@@ -0,0 +1,52 @@
+import sys
+
+
+# サブコマンド -> (モジュール, 説明, メトリクス・プロファイルのオプションを処理するかどうか)
+# モジュールは選択したサブコマンドの実行時にだけ読み込む（--help ではboto3などを読み込まない）
+SUBCOMMANDS = {
+    "days-back": ("cloudtrail_analyzer", "過去N日間のアクティビティを分析（cloudtrail_analyzer.py）", True),
+    "date-range": ("cloudtrail_events_bydate", "日付範囲を指定して分析（cloudtrail_events_bydate.py）", True),
+    "multi-region": ("cloudtrail_analyzer2", "日付範囲・複数リージョンを指定して分析（cloudtrail_analyzer2.py）", True),
+    "offline": ("cloudtrail_s3_analyzer", "S3に出力されたログファイルを解析（cloudtrail_s3_analyzer.py）", False),
+    "export": ("cloudtrail_export", "エクスポートしたイベントを集計（cloudtrail_export.py）", False),
+    "policy": ("cloudtrail_policy", "分析結果からIAMポリシーを作成（cloudtrail_policy.py）", False),
+}
+
+
+# サブコマンドの一覧を表示する関数
+def print_usage():
+    print("使用方法: ctinspect サブコマンド [引数...]")
+    print("")
+    print("サブコマンド:")
+    for name, (_, description, _) in SUBCOMMANDS.items():
+        print(f"  {name:<13} {description}")
+    print("")
+    print("サブコマンドの引数は、引数なしで実行すると表示されます（例: ctinspect days-back）")
+
+
+# 実行コマンド：ctinspect サブコマンド [引数...]（python -m ctinspect でも可）
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ("-h", "--help", "help"):
+        print_usage()
+        sys.exit(0 if argv else 1)
+
+    name, arguments = argv[0], argv[1:]
+    if name not in SUBCOMMANDS:
+        print(f"不明なサブコマンド: {name}")
+        print_usage()
+        sys.exit(1)
+
+    import importlib
+
+    module_name, _, with_metrics = SUBCOMMANDS[name]
+    module = importlib.import_module(module_name)
+    # 各スクリプトの main() は sys.argv から引数を読み込む
+    sys.argv = [f"ctinspect {name}"] + arguments
+    if with_metrics:
+        from cloudtrail_metrics import run_with_metrics
+
+        run_with_metrics(module.main)
+    else:
+        module.main()
+
@@ -0,0 +1,6 @@
+from ctinspect import main
+
+
+# python -m ctinspect で実行した場合
+if __name__ == "__main__":
+    main()
@@ -1,88 +1,556 @@
 import json
+import os
+import time
 import boto3
+from botocore.config import Config
 import datetime
-from collections import defaultdict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
+from cloudtrail_aggregate import DETAILS_KEY, EventNameStore
+from cloudtrail_checkpoint import get_checkpoint_store
+from cloudtrail_metrics import metrics
+
 
 # ロガーの設定
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-def lambda_handler(event, context):
-    iam_entity = "対象のIAMユーザー/ロール名"
-    days_back = 10  # 過去何日分のログか指定
-    
-    logger.info(f"分析開始: {iam_entity}の過去{days_back}日間のアクティビティ")
-    
-    # 過去X日間のログを取得
-    end_time = datetime.datetime.now()
-    start_time = end_time - datetime.timedelta(days=days_back)
-    
-    logger.info(f"期間: {start_time.isoformat()} から {end_time.isoformat()}")
-    
-    # CloudTrailクライアント作成
-    cloudtrail = boto3.client('cloudtrail')
-    
-    # サービスごとのアクション収集用
-    service_actions = defaultdict(set)
+# 残り時間がこれを下回ったらチェックポイントを保存して処理を中断する（ミリ秒）
+CHECKPOINT_MARGIN_MILLIS = 60 * 1000
+
+# 非同期呼び出し（InvocationType='Event'）のペイロードの上限（バイト）
+ASYNC_PAYLOAD_LIMIT_BYTES = 256 * 1024
+
+# 期間の指定がない場合に分析する日数
+DEFAULT_DAYS_BACK = 10
+
+# 期間を分割して並列に取得するサブウィンドウ数（スレッド数）のデフォルトと上限
+DEFAULT_WORKERS = int(os.environ.get("LAMBDA_WORKERS", "4"))
+MAX_WORKERS = 16
+
+# ウォームスタートのコンテナで再利用する分析結果の件数と有効期間（秒）
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "32"))
+RESULT_CACHE_TTL_SECONDS = int(os.environ.get("RESULT_CACHE_TTL_SECONDS", "300"))
+
+# ログに出力する分析結果の最大文字数（超えた分は省略する）
+LOG_MAX_CHARS = int(os.environ.get("LOG_MAX_CHARS", "4096"))
+
+# CloudTrailクライアントの設定（全スレッドで共有するため、上限のスレッド数に合わせてコネクションプールを広げる）
+# スロットリングはadaptiveモードのリトライで吸収する
+CLIENT_CONFIG = Config(
+    max_pool_connections=max(10, MAX_WORKERS * 2),
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+)
+
+# ログ出力用のJSONエンコーダ（インデントなし。iterencodeで少しずつ文字列にする）
+_LOG_ENCODER = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+# ウォームスタート時に再利用するクライアントとチェックポイントストア（名前 -> オブジェクト）
+_clients = {}
+
+# CloudWatchの埋め込みメトリクス形式（EMF）で出力するメトリクスの名前空間
+METRICS_NAMESPACE = os.environ.get("METRICS_NAMESPACE", "CloudTrailInspector")
+
+
+# スレッド間で共有するCloudTrailクライアントを作成する関数
+# 環境変数 EVENT_SOURCE（例: fake:events_per_day=5000）を指定すると、ローカル確認用の取得元を使う
+def create_cloudtrail_client():
+    if os.environ.get("EVENT_SOURCE"):
+        from cloudtrail_sources import create_event_source
+        return create_event_source(os.environ["EVENT_SOURCE"]).as_client()
+
+    return boto3.client('cloudtrail', config=CLIENT_CONFIG)
+
+
+# クライアントなどを1度だけ作成し、同じコンテナでの以降の実行で再利用する関数
+def get_client(name, factory):
+    if name not in _clients:
+        _clients[name] = factory()
+    return _clients[name]
+
+
+# Lambdaの初期化フェーズ（コールドスタート時）にCloudTrailクライアントを作成しておく
+if os.environ.get("AWS_LAMBDA_FUNCTION_NAME"):
+    get_client("cloudtrail", create_cloudtrail_client)
+
+
+# 最近の分析結果を保持するLRUキャッシュ（ダッシュボードからの同じ問い合わせにすぐ応答するため）
+# 件数が上限を超えたら最も古く使われた結果から捨て、有効期間を過ぎた結果は使わない
+class ResultCache:
+    def __init__(self, max_entries=RESULT_CACHE_SIZE, ttl_seconds=RESULT_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stored_at, response = entry
+        if time.monotonic() - stored_at > self.ttl_seconds:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return response
+
+    def put(self, key, response):
+        self.entries[key] = (time.monotonic(), response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+_result_cache = ResultCache()
+
+
+# 分析結果のキャッシュのキーを作成する関数（分析対象・期間などの指定。結果に影響しない指定は含めない）
+# チェックポイントからの再開、"no_cache": true を指定した場合、または期間を days_back で指定した場合は None
+# （days_back は実行時刻からの期間のため、同じ指定でも実行ごとに期間が異なる）
+def result_cache_key(event):
+    if event.get("no_cache") or event.get("checkpoint_id") or event.get("checkpoint"):
+        return None
+    if not (event.get("start_time") and event.get("end_time")):
+        return None
+    return json.dumps(
+        {key: value for key, value in event.items() if key not in ("workers", "auto_continue")},
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+
+
+# ログ出力用に値をインデントなしのJSONにする関数
+# 最大文字数に達した時点で変換をやめるため、結果が大きくても全体の文字列を作らない
+def compact_json(value, max_chars=LOG_MAX_CHARS):
+    chunks = []
+    size = 0
+    for chunk in _LOG_ENCODER.iterencode(value):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size > max_chars:
+            return "".join(chunks)[:max_chars] + f"...（{max_chars}文字以降を省略）"
+    return "".join(chunks)
+
+
+# 期間をサブウィンドウに等分する関数
+# LookupEventsの開始・終了時刻はどちらも範囲に含まれるため、ローカルスクリプトのチャンクと同じく
+# 隣接するサブウィンドウは重ならないようにする（境界の秒のイベントを2回数えない）
+def split_windows(start_time, end_time, count):
+    from cloudtrail_planner import split_at
+
+    start_time = start_time.replace(microsecond=0)
+    end_time = end_time.replace(microsecond=0)
+    step = (end_time - start_time) / count
+    windows = []
+    window_start = start_time
+    for i in range(count):
+        if i == count - 1:
+            window_end, next_start = end_time, None
+        else:
+            window_end, next_start = split_at(start_time + step * (i + 1))
+        # 1秒に満たない幅のサブウィンドウは作らない
+        if window_end >= window_start:
+            windows.append({
+                "start_time": window_start.isoformat(),
+                "end_time": window_end.isoformat(),
+                "next_token": None,
+                "done": False,
+            })
+        window_start = next_start
+    return windows
+
+
+# 実行時のイベントから分析の状態を作成する関数
+# 指定例: {"iam_entity": "ユーザー名", "days_back": 30}
+#         {"iam_entity": "ユーザー名", "start_time": "2025-01-01T00:00:00", "end_time": "2025-03-31T23:59:59"}
+def create_state(event):
+    iam_entity = event.get("iam_entity")
+    if not iam_entity:
+        raise ValueError("iam_entity を指定してください")
+
+    if event.get("start_time") and event.get("end_time"):
+        start_time = datetime.datetime.fromisoformat(event["start_time"])
+        end_time = datetime.datetime.fromisoformat(event["end_time"])
+        description = f"{iam_entity}の{event['start_time']}から{event['end_time']}までのアクティビティ"
+    else:
+        days_back = int(event.get("days_back", DEFAULT_DAYS_BACK))
+        end_time = datetime.datetime.now()
+        start_time = end_time - datetime.timedelta(days=days_back)
+        description = f"{iam_entity}の過去{days_back}日間のアクティビティ"
+
+    workers = min(MAX_WORKERS, max(1, int(event.get("workers", DEFAULT_WORKERS))))
+
+    return {
+        "iam_entity": iam_entity,
+        "description": description,
+        "start_time": start_time.isoformat(),
+        "end_time": end_time.isoformat(),
+        "windows": split_windows(start_time, end_time, workers),
+        "total_events": 0,
+        "action_store": [],
+        "invocations": 0,
+    }
+
+
+# 前回の実行のチェックポイントから状態を読み込む関数（新規の場合は作成）
+def load_state(event, store):
+    if event.get("checkpoint_id") and store is not None:
+        return event["checkpoint_id"], store.load(event["checkpoint_id"])
+    if event.get("checkpoint"):
+        return event.get("checkpoint_id"), event["checkpoint"]
+    return None, create_state(event)
+
+
+# チェックポイントを保存し、続きを処理するためのペイロードを返す関数
+# auto_continue が指定されていれば、自分自身を非同期で再実行して続きを処理する
+# ストアがない場合は途中結果をペイロードに含めるため、非同期呼び出しの上限を超える場合はエラーにする
+def save_checkpoint(state, checkpoint_id, store, event, context):
+    if store is not None:
+        store.save(checkpoint_id, state)
+        payload = {"checkpoint_id": checkpoint_id}
+    else:
+        payload = {"checkpoint_id": checkpoint_id, "checkpoint": state}
+
+    if event.get("auto_continue"):
+        payload["auto_continue"] = True
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        if len(body) > ASYNC_PAYLOAD_LIMIT_BYTES:
+            raise ValueError(
+                f"途中結果（{len(body)}バイト）が非同期呼び出しのペイロードの上限（{ASYNC_PAYLOAD_LIMIT_BYTES}バイト）を超えるため、"
+                "auto_continue を使う場合は CHECKPOINT_BUCKET を指定してください"
+            )
+        get_client("lambda", lambda: boto3.client('lambda')).invoke(
+            FunctionName=context.function_name,
+            InvocationType='Event',
+            Payload=body,
+        )
+        logger.info(f"チェックポイント {checkpoint_id} から続きを処理するため再実行しました")
+
+    return {
+        "継続": True,
+        "処理済みイベント数": state["total_events"],
+        **payload
+    }
+
+
+# メトリクスをEMF形式で標準出力に書き出す関数（CloudWatch Logsが自動的にメトリクスとして取り込む）
+# ロガーの接頭辞が付くとEMFとして認識されないため、printで1行ずつ出力する
+def emit_metrics():
+    for line in metrics.to_emf(METRICS_NAMESPACE, {"FunctionName": os.environ.get("AWS_LAMBDA_FUNCTION_NAME", "local")}):
+        print(line)
+
+
+# 1つのサブウィンドウをページネーションして集計する関数（スレッドプールで実行）
+# 残り時間が少なくなったら次のトークンを window に記録して中断する
+def process_window(cloudtrail, iam_entity, window, context):
+    action_store = EventNameStore()
     total_events = 0
-    
-    try:
-        # CloudTrailからイベント履歴を取得（ページネーション対応）
-        logger.info("CloudTrailからイベント取得開始")
-        paginator = cloudtrail.get_paginator('lookup_events')
-        for page in paginator.paginate(
-            LookupAttributes=[
+    next_token = window["next_token"]
+    region = os.environ.get("AWS_REGION", "default")
+
+    while True:
+        params = {
+            "LookupAttributes": [
                 {
                     'AttributeKey': 'Username',
                     'AttributeValue': iam_entity
                 }
             ],
-            StartTime=start_time,
-            EndTime=end_time
-        ):
-            page_events = page['Events']
-            total_events += len(page_events)
-            logger.info(f"イベント取得: {len(page_events)}件")
-            
-            for event in page_events:
-                if 'CloudTrailEvent' in event:
-                    event_details = json.loads(event['CloudTrailEvent'])
-                    if "eventName" in event_details and "eventSource" in event_details:
-                        service = event_details["eventSource"].split(".")[0].replace("amazonaws.com", "").replace("-", "")
-                        action = event_details["eventName"]
-                        # サービスごとにアクションを分類
-                        service_actions[service].add(action)
-        
+            "StartTime": datetime.datetime.fromisoformat(window["start_time"]),
+            "EndTime": datetime.datetime.fromisoformat(window["end_time"])
+        }
+        if next_token:
+            params["NextToken"] = next_token
+        started = time.perf_counter()
+        page = cloudtrail.lookup_events(**params)
+        metrics.observe("api_call_seconds", time.perf_counter() - started, region=region)
+
+        page_events = page['Events']
+        total_events += len(page_events)
+        metrics.increment("pages_total", region=region)
+        metrics.increment("events_total", len(page_events), region=region)
+        # adaptiveモードのリトライ（主にスロットリング）の回数
+        metrics.increment("retries_total", page.get("ResponseMetadata", {}).get("RetryAttempts", 0), region=region)
+        logger.info(f"イベント取得: {len(page_events)}件 ({window['start_time']} から)")
+
+        parse_started = time.perf_counter()
+        for event_record in page_events:
+            if 'CloudTrailEvent' in event_record:
+                # サービスごとにアクションを分類（回数と初回・最終の日時も記録）
+                action_store.add_event(event_record)
+        metrics.increment("parse_seconds_total", time.perf_counter() - parse_started, region=region)
+
+        next_token = page.get("NextToken")
+        if not next_token or context.get_remaining_time_in_millis() < CHECKPOINT_MARGIN_MILLIS:
+            break
+
+    window["next_token"] = next_token
+    window["done"] = not next_token
+    return total_events, action_store
+
+
+# 使用の有無だけを調べる関数（実行時のイベントに "distinct_actions": true を指定した場合）
+# 全イベントをページネーションせず、サンプルと EventSource / EventName の検索条件で確認する（API呼び出しが少ないためチェックポイントは使わない）
+# 指定例: {"iam_entity": "ユーザー名", "days_back": 30, "distinct_actions": true, "candidates": ["s3:PutObject"], "verify_pages": 2}
+def analyze_distinct_actions(event):
+    # 使用の有無だけを調べる場合にのみ読み込む
+    from cloudtrail_presence import DEFAULT_SAMPLE_PAGES, DEFAULT_VERIFY_PAGES, find_distinct_actions, render_presence_result
+
+    state = create_state(event)
+    cloudtrail = get_client("cloudtrail", create_cloudtrail_client)
+    region = os.environ.get("AWS_REGION", "default")
+    logger.info(f"分析開始: {state['description']}（使用の有無のみ）")
+
+    def lookup(lookup_attribute, next_token):
+        params = {
+            "StartTime": datetime.datetime.fromisoformat(state["start_time"]),
+            "EndTime": datetime.datetime.fromisoformat(state["end_time"])
+        }
+        if lookup_attribute:
+            params["LookupAttributes"] = [
+                {
+                    'AttributeKey': lookup_attribute[0],
+                    'AttributeValue': lookup_attribute[1]
+                }
+            ]
+        if next_token:
+            params["NextToken"] = next_token
+        started = time.perf_counter()
+        page = cloudtrail.lookup_events(**params)
+        metrics.observe("api_call_seconds", time.perf_counter() - started, region=region)
+        metrics.increment("pages_total", region=region)
+        metrics.increment("events_total", len(page['Events']), region=region)
+        return page
+
+    action_store, unconfirmed, api_calls, complete = find_distinct_actions(
+        lookup,
+        state["iam_entity"],
+        event.get("candidates", ()),
+        int(event.get("sample_pages", DEFAULT_SAMPLE_PAGES)),
+        int(event.get("verify_pages", DEFAULT_VERIFY_PAGES)),
+    )
+    response = render_presence_result(state["description"], action_store, unconfirmed, api_calls, complete)
+    logger.info(f"検出されたイベント名: {len(action_store.render_details())}件（API呼び出し {api_calls}回、{response['結果の範囲']}）")
+
+    emit_metrics()
+    logger.info("分析完了")
+    return response
+
+
+def lambda_handler(event, context):
+    store = get_client("checkpoint_store", get_checkpoint_store)
+    # ウォームスタート時に前回の実行のメトリクスが混ざらないようにする
+    metrics.reset()
+
+    try:
+        # 同じコンテナで最近分析した対象・期間であれば、その結果を返す
+        cache_key = result_cache_key(event)
+        if cache_key is not None:
+            response = _result_cache.get(cache_key)
+            if response is not None:
+                logger.info("同じ分析対象・期間の結果をキャッシュから返します")
+                return response
+
+        if event.get("distinct_actions"):
+            response = analyze_distinct_actions(event)
+            if cache_key is not None:
+                _result_cache.put(cache_key, response)
+            return response
+
+        checkpoint_id, state = load_state(event, store)
+        # チェックポイントから再開した場合も、最初の実行の指定で結果をキャッシュする
+        state.setdefault("cache_key", cache_key)
+        checkpoint_id = checkpoint_id or context.aws_request_id
+        state["invocations"] += 1
+        iam_entity = state["iam_entity"]
+        pending_windows = [window for window in state["windows"] if not window["done"]]
+
+        logger.info(f"分析開始: {state['description']}（{state['invocations']}回目の実行）")
+        logger.info(f"期間: {state['start_time']} から {state['end_time']}（未完了のサブウィンドウ {len(pending_windows)}件を並列に取得）")
+
+        # CloudTrailクライアント（全スレッドで共有し、ウォームスタート時は前回の実行のものを再利用）
+        cloudtrail = get_client("cloudtrail", create_cloudtrail_client)
+
+        # サービスごとのアクション収集用（前回までの途中結果を引き継ぐ）
+        action_store = EventNameStore.from_state(state["action_store"])
+        total_events = state["total_events"]
+
+        # CloudTrailからイベント履歴をサブウィンドウごとに並列取得し、結果をマージ
+        logger.info("CloudTrailからイベント取得開始")
+        with ThreadPoolExecutor(max_workers=max(1, len(pending_windows))) as executor:
+            futures = [
+                executor.submit(process_window, cloudtrail, iam_entity, window, context)
+                for window in pending_windows
+            ]
+            for future in futures:
+                window_events, window_action_store = future.result()
+                total_events += window_events
+                action_store.merge(window_action_store)
+
+        # タイムアウト前に中断したサブウィンドウがあれば、途中結果と次のトークンを保存
+        if not all(window["done"] for window in state["windows"]):
+            state["total_events"] = total_events
+            state["action_store"] = action_store.to_state()
+            logger.info(f"残り時間が少ないためチェックポイント {checkpoint_id} を保存します（累計 {total_events} イベント）")
+            emit_metrics()
+            return save_checkpoint(state, checkpoint_id, store, event, context)
+
         logger.info(f"合計イベント数: {total_events}")
-        logger.info(f"検出されたサービス数: {len(service_actions)}")
-        
-        # サービスごとのステートメントを出力形式で作成
-        result = {}
-        for service, actions in service_actions.items():
-            # 各サービス用のIAMアクション形式に変換
-            action_list = [f"{service}:{action}" for action in actions]
-            result[service] = sorted(action_list)
+        # サービスごとのステートメントを出力形式で作成（各サービス用のIAMアクション形式に変換）
+        result = action_store.render()
+        logger.info(f"検出されたサービス数: {len(result)}")
+        for service, action_list in result.items():
             logger.info(f"サービス {service}: {len(action_list)}アクション")
-        
+
         # レスポンス
         response = {
-            "アクセス分析結果": f"{iam_entity}の過去{days_back}日間のアクティビティ",
+            "アクセス分析結果": state["description"],
             "取得イベント数": total_events,
-            "サービスごとのアクション": result
+            "サービスごとのアクション": result,
+            DETAILS_KEY: action_store.render_details()
         }
-        
-        # 結果をログに詳細出力
-        logger.info("========== 分析結果詳細 ==========")
-        logger.info(json.dumps(response, ensure_ascii=False, indent=2))
-        logger.info("=================================")
-        
+
+        # 完了したチェックポイントは削除
+        if store is not None and state["invocations"] > 1:
+            store.delete(checkpoint_id)
+
+        # 結果をログに出力（インデントなしで、最大文字数まで）
+        logger.info(f"分析結果: {compact_json(response)}")
+        if state.get("cache_key") is not None:
+            _result_cache.put(state["cache_key"], response)
+
+        emit_metrics()
         logger.info("分析完了")
         return response
-    
+
     except Exception as e:
         logger.error(f"エラー発生: {str(e)}")
         return {
             "エラー": str(e)
         }
+
+
+# ローカル実行用のLambdaのコンテキスト
+class LocalContext:
+    aws_request_id = "local"
+    function_name = "local"
+
+    def get_remaining_time_in_millis(self):
+        return 15 * 60 * 1000
+
+
+# コールドスタート・ウォームスタートの計測で、子プロセスとして実行する関数
+# started（プロセスでの計測開始時刻）からモジュールの読み込みと1回目の実行まで（コールド）、
+# キャッシュを使わない2回目の実行（ウォーム）、1回目と同じ指定の3回目の実行（ウォーム・キャッシュ）の時間と
+# 最大RSSを、最後の行にJSONで出力する
+def run_harness_invocations(started):
+    import resource
+
+    logger.setLevel(logging.WARNING)
+    # 結果のキャッシュを使えるよう、期間は開始・終了の時刻で指定する
+    end_time = datetime.datetime.now().replace(microsecond=0)
+    start_time = end_time - datetime.timedelta(days=1)
+    event = {"iam_entity": "harness", "start_time": start_time.isoformat(), "end_time": end_time.isoformat()}
+    timings = {}
+
+    handler_started = time.perf_counter()
+    lambda_handler(event, LocalContext())
+    timings["cold"] = time.perf_counter() - started
+    timings["cold_handler"] = time.perf_counter() - handler_started
+
+    handler_started = time.perf_counter()
+    lambda_handler({**event, "no_cache": True}, LocalContext())
+    timings["warm"] = time.perf_counter() - handler_started
+
+    handler_started = time.perf_counter()
+    lambda_handler(event, LocalContext())
+    timings["warm_cached"] = time.perf_counter() - handler_started
+
+    # Linuxの ru_maxrss はKB単位
+    timings["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps(timings))
+
+
+# コールドスタート（新しいプロセス）とウォームスタート（同じプロセスでの再実行）の処理時間と最大RSSを計測する関数
+# 取得元は環境変数 EVENT_SOURCE（未指定の場合は1日2万イベントの擬似データ）
+def run_cold_warm_harness(repeat):
+    import subprocess
+    import sys
+    import tracemalloc
+
+    env = dict(os.environ)
+    env.setdefault("EVENT_SOURCE", "fake:events_per_day=20000,principals=harness")
+    code = "import time\nstarted = time.perf_counter()\nimport lambda_extractor\nlambda_extractor.run_harness_invocations(started)\n"
+
+    results = []
+    for _ in range(repeat):
+        completed = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        )
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    print(f"取得元: {env['EVENT_SOURCE']}（{repeat}回の中央値）")
+    labels = {
+        "cold": "コールド（読み込み+1回目）",
+        "cold_handler": "コールド（1回目の実行のみ）",
+        "warm": "ウォーム（キャッシュなし）",
+        "warm_cached": "ウォーム（キャッシュ）",
+    }
+    for name, label in labels.items():
+        values = sorted(result[name] for result in results)
+        print(f"  {label:<16} {values[len(values) // 2] * 1000:10.1f}ms")
+    print(f"  最大RSS {max(result['max_rss_mb'] for result in results):.1f}MB")
+
+    # 大きな結果をログに出力する際のメモリ使用量（インデント付きの全体 / インデントなし・最大文字数まで）
+    action_store = EventNameStore()
+    for i in range(20000):
+        action_store.add(f"service{i % 200}.amazonaws.com", f"Action{i}", "2025-01-01T00:00:00Z")
+    response = {"サービスごとのアクション": action_store.render(), DETAILS_KEY: action_store.render_details()}
+    for label, dump in (("json.dumps(indent=2)", lambda: json.dumps(response, ensure_ascii=False, indent=2)),
+                        (f"compact_json（{LOG_MAX_CHARS}文字まで）", lambda: compact_json(response))):
+        tracemalloc.start()
+        dump()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"  ログ出力 {label}: 最大 {peak / 1024 / 1024:.2f}MB")
+
+
+# 擬似データのCloudTrailクライアントで、サブウィンドウ数（スレッド数）ごとの処理時間を計測する
+# 実行コマンド：python lambda_extractor.py [ページ数] [1ページあたりの遅延(ミリ秒)]
+#              python lambda_extractor.py --cold-warm [回数]
+def main():
+    import sys
+    from cloudtrail_sources import FakeEventSource
+
+    if len(sys.argv) > 1 and sys.argv[1] == "--cold-warm":
+        run_cold_warm_harness(int(sys.argv[2]) if len(sys.argv) > 2 else 5)
+        return
+
+    page_count = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    latency = (int(sys.argv[2]) if len(sys.argv) > 2 else 100) / 1000
+    days_back = 10
+
+    # 期間全体で約 page_count ページになるよう、1日あたりのイベント数を決める
+    source = FakeEventSource(events_per_day=page_count * 50 / days_back, latency=latency, principals=("benchmark",))
+
+    _clients["cloudtrail"] = source.as_client()
+    logger.setLevel(logging.WARNING)
+
+    baseline = None
+    for workers in (1, 2, 4, 8):
+        started = time.perf_counter()
+        # 同じ期間を繰り返し計測するため、結果のキャッシュは使わない
+        lambda_handler({"iam_entity": "benchmark", "days_back": days_back, "workers": workers, "no_cache": True}, LocalContext())
+        elapsed = time.perf_counter() - started
+        baseline = baseline or elapsed
+        print(f"サブウィンドウ {workers}: {elapsed:.2f}秒 (x{baseline / elapsed:.1f})")
+
+
+if __name__ == "__main__":
+    main()
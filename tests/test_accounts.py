@@ -0,0 +1,74 @@
+import datetime
+import json
+import sys
+
+import pytest
+
+import cloudtrail_analyzer2
+import cloudtrail_fetcher
+from cloudtrail_accounts import AccountAccessError, AccountPool
+from cloudtrail_sources import FakeStsClient
+
+
+ALLOWED = "111111111111"
+DENIED = "222222222222"
+
+
+# (アカウント, リージョン, 認証情報) を記録するだけのクライアント
+def recording_client_factory(account, region, credentials):
+    return {"account": account, "region": region, "credentials": credentials}
+
+
+@pytest.fixture(autouse=True)
+def reset_account_pool():
+    yield
+    cloudtrail_fetcher.set_account_pool(None)
+
+
+def test_denied_account_raises_and_is_not_retried():
+    sts = FakeStsClient(denied_accounts=[DENIED])
+    pool = AccountPool([ALLOWED, DENIED], sts_client=sts, client_factory=recording_client_factory)
+
+    assert pool.client(ALLOWED, "us-east-1")["account"] == ALLOWED
+    for _ in range(3):
+        with pytest.raises(AccountAccessError):
+            pool.client(DENIED, "us-east-1")
+    assert set(pool.errors) == {DENIED}
+    # 拒否されたアカウントへのAssumeRoleは1回だけ
+    assert sts.calls == 2
+
+
+def test_credentials_are_refreshed_before_expiry():
+    sts = FakeStsClient()
+    pool = AccountPool([ALLOWED], duration_seconds=3600, sts_client=sts, client_factory=recording_client_factory)
+
+    client = pool.client(ALLOWED, "us-east-1")
+    assert pool.client(ALLOWED, "us-east-1") is client
+    assert sts.calls == 1
+
+    # 期限が近づいた認証情報は取得し直し、クライアントも作り直す
+    pool.credentials[ALLOWED]["Expiration"] = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=1)
+    refreshed = pool.client(ALLOWED, "us-east-1")
+    assert sts.calls == 2
+    assert refreshed is not client
+    assert refreshed["credentials"]["SessionToken"] != client["credentials"]["SessionToken"]
+
+
+@pytest.mark.parametrize("adaptive", [False, True])
+def test_analyzer2_skips_denied_account(tmp_path, monkeypatch, adaptive):
+    monkeypatch.chdir(tmp_path)
+    argv = ["cloudtrail_analyzer2.py", "bob", "--start-date", "2025-01-01", "--end-date", "2025-01-02",
+            "--regions", "us-east-1", "--accounts", f"{ALLOWED},{DENIED}",
+            "--source", f"fake:principals=bob,page_size=1000,denied_accounts={DENIED}"]
+    if adaptive:
+        argv.append("--adaptive-chunks")
+    monkeypatch.setattr(sys, "argv", argv)
+    cloudtrail_analyzer2.main()
+
+    with open(tmp_path / "cloudtrail_events_bob_2025-01-01_to_2025-01-02_accounts.json", encoding="utf-8") as f:
+        result = json.load(f)
+    assert set(result["取得できなかったアカウント"]) == {DENIED}
+    assert result["アカウントごとの結果"][DENIED]["取得イベント数"] == 0
+    assert result["アカウントごとの結果"][ALLOWED]["取得イベント数"] == 2000
+    # 全作業単位が完了したためジャーナルは削除される
+    assert list(tmp_path.glob("*.journal")) == []
@@ -0,0 +1,61 @@
+import datetime
+import json
+import tracemalloc
+
+from cloudtrail_aggregate import EventNameStore
+from cloudtrail_analyzer2 import aggregate_cloudtrail_events
+
+
+# 100万イベントの集計でメモリ使用量の最大値がこの値を超えないこと（ページ1つ分とストアの分だけ）
+PEAK_LIMIT_BYTES = 2 * 1024 * 1024
+
+ACTIONS = [
+    ("s3.amazonaws.com", "GetObject"),
+    ("s3.amazonaws.com", "PutObject"),
+    ("ec2.amazonaws.com", "DescribeInstances"),
+    ("iam.amazonaws.com", "GetRole"),
+    ("sts.amazonaws.com", "AssumeRole"),
+]
+
+
+# CloudTrailEvent（レコード）の文字列（集計ではeventSource/eventNameだけを取り出すため、アクションごとに使い回す）
+RECORDS = [
+    json.dumps({
+        "eventVersion": "1.09",
+        "eventSource": event_source,
+        "eventName": event_name,
+        "requestParameters": {"padding": "x" * 256},
+    }, separators=(",", ":"))
+    for event_source, event_name in ACTIONS
+]
+
+# 2025-01-01T00:00:00Z のUNIX時間
+BASE_EPOCH = datetime.datetime(2025, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+
+
+# LookupEvents形式のページを1つずつ作って返すジェネレータ（全イベントを同時には保持しない）
+def generate_pages(total_events, page_size=50):
+    for page_start in range(0, total_events, page_size):
+        yield {
+            "Events": [
+                {"EventId": f"event-{index}", "EventTime": BASE_EPOCH + index, "CloudTrailEvent": RECORDS[index % len(RECORDS)]}
+                for index in range(page_start, min(page_start + page_size, total_events))
+            ]
+        }
+
+
+def test_aggregate_memory_is_bounded_on_1m_event_stream():
+    event_store = EventNameStore()
+    tracemalloc.start()
+    try:
+        events_count = aggregate_cloudtrail_events(generate_pages(1000000), event_store)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert events_count == 1000000
+    assert peak < PEAK_LIMIT_BYTES
+    details = event_store.render_details()
+    assert set(details) == {"s3:GetObject", "s3:PutObject", "ec2:DescribeInstances", "iam:GetRole", "sts:AssumeRole"}
+    assert sum(detail["回数"] for detail in details.values()) == 1000000
+    assert details["s3:GetObject"]["初回"] == "2025-01-01T00:00:00Z"
@@ -0,0 +1,84 @@
+import datetime
+import json
+import sys
+import types
+
+import pytest
+
+import cloudtrail_analyzer
+import cloudtrail_fetcher
+from cloudtrail_cache import LATE_ARRIVAL_MARGIN_SECONDS
+from cloudtrail_sources import FakeEventSource
+
+
+FAKE_SOURCE = "fake:principals=alice,events_per_day=1440,page_size=1000"
+MARGIN = datetime.timedelta(seconds=LATE_ARRIVAL_MARGIN_SECONDS)
+
+
+# datetime.datetime.now() が指定した時刻を返すようにする
+def freeze_now(monkeypatch, now):
+    class FrozenDatetime(datetime.datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now
+
+    monkeypatch.setattr(cloudtrail_analyzer, "datetime", types.SimpleNamespace(datetime=FrozenDatetime, timedelta=datetime.timedelta))
+
+
+def run_analyzer(monkeypatch, now, *args):
+    freeze_now(monkeypatch, now)
+    monkeypatch.setattr(sys, "argv", ["cloudtrail_analyzer.py", "alice", *args, "--source", FAKE_SOURCE])
+    cloudtrail_analyzer.main()
+
+
+# 擬似データで start_time 以上・end_time 以下の時刻のイベント数
+def expected_events(start_time, end_time):
+    first, last = FakeEventSource(events_per_day=1440)._index_range(start_time, end_time)
+    return last - first + 1
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cloudtrail_fetcher, "_event_source", None)
+    return tmp_path
+
+
+def load(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_since_result_neither_overlaps_nor_overwrites_previous_result(workdir, monkeypatch):
+    first_run = datetime.datetime(2025, 3, 1, 12, 0, 30, 500000)
+    run_analyzer(monkeypatch, first_run, "2")
+    (previous_path,) = workdir.glob("cloudtrail_events_alice_*_past2days.json")
+    previous = load(previous_path)
+    previous_end = datetime.datetime.fromisoformat(previous["分析期間"]["終了"])
+    # 遅延配信の可能性がある直近の期間は含めない
+    assert previous_end == (first_run - MARGIN).replace(microsecond=0)
+
+    # 同じ日のうちに再実行しても、結合元のファイルは上書きしない
+    second_run = first_run + datetime.timedelta(hours=3)
+    run_analyzer(monkeypatch, second_run, "--since-result", str(previous_path))
+    assert load(previous_path) == previous
+    (merged_path,) = [path for path in workdir.glob("cloudtrail_events_alice_*_past2days.json") if path != previous_path]
+    merged = load(merged_path)
+    (delta_path,) = workdir.glob("cloudtrail_events_alice_*_delta.json")
+    delta = load(delta_path)
+
+    # 前回の終了時刻の秒のイベントを二重に数えない
+    merged_start = datetime.datetime.fromisoformat(merged["分析期間"]["開始"])
+    merged_end = datetime.datetime.fromisoformat(merged["分析期間"]["終了"])
+    assert merged_end == (second_run - MARGIN).replace(microsecond=0)
+    assert delta["取得イベント数"] == expected_events(previous_end + datetime.timedelta(seconds=1), merged_end)
+    assert merged["取得イベント数"] == expected_events(merged_start, merged_end)
+
+
+def test_since_result_within_margin_fetches_nothing(workdir, monkeypatch):
+    first_run = datetime.datetime(2025, 3, 1, 12, 0, 0)
+    run_analyzer(monkeypatch, first_run, "1")
+    (previous_path,) = workdir.glob("cloudtrail_events_alice_*_past1days.json")
+
+    run_analyzer(monkeypatch, first_run, "--since-result", str(previous_path))
+    assert list(workdir.glob("*_delta.json")) == []
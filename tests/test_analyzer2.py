@@ -0,0 +1,111 @@
+import datetime
+import json
+import sys
+
+import pytest
+
+import cloudtrail_analyzer2
+import cloudtrail_fetcher
+from cloudtrail_accounts import AccountAccessError
+from cloudtrail_journal import RunJournal
+
+
+START = datetime.datetime(2025, 1, 1)
+END = datetime.datetime(2025, 1, 1, 23, 59, 59)
+
+
+def page(event_name, next_token):
+    event = {"EventId": event_name, "CloudTrailEvent": f'{{"eventSource":"s3.amazonaws.com","eventName":"{event_name}","eventTime":"2025-01-01T00:00:00Z"}}'}
+    return {"Events": [event], "NextToken": next_token}
+
+
+# 1ページ目を返した後に error を送出する取得処理
+def failing_pages(error):
+    def iter_event_pages(*args, **kwargs):
+        yield page("GetObject", "token-2")
+        raise error
+    return iter_event_pages
+
+
+def open_journal(path, resume=False):
+    return RunJournal(str(path), {"iam_entity": "alice"}, resume=resume)
+
+
+def test_region_error_propagates_and_unit_is_not_marked_done(tmp_path, monkeypatch):
+    monkeypatch.setattr(cloudtrail_analyzer2, "iter_event_pages", failing_pages(RuntimeError("AccessDenied")))
+    journal = open_journal(tmp_path / "run.journal")
+    with pytest.raises(RuntimeError):
+        cloudtrail_analyzer2.fetch_unit_event_names("alice", START, END, "ap-northeast-1", journal)
+    journal.close()
+
+    # 再開時は完了済みとせず、失敗したページから取得し直す
+    resumed = open_journal(tmp_path / "run.journal", resume=True)
+    (progress,) = resumed.units.values()
+    assert not progress.done
+    assert progress.next_token == "token-2"
+    events_count, _ = progress.result("alice")
+    assert events_count == 1
+    resumed.close()
+
+
+def test_denied_account_is_skipped_without_journaling(tmp_path, monkeypatch):
+    monkeypatch.setattr(cloudtrail_analyzer2, "iter_event_pages", failing_pages(AccountAccessError("denied")))
+    journal = open_journal(tmp_path / "run.journal")
+    events_count, event_store = cloudtrail_analyzer2.fetch_unit_event_names(
+        "alice", START, END, "ap-northeast-1", journal, account="111111111111")
+    journal.close()
+    assert events_count == 0
+    assert event_store.render() == {}
+
+    resumed = open_journal(tmp_path / "run.journal", resume=True)
+    assert not any(progress.done for progress in resumed.units.values())
+    resumed.close()
+
+
+def raising_pages(*args, **kwargs):
+    raise RuntimeError("failed")
+    yield
+
+
+# 密度を調べたリージョンを記録する
+def counting_planner(calls):
+    plan_time_chunks = cloudtrail_analyzer2.plan_time_chunks
+
+    def planner(*args, **kwargs):
+        calls.append(args[2])
+        return plan_time_chunks(*args, **kwargs)
+    return planner
+
+
+def run_analyzer2(monkeypatch, workdir, argv, calls, pages=None):
+    monkeypatch.chdir(workdir)
+    monkeypatch.setattr(cloudtrail_fetcher, "_event_source", None)
+    monkeypatch.setattr(cloudtrail_analyzer2, "plan_time_chunks", counting_planner(calls))
+    if pages is not None:
+        monkeypatch.setattr(cloudtrail_analyzer2, "iter_event_pages", pages)
+    monkeypatch.setattr(sys, "argv", argv)
+    try:
+        cloudtrail_analyzer2.main()
+    finally:
+        monkeypatch.undo()
+    with open(workdir / "cloudtrail_events_bob_2025-01-01_to_2025-01-02.json", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_resume_reuses_adaptive_chunk_plan(tmp_path, monkeypatch):
+    argv = ["cloudtrail_analyzer2.py", "bob", "--start-date", "2025-01-01", "--end-date", "2025-01-02",
+            "--regions", "us-east-1,ap-northeast-1", "--source", "fake:principals=bob,page_size=1000", "--adaptive-chunks"]
+    (tmp_path / "reference").mkdir()
+    expected = run_analyzer2(monkeypatch, tmp_path / "reference", argv, [])
+
+    # 1回目は計画した後の取得で失敗する
+    calls = []
+    with pytest.raises(SystemExit):
+        run_analyzer2(monkeypatch, tmp_path, argv, calls, raising_pages)
+    assert sorted(calls) == ["ap-northeast-1", "us-east-1"]
+
+    # 再開時はジャーナルに記録した計画を使い、密度を調べ直さない
+    result = run_analyzer2(monkeypatch, tmp_path, argv + ["--resume"], calls)
+    assert len(calls) == 2
+    assert result["取得イベント数"] == expected["取得イベント数"]
+    assert result["サービスごとのCloudTrailイベント"] == expected["サービスごとのCloudTrailイベント"]
@@ -0,0 +1,93 @@
+import datetime
+import sqlite3
+
+import pytest
+
+import cloudtrail_fetcher
+from cloudtrail_cache import EventCache, iter_cached_event_pages
+from cloudtrail_extract import to_epoch
+from cloudtrail_fetcher import iter_event_pages
+from cloudtrail_planner import build_time_chunks
+from cloudtrail_sources import FakeEventSource
+
+
+START = datetime.datetime(2025, 1, 1)
+END = datetime.datetime(2025, 1, 1, 0, 59, 59)
+
+# 15分ごとのチャンク
+CHUNK_DAYS = 15 / 1440
+
+
+@pytest.fixture
+def fake_source(monkeypatch):
+    # 1秒に1件のため、チャンクの最後の秒にもイベントがある
+    source = FakeEventSource(events_per_day=86400, page_size=1000, principals=("u",))
+    source.rate_limited = False
+    monkeypatch.setattr(cloudtrail_fetcher, "_event_source", source)
+    return source
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = EventCache(str(tmp_path / "events.sqlite3"))
+    yield cache
+    cache.close()
+
+
+def count_events(pages):
+    return sum(len(data.get("Events", [])) for data in pages)
+
+
+def test_cached_chunks_match_direct_fetch(fake_source, cache):
+    chunks = build_time_chunks(START, END, CHUNK_DAYS)
+    assert len(chunks) == 4
+    direct = sum(count_events(iter_event_pages("u", start, end)) for start, end in chunks)
+    assert direct == 3600
+
+    # 1回目はAPIから取得し、2回目は全てキャッシュから読み出す
+    assert sum(count_events(iter_cached_event_pages(cache, "u", start, end)) for start, end in chunks) == direct
+    calls = fake_source.calls
+    assert sum(count_events(iter_cached_event_pages(cache, "u", start, end)) for start, end in chunks) == direct
+    assert fake_source.calls == calls
+    # 取得済みの期間は隙間なく1つにまとまる
+    assert cache.covered_windows("u", "default") == [(to_epoch(START), to_epoch(END) + 1)]
+
+
+def test_cached_range_includes_end_second(fake_source, cache):
+    # 終了時刻の秒（00:00:10）のイベントも含む
+    end_time = START + datetime.timedelta(seconds=10)
+    assert count_events(iter_cached_event_pages(cache, "u", START, end_time)) == 11
+    assert count_events(iter_cached_event_pages(cache, "u", end_time, end_time)) == 1
+
+
+def test_sources_and_accounts_do_not_share_cache(fake_source, tmp_path):
+    path = str(tmp_path / "events.sqlite3")
+    fake_cache = EventCache(path, "fake:principals=u")
+    end_time = START + datetime.timedelta(seconds=10)
+    assert count_events(iter_cached_event_pages(fake_cache, "u", START, end_time)) == 11
+    fake_cache.close()
+
+    # 同じファイルでも、取得元やアカウントが異なれば取得済みの期間として扱わない
+    api_cache = EventCache(path)
+    assert api_cache.covered_windows("u", "default") == []
+    assert api_cache.missing_windows("u", "default", to_epoch(START), to_epoch(end_time) + 1) == [(to_epoch(START), to_epoch(end_time) + 1)]
+    api_cache.close()
+
+    fake_cache = EventCache(path, "fake:principals=u")
+    assert fake_cache.covered_windows("u", "default") == [(to_epoch(START), to_epoch(end_time) + 1)]
+    assert fake_cache.covered_windows("u", "default", account="111111111111") == []
+    fake_cache.close()
+
+
+def test_old_format_cache_is_recreated(tmp_path):
+    path = str(tmp_path / "events.sqlite3")
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE windows (principal TEXT, region TEXT, start_time REAL, end_time REAL);
+        INSERT INTO windows VALUES ('u', 'default', 0, 100);
+    """)
+    connection.close()
+
+    cache = EventCache(path)
+    assert cache.covered_windows("u", "default") == []
+    cache.close()
@@ -0,0 +1,118 @@
+import datetime
+import gzip
+import json
+
+import pytest
+
+from cloudtrail_dedup import EventIdFilter
+from cloudtrail_sources import S3ExportSource
+
+
+def event(event_id, event_source="s3.amazonaws.com"):
+    return {"EventId": event_id, "EventSource": event_source, "CloudTrailEvent": "{}"}
+
+
+def page(event_ids, next_token=None, event_source="s3.amazonaws.com"):
+    return {"Events": [event(event_id, event_source) for event_id in event_ids], "NextToken": next_token}
+
+
+# filter_pages で残ったイベントのEventId（ページごと）
+def kept_ids(dedup, pages, region=None, account=None):
+    return [[event["EventId"] for event in data["Events"]] for data in dedup.filter_pages(pages, region, account)]
+
+
+def test_overlapping_pages_keep_first_occurrence():
+    dedup = EventIdFilter()
+    pages = [page(["a", "b", "c", "d"], "token-2"), page(["c", "d", "e", "f"])]
+    filtered = list(dedup.filter_pages(pages))
+    assert [[e["EventId"] for e in data["Events"]] for data in filtered] == [["a", "b", "c", "d"], ["e", "f"]]
+    # NextTokenなどイベント以外の項目はそのまま
+    assert [data["NextToken"] for data in filtered] == ["token-2", None]
+    assert (dedup.raw_events, dedup.duplicates, dedup.global_skipped) == (8, 2, 0)
+
+    # 別の作業単位（別のリージョン）で同じEventIdが現れた場合も重複として数える
+    assert kept_ids(dedup, [page(["f", "g"])], region="ap-northeast-1") == [["g"]]
+    assert (dedup.raw_events, dedup.duplicates) == (10, 3)
+
+
+def test_switches_to_bloom_filter_at_exact_limit(capsys):
+    dedup = EventIdFilter(exact_limit=3, bloom_capacity=1000)
+    assert kept_ids(dedup, [page(["a", "b", "c"])]) == [["a", "b", "c"]]
+    assert dedup.bloom is None
+
+    # exact_limit を超えた時点でBloomフィルタに切り替え、それまでのEventIdも引き継ぐ
+    assert kept_ids(dedup, [page(["d", "a", "e", "b", "e"])]) == [["d", "e"]]
+    assert dedup.bloom is not None
+    assert dedup.keys == set()
+    assert "Bloomフィルタ" in capsys.readouterr().out
+    assert kept_ids(dedup, [page(["c", "d", "f"])]) == [["f"]]
+    assert (dedup.raw_events, dedup.duplicates) == (11, 5)
+    assert dedup.render_stats()["重複の判定"] == "EventId（Bloomフィルタ、誤判定率 1e-06）"
+
+
+def test_accounts_are_deduplicated_separately():
+    dedup = EventIdFilter()
+    assert kept_ids(dedup, [page(["a", "b"])], account="111111111111") == [["a", "b"]]
+    # 別のアカウントの同じEventIdは別のイベント
+    assert kept_ids(dedup, [page(["a", "b"])], account="222222222222") == [["a", "b"]]
+    assert kept_ids(dedup, [page(["b", "c"])], account="111111111111") == [["c"]]
+    assert dedup.duplicates == 1
+
+
+def test_global_services_are_counted_only_in_us_east_1():
+    dedup = EventIdFilter(["ap-northeast-1", "us-east-1"])
+    pages = [{"Events": [event("iam-1", "iam.amazonaws.com"), event("cf-1", "cloudfront.amazonaws.com"),
+                         event("r53-1", "route53.amazonaws.com"), event("sts-1", "sts.amazonaws.com"),
+                         event("s3-1")]}]
+    # us-east-1 以外ではIAM・CloudFront・Route 53のイベントを除き、STSは残す
+    assert kept_ids(dedup, pages, region="ap-northeast-1") == [["sts-1", "s3-1"]]
+    assert (dedup.raw_events, dedup.duplicates, dedup.global_skipped) == (5, 0, 3)
+
+    assert kept_ids(dedup, [page(["iam-1"], event_source="iam.amazonaws.com"), page(["sts-2"], event_source="sts.amazonaws.com")],
+                    region="us-east-1") == [["iam-1"], ["sts-2"]]
+    assert dedup.global_skipped == 3
+
+
+def test_global_services_are_kept_without_us_east_1():
+    dedup = EventIdFilter(["ap-northeast-1", "eu-west-1"])
+    assert kept_ids(dedup, [page(["iam-1"], event_source="iam.amazonaws.com")], region="ap-northeast-1") == [["iam-1"]]
+    assert dedup.global_skipped == 0
+
+
+def test_events_without_event_id_are_kept():
+    dedup = EventIdFilter()
+    events = [event(""), event(""), {"EventSource": "s3.amazonaws.com", "CloudTrailEvent": "{}"}, event("a"), event("a")]
+    (filtered,) = dedup.filter_pages([{"Events": events}])
+    # EventIdのないイベントは全て残し、重複として数えない
+    assert len(filtered["Events"]) == 4
+    assert (dedup.raw_events, dedup.duplicates) == (5, 1)
+
+
+def test_s3_export_records_without_event_id_are_not_dropped(tmp_path):
+    records = [
+        {"eventTime": f"2025-01-01T00:00:0{i}Z", "eventSource": "s3.amazonaws.com", "eventName": "GetObject",
+         "awsRegion": "us-east-1", "userIdentity": {"type": "IAMUser", "userName": "alice"}}
+        for i in range(3)
+    ]
+    with gzip.open(tmp_path / "log.json.gz", "wt", encoding="utf-8") as f:
+        json.dump({"Records": records}, f)
+    source = S3ExportSource([str(tmp_path)])
+    data = source.lookup_events_page("alice", datetime.datetime(2025, 1, 1), datetime.datetime(2025, 1, 1, 0, 0, 59), "us-east-1")
+    assert [event["EventId"] for event in data["Events"]] == ["", "", ""]
+
+    dedup = EventIdFilter(["us-east-1"])
+    (filtered,) = dedup.filter_pages([data], "us-east-1")
+    assert len(filtered["Events"]) == 3
+    assert dedup.duplicates == 0
+
+
+@pytest.mark.parametrize("exact_limit", [1000000, 2])
+def test_render_stats(exact_limit):
+    dedup = EventIdFilter(["ap-northeast-1", "us-east-1"], exact_limit=exact_limit, bloom_capacity=1000)
+    list(dedup.filter_pages([page(["a", "b", "c"]), page(["c", "d"])], region="us-east-1"))
+    list(dedup.filter_pages([page(["d", "e"]), page(["iam-1"], event_source="iam.amazonaws.com")], region="ap-northeast-1"))
+    stats = dedup.render_stats()
+    assert stats["取得イベント数（重複を含む）"] == 8
+    assert stats["重複したイベント数"] == 2
+    assert stats["us-east-1以外で除いたグローバルサービスのイベント数"] == 1
+    assert stats["重複の判定"] == ("EventId" if exact_limit > 5 else "EventId（Bloomフィルタ、誤判定率 1e-06）")
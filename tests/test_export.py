@@ -0,0 +1,88 @@
+import datetime
+import os
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import cloudtrail_export
+from cloudtrail_export import EventExporter, count_exported_events, find_export_files, read_export
+from cloudtrail_sources import FakeEventSource
+
+
+START = datetime.datetime(2025, 1, 1)
+END = datetime.datetime(2025, 1, 2, 23, 59, 59)
+
+
+# 擬似データのページ（2日間で1050件、50件ずつ。全イベントを principals で分け合う）
+def fake_pages(iam_entity="alice", principals=("alice",)):
+    source = FakeEventSource(events_per_day=525, principals=principals)
+    next_token = None
+    while True:
+        data = source.lookup_events_page(iam_entity, START, END, None, next_token, None)
+        yield data
+        next_token = data.get("NextToken")
+        if not next_token:
+            return
+
+
+@pytest.mark.parametrize("export_format", ["parquet", "arrow"])
+def test_round_trip_with_part_rollover(tmp_path, export_format):
+    exporter = EventExporter(str(tmp_path), export_format, batch_rows=100)
+    events = [event for data in exporter.export_pages(fake_pages(), "alice") for event in data["Events"]]
+    assert len(events) == 1050
+    # 100行ごとに1ファイル書き出し、残りは close で書き出す
+    assert exporter.parts == 10
+    exporter.close()
+    assert exporter.parts == 11
+    assert exporter.total_rows == 1050
+
+    paths = find_export_files(str(tmp_path))
+    assert len(paths) == 11
+    assert all(path.endswith(cloudtrail_export.EXPORT_FORMATS[export_format]) for path in paths)
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+    table = read_export(str(tmp_path)).to_pydict()
+    assert tuple(table) == cloudtrail_export.EXPORT_COLUMNS
+    assert set(table["principal"]) == {"alice"}
+    expected = sorted((event["EventTime"], event["EventSource"], event["EventName"]) for event in events)
+    assert sorted(zip(table["eventTime"], table["eventSource"], table["eventName"])) == expected
+    assert set(table["awsRegion"]) == {"us-east-1"}
+
+    # 列を絞った読み込みと日付ごとの集計
+    assert read_export(str(tmp_path), ["eventName"]).column_names == ["eventName"]
+    by_date = dict(count_exported_events(str(tmp_path), ("date",)))
+    assert by_date == {(datetime.date(2025, 1, 1),): 525, (datetime.date(2025, 1, 2),): 525}
+
+
+def test_principals_filter_on_shared_scan(tmp_path):
+    exporter = EventExporter(str(tmp_path), batch_rows=100)
+    for _ in exporter.export_pages(fake_pages(None, ("alice", "bob")), None, principals={"bob"}):
+        pass
+    exporter.close()
+    table = read_export(str(tmp_path), ["principal"]).to_pydict()
+    assert set(table["principal"]) == {"bob"}
+    assert 0 < exporter.total_rows < 1050
+    assert count_exported_events(str(tmp_path), ("principal",), principal="bob") == [(("bob",), exporter.total_rows)]
+
+
+def test_part_is_written_to_tmp_then_replaced(tmp_path, monkeypatch):
+    replaced = []
+
+    def failing_replace(src, dst):
+        replaced.append((src, dst))
+        raise OSError("disk full")
+
+    monkeypatch.setattr(cloudtrail_export.os, "replace", failing_replace)
+    exporter = EventExporter(str(tmp_path), batch_rows=100)
+    with pytest.raises(OSError):
+        for _ in exporter.export_pages(fake_pages(), "alice"):
+            pass
+
+    # 書き出しに失敗したファイルは一時ファイルのまま残り、読み込みの対象にならない
+    ((src, dst),) = replaced
+    assert src == f"{dst}.tmp"
+    assert os.path.exists(src) and not os.path.exists(dst)
+    assert find_export_files(str(tmp_path)) == []
+    assert read_export(str(tmp_path)).num_rows == 0
+    assert exporter.total_rows == 0
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from cloudtrail_extract import (
+    _build_sample_event,
+    extract_event_fields,
+    extract_event_source_and_name,
+    extract_event_source_and_name_full,
+    normalize_service_name,
+)
+
+
+# ネストしたフィールドより前・後にあるフィールド、文字列以外の値のフィールド、存在しないフィールド
+FIELDS = ("eventSource", "eventName", "awsRegion", "sourceIPAddress", "eventID", "readOnly", "eventType", "errorCode")
+
+
+# 全体をパースした場合のフィールドの値
+def full_fields(raw, fields):
+    event_details = json.loads(raw)
+    return tuple(event_details.get(field) for field in fields)
+
+
+RECORDS = [
+    # CloudTrailと同じコンパクトなJSON（ネストしたフィールドにも eventSource がある）
+    _build_sample_event(0, 256),
+    _build_sample_event(1, 4096),
+    # 空白入りのJSON
+    json.dumps({"eventSource": "s3.amazonaws.com", "eventName": "GetObject", "awsRegion": "us-east-1"}),
+    # エスケープを含む値
+    json.dumps({"eventSource": "s3.amazonaws.com", "eventName": "Get\\Object", "sourceIPAddress": "a\"b"}, separators=(",", ":")),
+    # errorCode が null、ネストしたフィールドより後に eventName がある
+    json.dumps({
+        "eventSource": "ec2.amazonaws.com",
+        "errorCode": None,
+        "requestParameters": {"eventName": "Nested", "awsRegion": "nested-region"},
+        "eventName": "RunInstances",
+        "awsRegion": "ap-northeast-1",
+    }, separators=(",", ":")),
+    # ネストしたフィールドにだけ awsRegion がある
+    json.dumps({
+        "eventSource": "iam.amazonaws.com",
+        "eventName": "GetRole",
+        "responseElements": {"awsRegion": "nested-region"},
+    }, separators=(",", ":")),
+    # eventName がない
+    json.dumps({"eventSource": "s3.amazonaws.com", "requestParameters": {}}, separators=(",", ":")),
+]
+
+
+@pytest.mark.parametrize("raw", RECORDS)
+def test_extract_event_source_and_name_matches_full_parse(raw):
+    assert extract_event_source_and_name(raw) == extract_event_source_and_name_full(raw)
+
+
+@pytest.mark.parametrize("raw", RECORDS)
+def test_extract_event_fields_matches_full_parse(raw):
+    assert extract_event_fields(raw, FIELDS) == full_fields(raw, FIELDS)
+
+
+def test_fields_after_nested_markers_are_extracted():
+    raw = _build_sample_event(7, 512)
+    assert extract_event_fields(raw, ("eventID", "eventType", "readOnly")) == ("event-7", "AwsApiCall", True)
+
+
+def test_sample_events_match_full_parse():
+    for index in range(200):
+        raw = _build_sample_event(index, 128)
+        assert extract_event_source_and_name(raw) == extract_event_source_and_name_full(raw)
+        assert extract_event_fields(raw, FIELDS) == full_fields(raw, FIELDS)
+
+
+@pytest.mark.parametrize("event_source, service", [
+    ("s3.amazonaws.com", "s3"),
+    ("ssm-incidents.amazonaws.com", "ssmincidents"),
+    ("iam.amazonaws.com", "iam"),
+])
+def test_normalize_service_name(event_source, service):
+    assert normalize_service_name(event_source) == service
@@ -0,0 +1,105 @@
+import datetime
+
+import pytest
+
+import cloudtrail_chunks
+import cloudtrail_fetcher
+from cloudtrail_chunks import fetch_chunk_events
+from cloudtrail_fetcher import iter_event_pages
+from cloudtrail_journal import RunJournal
+from cloudtrail_sources import FakeEventSource
+
+
+START = datetime.datetime(2025, 1, 1)
+END = datetime.datetime(2025, 1, 1, 23, 59, 59)
+PARAMS = {"iam_entity": "u"}
+
+
+@pytest.fixture(autouse=True)
+def fake_source(monkeypatch):
+    # 1日500件を50件ずつ取得するため、1チャンクは10ページ
+    source = FakeEventSource(events_per_day=500, page_size=50, principals=("u",))
+    source.rate_limited = False
+    monkeypatch.setattr(cloudtrail_fetcher, "_event_source", source)
+    return source
+
+
+# 取得を始めたページのトークンを記録し、stop_after ページ目の後にジャーナルを止める取得処理
+def recording_pages(journal, next_tokens, stop_after=None):
+    def pages(*args, **kwargs):
+        next_tokens.append(kwargs.get("next_token"))
+        for page_number, data in enumerate(iter_event_pages(*args, **kwargs), 1):
+            yield data
+            if page_number == stop_after:
+                journal.stop()
+    return pages
+
+
+def test_resume_continues_from_saved_token(tmp_path, monkeypatch):
+    path = str(tmp_path / "run.journal")
+    expected_count, expected_store = fetch_chunk_events("u", 0, 1, START, END)
+    assert expected_count == 500
+
+    # 3ページ目の後に中断する
+    journal = RunJournal(path, PARAMS)
+    next_tokens = []
+    monkeypatch.setattr(cloudtrail_chunks, "iter_event_pages", recording_pages(journal, next_tokens, stop_after=3))
+    with pytest.raises(KeyboardInterrupt):
+        fetch_chunk_events("u", 0, 1, START, END, journal=journal)
+    journal.close()
+    assert next_tokens == [None]
+
+    # 再開時は記録した3ページ分の集計結果と次のページのトークンを読み込む
+    resumed = RunJournal(path, PARAMS, resume=True)
+    (progress,) = resumed.units.values()
+    assert not progress.done
+    assert progress.next_token is not None
+    assert progress.result("u")[0] == 150
+
+    saved_token = progress.next_token
+    monkeypatch.setattr(cloudtrail_chunks, "iter_event_pages", recording_pages(resumed, next_tokens))
+    events_count, event_store = fetch_chunk_events("u", 0, 1, START, END, journal=resumed)
+    resumed.close()
+    assert next_tokens == [None, saved_token]
+    assert events_count == expected_count
+    assert event_store.render_details() == expected_store.render_details()
+
+    # 完了した作業単位は再度取得しない
+    completed = RunJournal(path, PARAMS, resume=True)
+    assert fetch_chunk_events("u", 0, 1, START, END, journal=completed)[0] == expected_count
+    completed.close()
+    assert next_tokens == [None, saved_token]
+
+
+def test_torn_last_line_is_skipped(tmp_path, monkeypatch):
+    path = str(tmp_path / "run.journal")
+    journal = RunJournal(path, PARAMS)
+    monkeypatch.setattr(cloudtrail_chunks, "iter_event_pages", recording_pages(journal, [], stop_after=2))
+    with pytest.raises(KeyboardInterrupt):
+        fetch_chunk_events("u", 0, 1, START, END, journal=journal)
+    journal.close()
+
+    # 書き込み途中でプロセスが終了した場合の不完全な最後の行
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"type":"page","unit":"u/2025-01-01T00:00:00/2025-01-01T23:59:59","next_tok')
+
+    resumed = RunJournal(path, PARAMS, resume=True)
+    (progress,) = resumed.units.values()
+    assert progress.result("u")[0] == 100
+    assert not progress.done
+    resumed.close()
+
+
+def test_chunk_plans_are_restored_on_resume(tmp_path):
+    path = str(tmp_path / "run.journal")
+    plans = [(("111111111111", "us-east-1"), [(START, START + datetime.timedelta(hours=6)), (START + datetime.timedelta(hours=6, seconds=1), END)]),
+             (None, [(START, END)])]
+    journal = RunJournal(path, PARAMS, run_info={"end_time": END.isoformat()})
+    assert journal.chunk_plans() is None
+    journal.record_chunk_plans(plans)
+    journal.close()
+
+    resumed = RunJournal(path, PARAMS, resume=True)
+    assert resumed.chunk_plans() == plans
+    assert resumed.run_info["end_time"] == END.isoformat()
+    resumed.close()
@@ -0,0 +1,130 @@
+import datetime
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import lambda_extractor
+from cloudtrail_aggregate import DETAILS_KEY
+from cloudtrail_checkpoint import FileCheckpointStore
+from cloudtrail_sources import FakeEventSource
+
+
+@pytest.fixture
+def fake_cloudtrail(monkeypatch):
+    monkeypatch.setitem(lambda_extractor._clients, "cloudtrail", FakeEventSource(events_per_day=5000, principals=("u",)).as_client())
+    monkeypatch.setattr(lambda_extractor, "emit_metrics", lambda: None)
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 4, 16])
+def test_split_windows_do_not_overlap(count):
+    start_time = datetime.datetime(2025, 1, 1, 0, 0, 0, 500000)
+    end_time = datetime.datetime(2025, 1, 2, 23, 59, 59, 250000)
+    windows = lambda_extractor.split_windows(start_time, end_time, count)
+
+    assert len(windows) == count
+    assert windows[0]["start_time"] == "2025-01-01T00:00:00"
+    assert windows[-1]["end_time"] == "2025-01-02T23:59:59"
+    for previous, window in zip(windows, windows[1:]):
+        previous_end = datetime.datetime.fromisoformat(previous["end_time"])
+        assert datetime.datetime.fromisoformat(window["start_time"]) == previous_end + datetime.timedelta(seconds=1)
+
+
+def test_split_windows_skips_windows_shorter_than_a_second():
+    start_time = datetime.datetime(2025, 1, 1)
+    windows = lambda_extractor.split_windows(start_time, start_time, 4)
+    assert [(window["start_time"], window["end_time"]) for window in windows] == [("2025-01-01T00:00:00", "2025-01-01T00:00:00")]
+
+
+@pytest.mark.parametrize("workers", [1, 2, 4, 16])
+def test_total_events_do_not_depend_on_workers(fake_cloudtrail, workers):
+    event = {"iam_entity": "u", "start_time": "2025-01-01T00:00:00", "end_time": "2025-01-02T23:59:59",
+             "workers": workers, "no_cache": True}
+    response = lambda_extractor.lambda_handler(event, lambda_extractor.LocalContext())
+    assert response["取得イベント数"] == 10000
+
+
+def test_days_back_results_are_not_cached():
+    assert lambda_extractor.result_cache_key({"iam_entity": "u", "days_back": 30}) is None
+    assert lambda_extractor.result_cache_key({"iam_entity": "u"}) is None
+    assert lambda_extractor.result_cache_key({"iam_entity": "u", "start_time": "2025-01-01T00:00:00", "end_time": "2025-01-02T23:59:59"}) is not None
+
+
+# Lambdaのデプロイパッケージに含めないモジュール（SQLiteのキャッシュ・ローカル用の取得元など）を読み込まない
+def test_import_does_not_load_local_only_modules():
+    code = "import sys, lambda_extractor; print(' '.join(sorted(sys.modules)))"
+    completed = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    modules = set(completed.stdout.split())
+    assert {"cloudtrail_aggregate", "cloudtrail_extract", "cloudtrail_checkpoint", "cloudtrail_metrics"} <= modules
+    assert not modules & {"sqlite3", "cloudtrail_cache", "cloudtrail_sources", "cloudtrail_presence", "cloudtrail_fetcher"}
+
+
+# 残り時間が常に少ないコンテキスト（各サブウィンドウで1ページ取得するたびに中断する）
+class LowTimeContext(lambda_extractor.LocalContext):
+    aws_request_id = "low-time"
+
+    def get_remaining_time_in_millis(self):
+        return lambda_extractor.CHECKPOINT_MARGIN_MILLIS - 1
+
+
+# 非同期の再実行のペイロードを記録するだけのLambdaクライアント
+class RecordingLambdaClient:
+    def __init__(self):
+        self.payloads = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.payloads.append(json.loads(Payload))
+
+
+CONTINUATION_EVENT = {"iam_entity": "u", "start_time": "2025-01-01T00:00:00", "end_time": "2025-01-01T23:59:59",
+                      "workers": 4, "no_cache": True}
+
+
+@pytest.mark.parametrize("use_store", [False, True])
+def test_continuation_gives_same_totals(fake_cloudtrail, monkeypatch, tmp_path, use_store):
+    monkeypatch.setitem(lambda_extractor._clients, "checkpoint_store",
+                        FileCheckpointStore(str(tmp_path)) if use_store else None)
+    expected = lambda_extractor.lambda_handler(CONTINUATION_EVENT, lambda_extractor.LocalContext())
+
+    response = lambda_extractor.lambda_handler(CONTINUATION_EVENT, LowTimeContext())
+    invocations = 1
+    while response.get("継続"):
+        assert ("checkpoint" in response) != use_store
+        # 返されたペイロードで再実行すると続きから処理する
+        payload = {key: value for key, value in response.items() if key not in ("継続", "処理済みイベント数")}
+        response = lambda_extractor.lambda_handler(payload, LowTimeContext())
+        invocations += 1
+
+    # 5000件を50件ずつ4つのサブウィンドウで取得するため、1回の実行で4ページずつ進む
+    assert invocations == 25
+    assert response["取得イベント数"] == expected["取得イベント数"] == 5000
+    assert response["サービスごとのアクション"] == expected["サービスごとのアクション"]
+    assert response[DETAILS_KEY] == expected[DETAILS_KEY]
+    # 完了したチェックポイントは削除される
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_auto_continue_reinvokes_with_checkpoint(fake_cloudtrail, monkeypatch):
+    lambda_client = RecordingLambdaClient()
+    monkeypatch.setitem(lambda_extractor._clients, "checkpoint_store", None)
+    monkeypatch.setitem(lambda_extractor._clients, "lambda", lambda_client)
+
+    response = lambda_extractor.lambda_handler({**CONTINUATION_EVENT, "auto_continue": True}, LowTimeContext())
+    while lambda_client.payloads:
+        response = lambda_extractor.lambda_handler(lambda_client.payloads.pop(), LowTimeContext())
+    assert response["取得イベント数"] == 5000
+
+
+def test_auto_continue_without_store_rejects_oversized_payload(fake_cloudtrail, monkeypatch):
+    lambda_client = RecordingLambdaClient()
+    monkeypatch.setitem(lambda_extractor._clients, "checkpoint_store", None)
+    monkeypatch.setitem(lambda_extractor._clients, "lambda", lambda_client)
+    monkeypatch.setattr(lambda_extractor, "ASYNC_PAYLOAD_LIMIT_BYTES", 1024)
+
+    response = lambda_extractor.lambda_handler({**CONTINUATION_EVENT, "auto_continue": True}, LowTimeContext())
+    # 上限を超える途中結果はペイロードに含めず、チェックポイントのストアを指定するよう返す
+    assert "CHECKPOINT_BUCKET" in response["エラー"]
+    assert lambda_client.payloads == []
@@ -0,0 +1,93 @@
+import datetime
+
+import pytest
+
+import cloudtrail_fetcher
+from cloudtrail_planner import CHUNK_GAP, build_time_chunks, estimate_window_events, plan_chunks
+from cloudtrail_sources import FakeEventSource
+
+
+START = datetime.datetime(2025, 1, 1)
+
+
+# 1日ごとのチャンクと推定イベント数の一覧を作る
+def daily_estimates(counts):
+    chunks = build_time_chunks(START, START + datetime.timedelta(days=len(counts)) - CHUNK_GAP, 1)
+    return [(start, end, count) for (start, end), count in zip(chunks, counts)]
+
+
+# 作業単位が期間全体を隙間・重なりなく覆っていることを確認する
+def assert_contiguous(plan, start_time, end_time):
+    assert plan[0][0] == start_time
+    assert plan[-1][1] == end_time
+    for (_, previous_end, _), (start, _, _) in zip(plan, plan[1:]):
+        assert start == previous_end + CHUNK_GAP
+
+
+@pytest.fixture
+def fake_source(monkeypatch):
+    source = FakeEventSource(events_per_day=8640, principals=("u",))
+    # 擬似データはAPI制限を再現しないため、レート制御もしない
+    source.rate_limited = False
+    monkeypatch.setattr(cloudtrail_fetcher, "_event_source", source)
+    return source
+
+
+def test_dense_chunk_is_split_into_target_sized_pieces():
+    estimates = daily_estimates([5000])
+    plan = plan_chunks(estimates, target_events=2000)
+    assert len(plan) == 3
+    assert [estimate for _, _, estimate in plan] == pytest.approx([5000 / 3] * 3)
+    assert_contiguous(plan, estimates[0][0], estimates[0][1])
+
+
+def test_split_is_capped_at_max_split():
+    plan = plan_chunks(daily_estimates([100000]), target_events=2000, max_split=4)
+    assert len(plan) == 4
+
+
+def test_adjacent_sparse_chunks_are_merged_up_to_target():
+    estimates = daily_estimates([500, 500, 500, 500, 500, 100])
+    plan = plan_chunks(estimates, target_events=2000)
+    assert [estimate for _, _, estimate in plan] == [2000, 600]
+    assert_contiguous(plan, estimates[0][0], estimates[-1][1])
+
+
+def test_sparse_chunks_are_not_merged_across_dense_chunk():
+    estimates = daily_estimates([100, 5000, 100])
+    plan = plan_chunks(estimates, target_events=2000)
+    assert [round(estimate) for _, _, estimate in plan] == [100, 1667, 1667, 1667, 100]
+    assert_contiguous(plan, estimates[0][0], estimates[-1][1])
+
+
+def test_empty_plan_for_no_chunks():
+    assert plan_chunks([]) == []
+
+
+def test_estimate_is_exact_when_window_fits_in_one_page(fake_source):
+    # 1日8640件（10秒ごと）のため、5分間は30件で1ページに収まる
+    start_time = START
+    end_time = START + datetime.timedelta(minutes=5) - CHUNK_GAP
+    assert estimate_window_events("u", start_time, end_time) == 30
+
+
+def test_estimate_extrapolates_from_first_page_density(fake_source):
+    end_time = START + datetime.timedelta(days=1) - CHUNK_GAP
+    estimate = estimate_window_events("u", START, end_time)
+    assert estimate == pytest.approx(8640, rel=0.05)
+
+
+@pytest.mark.parametrize("start_time, end_time", [
+    (START, START + datetime.timedelta(days=21) - CHUNK_GAP),
+    (START.replace(microsecond=500000), START + datetime.timedelta(days=14, microseconds=250000)),
+    (START.replace(microsecond=999999), START + datetime.timedelta(days=7)),
+])
+def test_time_chunks_are_whole_seconds_and_contiguous(start_time, end_time):
+    chunks = build_time_chunks(start_time, end_time, 7)
+    assert all(start.microsecond == 0 and end.microsecond == 0 and start <= end for start, end in chunks)
+    assert_contiguous([(start, end, 0) for start, end in chunks], start_time.replace(microsecond=0), end_time.replace(microsecond=0))
+
+
+def test_time_chunks_for_a_single_second():
+    assert build_time_chunks(START, START.replace(microsecond=500000), 7) == [(START, START)]
+    assert build_time_chunks(START, START - CHUNK_GAP, 7) == []
@@ -0,0 +1,107 @@
+import json
+import os
+
+from cloudtrail_extract import normalize_service_name
+from cloudtrail_policy import generate_policy, group_actions, load_index, load_mapping
+
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STS_CATALOG = load_index()["catalogs"]["sts"]
+
+
+# eventSource と eventName から分析結果の「サービス名:イベント名」を作る
+def event_name(event_source, name):
+    return f"{normalize_service_name(event_source)}:{name}"
+
+
+def policy_actions(service_event_names, catalogs=None, wildcards=True):
+    policy, unmapped, no_permission = generate_policy(service_event_names, catalogs, wildcards)
+    return policy["Statement"][0]["Action"], unmapped, no_permission
+
+
+def test_wildcard_only_when_catalog_is_fully_covered():
+    assert group_actions("sts", set(STS_CATALOG), STS_CATALOG) == ["sts:*"]
+    # 一覧のアクションが1つでも未使用ならサービス全体のワイルドカードにしない
+    actions = set(STS_CATALOG) - {"GetSessionToken"}
+    grouped = group_actions("sts", actions, STS_CATALOG)
+    assert "sts:*" not in grouped
+    assert "sts:GetSessionToken" not in grouped
+
+
+def test_prefix_wildcard_requires_all_matching_actions():
+    assume_actions = {name for name in STS_CATALOG if name.startswith("Assume")}
+    assert len(assume_actions) > 1
+    assert group_actions("sts", assume_actions | {"GetCallerIdentity"}, STS_CATALOG) == ["sts:Assume*", "sts:GetCallerIdentity"]
+
+    # Assume で始まるアクションの一部だけを使った場合は、使ったアクションだけを並べる
+    assert group_actions("sts", {"AssumeRole", "GetCallerIdentity"}, STS_CATALOG) == ["sts:AssumeRole", "sts:GetCallerIdentity"]
+
+
+def test_actions_without_catalog_are_listed_explicitly():
+    assert group_actions("ec2", {"DescribeInstances", "DescribeVpcs"}, None) == ["ec2:DescribeInstances", "ec2:DescribeVpcs"]
+    # 一覧にないアクションはワイルドカードにまとめた場合もそのまま残す
+    catalog = frozenset({"DescribeInstances", "DescribeVpcs", "RunInstances"})
+    assert group_actions("ec2", {"DescribeInstances", "DescribeVpcs", "DescribeNew"}, catalog) == ["ec2:Describe*", "ec2:DescribeNew"]
+def test_partial_service_gives_explicit_actions():
+    names = {event_name("ec2.amazonaws.com", "DescribeInstances"), event_name("ec2.amazonaws.com", "DescribeVpcs")}
+    catalogs = {"ec2": frozenset({"DescribeInstances", "DescribeVpcs", "DescribeSubnets", "RunInstances"})}
+    actions, unmapped, no_permission = policy_actions(names, catalogs)
+    assert actions == ["ec2:DescribeInstances", "ec2:DescribeVpcs"]
+    assert unmapped == no_permission == []
+
+    # 全てのDescribe系を使った場合だけ Describe* にまとめる
+    names.add(event_name("ec2.amazonaws.com", "DescribeSubnets"))
+    assert policy_actions(names, catalogs)[0] == ["ec2:Describe*"]
+    assert policy_actions(names, catalogs, wildcards=False)[0] == ["ec2:DescribeInstances", "ec2:DescribeSubnets", "ec2:DescribeVpcs"]
+
+
+def test_data_events_map_to_iam_actions():
+    names = {
+        event_name("s3.amazonaws.com", "HeadObject"),
+        event_name("s3.amazonaws.com", "CopyObject"),
+        event_name("s3.amazonaws.com", "ListBuckets"),
+        event_name("lambda.amazonaws.com", "Invoke"),
+        event_name("lambda.amazonaws.com", "GetFunction20150331v2"),
+    }
+    actions, unmapped, no_permission = policy_actions(names)
+    assert actions == ["lambda:GetFunction", "lambda:InvokeFunction", "s3:GetObject", "s3:ListAllMyBuckets", "s3:PutObject"]
+    assert unmapped == no_permission == []
+
+
+def test_unmapped_and_no_permission_events():
+    names = {
+        event_name("apigateway.amazonaws.com", "GetRestApis"),
+        event_name("apigateway.amazonaws.com", "SomethingNew"),
+        event_name("sts.amazonaws.com", "GetCallerIdentity"),
+        event_name("signin.amazonaws.com", "ConsoleLogin"),
+        event_name("monitoring.amazonaws.com", "GetMetricData"),
+    }
+    actions, unmapped, no_permission = policy_actions(names)
+    assert actions == ["apigateway:GET", "cloudwatch:GetMetricData"]
+    # HTTPメソッドが決められないイベントはポリシーに含めず一覧にする
+    assert unmapped == [event_name("apigateway.amazonaws.com", "SomethingNew")]
+    assert no_permission == sorted([event_name("signin.amazonaws.com", "ConsoleLogin"), event_name("sts.amazonaws.com", "GetCallerIdentity")])
+
+
+def test_policy_has_lambda_policy_format():
+    with open(os.path.join(REPO_DIR, "lambda_policy.json"), encoding="utf-8") as f:
+        template = json.load(f)
+    policy, _, _ = generate_policy({event_name("s3.amazonaws.com", "GetObject")})
+    assert policy["Version"] == template["Version"]
+    assert set(policy["Statement"][0]) == set(template["Statement"][0])
+
+
+def test_index_is_kept_in_memory_only(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    load_index.cache_clear()
+    assert load_index() is load_index()
+    # 索引をファイルに保存しない
+    assert not [name for name in os.listdir(REPO_DIR) if name.endswith(".pickle")]
+    assert os.listdir(tmp_path) == []
+
+
+# 対応表は ctinspect パッケージのデータとして読み込む（インストール先の share ディレクトリを探さない）
+def test_mapping_is_read_from_package_data():
+    with open(os.path.join(REPO_DIR, "ctinspect", "cloudtrail_iam_mapping.json"), encoding="utf-8") as f:
+        assert load_mapping() == json.load(f)
@@ -0,0 +1,52 @@
+import datetime
+
+from cloudtrail_aggregate import EventNameStore
+from cloudtrail_presence import COVERAGE_COMPLETE, COVERAGE_LOWER_BOUND, find_distinct_actions, render_presence_result
+from cloudtrail_sources import FakeEventSource
+
+
+START = datetime.datetime(2025, 1, 1)
+END = START + datetime.timedelta(days=1)
+
+
+def fake_lookup(source):
+    def lookup(lookup_attribute, next_token):
+        return source.lookup_events_page(None, START, END, None, next_token, lookup_attribute)
+    return lookup
+
+
+# 全件を取得した場合のイベント名
+def all_actions(source, iam_entity):
+    lookup = fake_lookup(source)
+    event_store = EventNameStore()
+    next_token = None
+    while True:
+        data = lookup(("Username", iam_entity), next_token)
+        for event in data.get("Events", []):
+            event_store.add_event(event)
+        next_token = data.get("NextToken")
+        if not next_token:
+            return set(event_store.render_details())
+
+
+def test_sampled_result_is_reported_as_lower_bound():
+    # ほとんどのイベントが少数のイベント名のため、サンプルでは他のイベント名を見落とす
+    source = FakeEventSource(events_per_day=20000, principals=("heavy-role", "other-user"), hot_rate=0.99)
+    event_store, unconfirmed, api_calls, complete = find_distinct_actions(fake_lookup(source), "heavy-role")
+    found = set(event_store.render_details())
+    assert found < all_actions(source, "heavy-role")
+    assert unconfirmed == []
+    assert not complete
+
+    response = render_presence_result("heavy-role", event_store, unconfirmed, api_calls, complete)
+    assert response["結果の範囲"] == COVERAGE_LOWER_BOUND
+
+
+def test_fully_sampled_result_is_reported_as_complete():
+    source = FakeEventSource(events_per_day=50, principals=("light-user",))
+    event_store, unconfirmed, api_calls, complete = find_distinct_actions(fake_lookup(source), "light-user")
+    assert complete
+    assert set(event_store.render_details()) == all_actions(source, "light-user")
+
+    response = render_presence_result("light-user", event_store, unconfirmed, api_calls, complete)
+    assert response["結果の範囲"] == COVERAGE_COMPLETE
@@ -0,0 +1,121 @@
+import gzip
+import json
+
+import pytest
+
+import cloudtrail_s3_analyzer
+from cloudtrail_s3_analyzer import analyze_log_file, find_log_files
+
+
+# CloudTrailログのレコードを作成する関数
+def make_record(event_source, event_name, user_identity, event_time="2025-01-01T00:00:00Z"):
+    return {
+        "eventVersion": "1.09",
+        "userIdentity": user_identity,
+        "eventTime": event_time,
+        "eventSource": event_source,
+        "eventName": event_name,
+        "awsRegion": "us-east-1",
+        "sourceIPAddress": "192.0.2.1",
+    }
+
+
+def iam_user(name):
+    return {"type": "IAMUser", "userName": name, "arn": f"arn:aws:iam::123456789012:user/{name}"}
+
+
+def assumed_role(role, session):
+    return {
+        "type": "AssumedRole",
+        "arn": f"arn:aws:sts::123456789012:assumed-role/{role}/{session}",
+        "sessionContext": {"sessionIssuer": {"type": "Role", "userName": role}},
+    }
+
+
+# S3にエクスポートされた形式（{"Records": [...]} をgzip圧縮した .json.gz）でログファイルを書き出す
+def write_log(path, records):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump({"Records": records}, f)
+    return str(path)
+
+
+@pytest.fixture
+def log_dir(tmp_path):
+    write_log(tmp_path / "us-east-1" / "2025" / "01" / "alice.json.gz", [
+        make_record("s3.amazonaws.com", "GetObject", iam_user("alice")),
+        make_record("s3.amazonaws.com", "PutObject", iam_user("alice"), "2025-01-02T00:00:00Z"),
+        make_record("ec2.amazonaws.com", "DescribeInstances", iam_user("bob")),
+    ])
+    write_log(tmp_path / "us-east-1" / "2025" / "01" / "role.json.gz", [
+        make_record("sts.amazonaws.com", "GetCallerIdentity", assumed_role("deploy-role", "ci-session")),
+        make_record("iam.amazonaws.com", "GetRole", assumed_role("deploy-role", "alice")),
+    ])
+    write_log(tmp_path / "ap-northeast-1" / "2025" / "01" / "other.json.gz", [
+        make_record("ec2.amazonaws.com", "RunInstances", iam_user("bob")),
+        make_record("ec2.amazonaws.com", "DescribeVpcs", iam_user("carol")),
+    ])
+    # 対象の名前を部分文字列として含むが、対象のレコードはないファイル
+    write_log(tmp_path / "ap-northeast-1" / "2025" / "01" / "substring.json.gz", [
+        make_record("s3.amazonaws.com", "ListBuckets", iam_user("alice-admin")),
+    ])
+    (tmp_path / "ap-northeast-1" / "README.txt").write_text("not a log")
+    return tmp_path
+
+
+# 全ファイルの結果を (IAMエンティティごとの件数, IAMエンティティごとのイベント名) にまとめる
+def analyze_all(paths, principals):
+    counts = {}
+    details = {}
+    records = 0
+    for path in paths:
+        _, records_count, principal_counts, principal_event_stores, _ = analyze_log_file(path, principals)
+        records += records_count
+        for iam_entity, count in principal_counts.items():
+            counts[iam_entity] = counts.get(iam_entity, 0) + count
+        for iam_entity, event_store in principal_event_stores.items():
+            details.setdefault(iam_entity, {}).update(event_store.render_details())
+    return records, counts, details
+
+
+def test_find_log_files_walks_directories(log_dir):
+    paths = find_log_files([str(log_dir)])
+    assert [path.rsplit("/", 1)[-1] for path in paths] == ["other.json.gz", "substring.json.gz", "alice.json.gz", "role.json.gz"]
+
+
+def test_prefilter_skips_files_without_principal(log_dir):
+    path = str(log_dir / "ap-northeast-1" / "2025" / "01" / "other.json.gz")
+    size, records_count, principal_counts, principal_event_stores, _ = analyze_log_file(path, {"alice"})
+    assert size > 0
+    # 読み飛ばしたファイルもレコード数は数える
+    assert records_count == 2
+    assert principal_counts == {}
+    assert principal_event_stores == {}
+
+
+def test_principal_matches_user_role_and_session_names(log_dir):
+    _, counts, details = analyze_all(find_log_files([str(log_dir)]), {"alice", "deploy-role", "ci-session"})
+    assert counts == {"alice": 3, "deploy-role": 2, "ci-session": 1}
+    assert set(details["alice"]) == {"s3:GetObject", "s3:PutObject", "iam:GetRole"}
+    assert set(details["deploy-role"]) == {"sts:GetCallerIdentity", "iam:GetRole"}
+    assert details["alice"]["s3:PutObject"]["最終"] == "2025-01-02T00:00:00Z"
+
+
+@pytest.mark.parametrize("principals", [{"alice"}, {"bob"}, {"alice", "bob", "carol"}, {"nobody"}])
+def test_prefilter_gives_same_result_as_full_parse(log_dir, monkeypatch, principals):
+    paths = find_log_files([str(log_dir)])
+    _, filtered_counts, filtered_details = analyze_all(paths, principals)
+    # 読み飛ばしを無効にして全ファイルをパースした結果と比較する
+    monkeypatch.setattr(cloudtrail_s3_analyzer, "PREFILTER_MAX_PRINCIPALS", 0)
+    _, full_counts, full_details = analyze_all(paths, principals)
+    assert filtered_counts == full_counts
+    assert filtered_details == full_details
+
+
+def test_export_rows_are_returned_for_matched_records(log_dir):
+    path = str(log_dir / "us-east-1" / "2025" / "01" / "alice.json.gz")
+    _, _, _, _, export_rows = analyze_log_file(path, {"alice"}, export=True)
+    assert [row[:4] for row in export_rows] == [
+        ("alice", 1735689600000, "s3.amazonaws.com", "GetObject"),
+        ("alice", 1735776000000, "s3.amazonaws.com", "PutObject"),
+    ]
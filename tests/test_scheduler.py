@@ -0,0 +1,121 @@
+import datetime
+import threading
+import time
+
+import pytest
+
+import cloudtrail_fetcher
+import cloudtrail_scheduler
+from cloudtrail_scheduler import LOOKUP_EVENTS_TPS, MIN_RATE, RATE_RECOVERY_STEP, TokenBucket, get_rate_limiter, run_work_units
+from cloudtrail_sources import FakeEventSource
+
+
+# 待機せずに時刻だけを進める時計（time.monotonic / perf_counter / sleep の代わり）
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cloudtrail_scheduler, "time", clock)
+    monkeypatch.setattr(cloudtrail_fetcher, "time", clock)
+    monkeypatch.setattr(cloudtrail_scheduler, "_rate_limiters", {})
+    return clock
+
+
+def test_acquire_waits_for_refill(clock):
+    bucket = TokenBucket(rate=2.0)
+    bucket.acquire()
+    bucket.acquire()
+    assert clock.sleeps == []
+    # バケットが空になったら次のトークンまで 1/レート 秒待つ
+    bucket.acquire()
+    assert clock.sleeps == [pytest.approx(0.5)]
+
+
+def test_throttle_halves_rate_down_to_floor(clock):
+    bucket = TokenBucket(rate=2.0)
+    rates = []
+    for _ in range(6):
+        bucket.on_throttle()
+        rates.append(bucket.rate)
+    assert rates == pytest.approx([1.0, 0.5, 0.25, 0.125, MIN_RATE, MIN_RATE])
+    assert bucket.throttle_count == 6
+    assert bucket.tokens == 0
+
+    # スロットリング後は下げたレートでトークンを補充する
+    bucket.acquire()
+    assert clock.sleeps == [pytest.approx(1 / MIN_RATE)]
+
+
+def test_success_recovers_rate_up_to_max(clock):
+    bucket = TokenBucket(rate=2.0)
+    for _ in range(10):
+        bucket.on_throttle()
+    successes = 0
+    while bucket.rate < bucket.max_rate:
+        bucket.on_success()
+        successes += 1
+    assert successes == round((2.0 - MIN_RATE) / RATE_RECOVERY_STEP)
+    bucket.on_success()
+    assert bucket.rate == 2.0
+
+
+def test_fetch_page_lowers_rate_on_throttling(clock, monkeypatch):
+    # 常にスロットリングする取得元では、再試行のたびにレートを半分にして最後はエラーにする
+    source = FakeEventSource(throttle_rate=1.0)
+    monkeypatch.setattr(cloudtrail_fetcher, "_event_source", source)
+    with pytest.raises(Exception, match="最大再試行回数"):
+        cloudtrail_fetcher.fetch_page("u", None, None, "us-east-1", max_retries=3)
+    limiter = get_rate_limiter("us-east-1")
+    assert source.throttles == 4
+    assert limiter.throttle_count == 4
+    assert limiter.rate == pytest.approx(LOOKUP_EVENTS_TPS / 16)
+
+
+def test_fetch_page_recovers_rate_after_throttling(clock, monkeypatch):
+    source = FakeEventSource(events_per_day=100, principals=("u",))
+    monkeypatch.setattr(cloudtrail_fetcher, "_event_source", source)
+    limiter = get_rate_limiter("us-east-1")
+    limiter.on_throttle()
+    start_time = datetime.datetime(2025, 1, 1)
+    cloudtrail_fetcher.fetch_page("u", start_time, start_time + datetime.timedelta(days=1), "us-east-1")
+    assert limiter.rate == pytest.approx(LOOKUP_EVENTS_TPS / 2 + RATE_RECOVERY_STEP)
+
+
+def test_run_work_units_returns_all_results():
+    results = dict(run_work_units(range(20), lambda unit: unit * unit, concurrency=4))
+    assert results == {unit: unit * unit for unit in range(20)}
+
+
+def test_run_work_units_cancels_pending_units_on_error():
+    started = []
+    lock = threading.Lock()
+
+    def worker(unit):
+        with lock:
+            started.append(unit)
+        if unit == 0:
+            raise RuntimeError("failed")
+        time.sleep(0.05)
+        return unit
+
+    with pytest.raises(RuntimeError):
+        for _ in run_work_units(range(50), worker, concurrency=1):
+            pass
+    time.sleep(0.2)
+    # 失敗した作業単位の後は、実行中だった作業単位を除いて開始しない
+    assert len(started) <= 2
@@ -0,0 +1,102 @@
+import csv
+import datetime
+from collections import Counter
+
+import pytest
+
+import cloudtrail_aggregate
+from cloudtrail_aggregate import EventNameStore, write_timeline
+from cloudtrail_extract import normalize_service_name
+from cloudtrail_sources import FakeEventSource
+
+
+START = datetime.datetime(2025, 1, 1)
+END = datetime.datetime(2025, 1, 3, 23, 59, 59)
+
+
+@pytest.fixture(autouse=True)
+def daily_counts(monkeypatch):
+    monkeypatch.setattr(cloudtrail_aggregate, "_daily_counts_enabled", True)
+
+
+# 擬似データの全イベント
+def fake_events(iam_entity, events_per_day=200):
+    source = FakeEventSource(events_per_day=events_per_day, principals=("alice", "bob"))
+    events = []
+    next_token = None
+    while True:
+        data = source.lookup_events_page(iam_entity, START, END, None, next_token, None)
+        events.extend(data["Events"])
+        next_token = data.get("NextToken")
+        if not next_token:
+            return events
+
+
+def build_store(events):
+    store = EventNameStore()
+    for event in events:
+        store.add_event(event)
+    return store
+
+
+# イベントから直接数えた (日付, サービス名, eventSource, eventName) ごとの回数
+def expected_daily_counts(events):
+    return Counter(
+        (event["EventTime"].date(), normalize_service_name(event["EventSource"]), event["EventSource"], event["EventName"])
+        for event in events
+    )
+
+
+def test_timeline_rows_match_daily_counts():
+    events = fake_events("alice")
+    store = build_store(events)
+    rows = list(store.timeline_rows())
+
+    assert {row[:4]: row[4] for row in rows} == expected_daily_counts(events)
+    # 日付順に並び、3日間の全イベントを含む
+    assert [row[0] for row in rows] == sorted(row[0] for row in rows)
+    assert {row[0] for row in rows} == {datetime.date(2025, 1, 1), datetime.date(2025, 1, 2), datetime.date(2025, 1, 3)}
+    assert sum(row[4] for row in rows) == len(events)
+
+    # 初回・最終の日時はイベントの最小・最大の日時で、タイムラインの最初と最後の日と一致する
+    details = store.render_details()
+    for key in {f"{normalize_service_name(event['EventSource'])}:{event['EventName']}" for event in events}:
+        event_times = [event["EventTime"] for event in events
+                       if f"{normalize_service_name(event['EventSource'])}:{event['EventName']}" == key]
+        assert details[key]["初回"] == min(event_times).strftime("%Y-%m-%dT%H:%M:%SZ")
+        assert details[key]["最終"] == max(event_times).strftime("%Y-%m-%dT%H:%M:%SZ")
+        dates = [row[0] for row in rows if f"{row[1]}:{row[3]}" == key]
+        assert (min(dates), max(dates)) == (min(event_times).date(), max(event_times).date())
+
+
+def test_daily_counts_survive_journal_state():
+    store = build_store(fake_events("alice"))
+    assert list(EventNameStore.from_state(store.to_state()).timeline_rows()) == list(store.timeline_rows())
+
+
+def test_write_timeline_csv(tmp_path):
+    stores = {"alice": build_store(fake_events("alice")), "bob": build_store(fake_events("bob"))}
+    path = str(tmp_path / "timeline.csv")
+    write_timeline(path, stores)
+
+    with open(path, encoding="utf-8", newline="") as f:
+        rows = list(csv.DictReader(f))
+    assert tuple(rows[0]) == cloudtrail_aggregate.TIMELINE_COLUMNS
+    for iam_entity, store in stores.items():
+        written = [
+            (datetime.date.fromisoformat(row["date"]), row["service"], row["event_source"], row["event_name"], int(row["count"]))
+            for row in rows if row["principal"] == iam_entity
+        ]
+        assert written == list(store.timeline_rows())
+
+
+def test_write_timeline_parquet(tmp_path):
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    store = build_store(fake_events("alice"))
+    path = str(tmp_path / "timeline.parquet")
+    write_timeline(path, {"alice": store})
+
+    table = pyarrow_parquet.read_table(path).to_pydict()
+    assert tuple(table) == cloudtrail_aggregate.TIMELINE_COLUMNS
+    assert set(table["principal"]) == {"alice"}
+    assert list(zip(table["date"], table["service"], table["event_source"], table["event_name"], table["count"])) == list(store.timeline_rows())